@@ -0,0 +1,57 @@
+import asyncio
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from database_manager import DatabaseManager
+
+
+class AsyncDatabaseManager:
+    '''
+    Awaitable facade over DatabaseManager that keeps queries off the event loop.
+    Reads run on a bounded pool so they overlap each other and the writer, writes queue on one thread since SQLite has a single writer.
+    '''
+    READ_WORKERS = 8 #TODO make configurable
+    WRITE_METHODS = {"save_songs", "update_wanted", "update_download_paths", "delete_songs", "migrate", "init_db"}
+
+    _executors = {} #shared by every AsyncDatabaseManager in the process, "read" and "write" pools
+    _executors_lock = threading.Lock()
+
+    def __init__(self):
+        self.logger = logging.getLogger("AsyncDatabaseManager")
+        self._db_m = DatabaseManager()
+
+    @classmethod
+    def _get_executor(cls, kind):
+        with cls._executors_lock:
+            executor = cls._executors.get(kind)
+            if executor is None:
+                workers = 1 if kind == "write" else cls.READ_WORKERS
+                executor = cls._executors[kind] = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{kind}")
+            return executor
+
+    @classmethod
+    def shutdown(cls):
+        '''
+        Waits for queued queries and stops the worker threads, used on shutdown
+        '''
+        with cls._executors_lock:
+            executors, cls._executors = cls._executors, {}
+        for executor in executors.values():
+            executor.shutdown(wait=True)
+
+    def __getattr__(self, name):
+        '''
+        Wraps each DatabaseManager method in a coroutine that runs it on the read or write pool
+        '''
+        method = getattr(self._db_m, name)
+        if not callable(method):
+            return method
+        kind = "write" if name in self.WRITE_METHODS else "read"
+
+        @functools.wraps(method)
+        async def run(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(kind), functools.partial(method, *args, **kwargs))
+        return run
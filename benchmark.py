@@ -0,0 +1,932 @@
+'''
+Benchmarks for the hot paths of the server and client, run one with:
+python benchmark.py <name> [options]
+'''
+import argparse
+import asyncio
+import json
+import os
+import posixpath
+import random
+import re
+import socket
+import socketserver
+import subprocess
+import tempfile
+import threading
+import time
+
+def percentile(values, percent):
+    '''
+    Nearest-rank percentile of a list of numbers
+    '''
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))]
+
+def report_latencies(label, latencies):
+    print(f"{label:>8}: n={len(latencies)} p50={percentile(latencies, 50)*1000:.1f}ms p99={percentile(latencies, 99)*1000:.1f}ms max={max(latencies)*1000:.1f}ms")
+
+def make_customs(count, start=0):
+    return [
+        {
+            "file_id": f"bench{i}",
+            "artist": f"Artist {i % 997}",
+            "title": f"Title {i}",
+            "diff_drums": i % 7,
+            "diff_guitar": i % 5,
+            "diff_bass": i % 3,
+            "diff_vocals": -1,
+            "download_url": f"/download/{i}",
+            "wanted": i % 2 == 0,
+            "downloaded": False,
+            "download_path": "",
+        }
+        for i in range(start, start + count)
+    ]
+
+def make_dta(count, start=0):
+    '''
+    A merged songs.dta with 'count' songs laid out the way customs packs are
+    '''
+    return "".join(
+        f"""(song{i}
+   (name "Title {i}")
+   (artist "Artist {i % 997}")
+   (master TRUE)
+   (song
+      (name "songs/song{i}/song{i}")
+      (tracks ((drum (0 1 2 3 4 5)) (bass (6 7)) (guitar (8 9)) (vocals (10 11))))
+      (vols (-1.5 -1.5 -2.0 -2.0 0.0 0.0 -3.5 -3.5 0 0 0 0))
+      (pans (-1.0 1.0 -1.0 1.0 -1.0 1.0 -1.0 1.0 -1.0 1.0 -1.0 1.0))
+      (cores (-1 -1 -1 -1 -1 -1 1 1 -1 -1 -1 -1))
+      ;(crowd_channels 12 13)
+      (vocal_parts 3)
+   )
+   (rank (drum {i % 400}) (guitar 200) (bass 100) (vocals 50) (band 250))
+   (genre 'rock')
+   (year_released {1960 + i % 60})
+   (preview 30000 60000)
+)
+"""
+        for i in range(start, start + count)
+    )
+
+# === DTA parsing ===
+def legacy_dta_to_nested_list(dta):
+    '''
+    The findall plus recursive parse_tokens parser DTAProcessor used before, kept as the baseline
+    '''
+    from dta_processor import DTAProcessor
+
+    def parse_tokens(tokens, i=0):
+        parsed = []
+        while i < len(tokens):
+            token = tokens[i]
+            if token == '(':
+                i, subtree = parse_tokens(tokens, i + 1)
+                parsed.append(subtree)
+            elif token == ')':
+                return i, parsed
+            elif token.startswith(';'):
+                pass
+            else:
+                parsed.append(DTAProcessor.parse_atom(token))
+            i += 1
+        return i, parsed
+
+    return parse_tokens(re.findall(r'\'[^\']*\'|\"[^\"]*\"|\(|\)|;[^\n]*|[^\s()]+', dta))[1]
+
+def bench_dta_parse(args):
+    '''
+    songs.dta parse time of DTAProcessor against the old recursive parser
+    '''
+    from dta_processor import DTAProcessor
+
+    if args.file:
+        with open(args.file, "r") as dta_f:
+            dta = dta_f.read()
+    else:
+        dta = make_dta(args.songs)
+    print(f"{len(dta) / 1e6:.1f}MB of .dta, best of {args.repeat}")
+    results = {}
+    for label, parse in [("legacy", legacy_dta_to_nested_list), ("current", DTAProcessor.dta_to_nested_list)]:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[label] = parse(dta)
+            timings.append(time.perf_counter() - start)
+        print(f"{label:>8}: {min(timings)*1000:.0f}ms {len(dta) / 1e6 / min(timings):.1f}MB/s {len(results[label])} top level items")
+    if repr(results["legacy"]) != repr(results["current"]):
+        raise SystemExit("Parsers disagree")
+
+def legacy_nested_list_to_dta(nested, level=1, indent="   "):
+    '''
+    The string concatenating serializer DTAProcessor used before, kept as the baseline
+    '''
+    s = ""
+    if isinstance(nested, list):
+        s = "("
+        if any(isinstance(each, list) for each in nested):
+            for i, each in enumerate(nested):
+                s += "\n" + (indent * level) + (legacy_nested_list_to_dta(each, level + 1) + " " if i != len(nested) - 1 else legacy_nested_list_to_dta(each, level + 1))
+            s += "\n" + (indent * (level - 1)) + ")"
+        else:
+            for i, each in enumerate(nested):
+                s += (legacy_nested_list_to_dta(each, level) + " ") if i != len(nested) - 1 else legacy_nested_list_to_dta(each, level)
+            s += ")"
+    else:
+        s = str(nested)
+    return s
+
+def bench_dta_write(args):
+    '''
+    Writing parsed songs back to a songs.dta, concatenated into one string against streamed to the file
+    '''
+    from dta_processor import DTAProcessor
+
+    songs = DTAProcessor.dta_to_nested_list(make_dta(args.songs))
+
+    def concatenated(path):
+        modified_content = ""
+        for song in songs:
+            modified_content += legacy_nested_list_to_dta(song) + "\n"
+        with open(path, "w") as dta_f:
+            dta_f.write(modified_content)
+
+    def streamed(path):
+        with open(path, "w") as dta_f:
+            for song in songs:
+                DTAProcessor.write_dta(song, dta_f.write)
+                dta_f.write("\n")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        outputs = {}
+        for label, write in [("concat", concatenated), ("stream", streamed)]:
+            outputs[label] = os.path.join(tmp, f"{label}.dta")
+            start = time.perf_counter()
+            write(outputs[label])
+            elapsed = time.perf_counter() - start
+            size = os.path.getsize(outputs[label])
+            print(f"{label:>8}: {elapsed*1000:.0f}ms {size / 1e6 / elapsed:.1f}MB/s {len(songs) / elapsed:.0f} songs/s")
+        with open(outputs["concat"], "rb") as concat_f, open(outputs["stream"], "rb") as stream_f:
+            if concat_f.read() != stream_f.read():
+                raise SystemExit("Serializers disagree")
+
+def bench_dta_read(args):
+    '''
+    Reading songs.dta for name and artist then writing every other song back, full parse against span indexing of the read or mapped file
+    '''
+    import mmap
+    import tracemalloc
+    from dta_processor import DTAProcessor
+
+    def full(path, out_f):
+        with open(path, "r", encoding="latin-1") as dta_f:
+            nested = DTAProcessor.dta_to_nested_list(dta_f.read())
+        songs = [(each[1][1], each[2][1], each) for each in nested if isinstance(each, list)]
+        for song in songs[::2]:
+            out_f.write((DTAProcessor.nested_list_to_dta(song[2]) + "\n").encode("latin-1"))
+
+    def indexed(path, out_f, data=None):
+        if data is None:
+            with open(path, "rb") as dta_f:
+                data = dta_f.read()
+        spans, (trailer_start, trailer_end) = DTAProcessor.index_songs(data, ("name", "artist"))
+        view = memoryview(data)
+        songs = [(fields.get("name"), fields.get("artist"), view[start:end]) for start, end, fields in spans]
+        out_f.writelines([song[2] for song in songs[::2]] + [view[trailer_start:trailer_end]])
+
+    def mapped(path, out_f):
+        with open(path, "rb") as dta_f:
+            data = mmap.mmap(dta_f.fileno(), 0, access=mmap.ACCESS_READ)
+        indexed(path, out_f, data)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.file
+        if not path:
+            path = os.path.join(tmp, "songs.dta")
+            with open(path, "wb") as dta_f:
+                dta_f.write(make_dta(args.songs).encode())
+        print(f"{os.path.getsize(path) / 1e6:.1f}MB of .dta")
+        for label, run in [("full", full), ("indexed", indexed), ("mapped", mapped)]:
+            with open(os.path.join(tmp, f"{label}.dta"), "wb") as out_f:
+                start = time.perf_counter()
+                run(path, out_f)
+                elapsed = time.perf_counter() - start
+            with open(os.path.join(tmp, f"{label}.dta"), "wb") as out_f:
+                tracemalloc.start()
+                run(path, out_f)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            print(f"{label:>8}: {elapsed*1000:.0f}ms peak {peak / 1e6:.1f}MB of Python allocations")
+
+def bench_dta_parallel(args):
+    '''
+    Indexing one large songs.dta split over 1, 2, 4 and 8 worker processes
+    '''
+    import mmap
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from dta_processor import DTAProcessor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "songs.dta")
+        with open(path, "wb") as dta_f:
+            dta_f.write(make_dta(args.songs).encode())
+        with open(path, "rb") as dta_f:
+            data = mmap.mmap(dta_f.fileno(), 0, access=mmap.ACCESS_READ)
+        print(f"{len(data) / 1e6:.1f}MB of .dta, {os.cpu_count()} cores")
+
+        start = time.perf_counter()
+        expected = DTAProcessor.index_songs(data)
+        serial = time.perf_counter() - start
+        print(f"  serial: {serial*1000:.0f}ms")
+        for workers in args.workers:
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                list(pool.map(abs, range(workers * 4))) #start the workers before timing
+                start = time.perf_counter()
+                result = DTAProcessor.index_file(path, data, executor=pool, parts=workers)
+                elapsed = time.perf_counter() - start
+            if result != expected:
+                raise SystemExit(f"{workers} workers disagree with serial indexing")
+            print(f"{workers:>8}: {elapsed*1000:.0f}ms {serial / elapsed:.2f}x")
+        data.close()
+
+def bench_dta_parallel_fuzz(args):
+    '''
+    Indexing random scraps of .dta split over worker processes against indexing them serially, cuts land inside songs, quotes and comments
+    '''
+    import mmap
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+    from dta_processor import DTAProcessor
+
+    pieces = ["(", ")", "'", '"', ";", "\n", "\n(", " ", "name", "artist", "x", "q", "1", "'q'", '"a;"', "(name ", "(artist "]
+    rng = random.Random(args.seed)
+    mismatches = 0
+    with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=args.workers, mp_context=get_context("spawn")) as pool:
+        path = os.path.join(tmp, "songs.dta")
+        for case in range(args.cases):
+            text = "".join(rng.choice(pieces) for _ in range(rng.randint(1, 40)))
+            with open(path, "wb") as dta_f:
+                dta_f.write(text.encode())
+            with open(path, "rb") as dta_f:
+                data = mmap.mmap(dta_f.fileno(), 0, access=mmap.ACCESS_READ)
+            with data:
+                expected = DTAProcessor.index_songs(data)
+                result = DTAProcessor.index_file(path, data, executor=pool, parts=rng.randint(2, 4))
+            if result != expected:
+                mismatches += 1
+                print(f"case {case} {text!r}: {result} serially {expected}")
+    print(f"{args.cases - mismatches}/{args.cases} cases agree with serial indexing")
+    if mismatches:
+        raise SystemExit(f"{mismatches} cases disagree with serial indexing")
+
+def bench_dta_stream(args):
+    '''
+    Peak memory of streaming songs out of songs.dta files of growing size, it should stay flat
+    '''
+    import tracemalloc
+    from dta_processor import DTAProcessor
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for songs in args.songs:
+            path = os.path.join(tmp, f"{songs}.dta")
+            with open(path, "wb") as dta_f:
+                dta_f.write(make_dta(songs).encode())
+            start = time.perf_counter()
+            count = sum(1 for _, fields in DTAProcessor.iter_dta(path) if fields is not None)
+            elapsed = time.perf_counter() - start
+            tracemalloc.start()
+            for _ in DTAProcessor.iter_dta(path):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"{count:>8} songs: {os.path.getsize(path) / 1e6:.1f}MB streamed with a {peak / 1e6:.2f}MB peak in {elapsed*1000:.0f}ms")
+
+def bench_dtb_parse(args):
+    '''
+    Decode time of a compiled songs.dtb against parsing the same songs from text
+    '''
+    from dta_processor import DTAProcessor
+
+    dta = make_dta(args.songs)
+    dtb = DTAProcessor.nested_list_to_dtb(DTAProcessor.dta_to_nested_list(dta))
+    print(f"{len(dta) / 1e6:.1f}MB of .dta, {len(dtb) / 1e6:.1f}MB of .dtb, best of {args.repeat}")
+    results = {}
+    for label, size, parse in [("text", len(dta), lambda: DTAProcessor.dta_to_nested_list(dta)), ("binary", len(dtb), lambda: DTAProcessor.dtb_to_nested_list(dtb))]:
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[label] = parse()
+            timings.append(time.perf_counter() - start)
+        print(f"{label:>8}: {min(timings)*1000:.0f}ms {size / 1e6 / min(timings):.1f}MB/s {len(results[label]) / min(timings):.0f} songs/s")
+    if results["text"] != results["binary"]:
+        raise SystemExit("Decoded .dtb differs from the parsed .dta")
+    if DTAProcessor.nested_list_to_dtb(results["binary"]) != dtb:
+        raise SystemExit("Encoding the decoded .dtb gives different bytes")
+
+def bench_dta_suite(args):
+    '''
+    Round trip check and tokenize, parse and serialize throughput of DTAProcessor on a generated corpus, each run is appended to a history file
+    '''
+    from dta_corpus import check_round_trip, make_corpus
+    from dta_processor import DTAProcessor
+
+    for seed in range(args.seed, args.seed + args.check):
+        try:
+            check_round_trip(make_corpus(200, seed))
+        except ValueError as e:
+            raise SystemExit(f"Round trip failed for seed {seed}: {e}")
+    print(f"Round trip held for {args.check} corpora of 200 songs")
+
+    dta = make_corpus(args.songs, args.seed)
+    size = len(dta.encode(DTAProcessor.DEFAULT_ENCODING))
+    tokens = DTAProcessor.tokenize(dta)
+    _, parsed = DTAProcessor.parse_tokens(tokens)
+    stages = {
+        "tokenize": lambda: DTAProcessor.tokenize(dta),
+        "parse": lambda: DTAProcessor.parse_tokens(tokens),
+        "serialize": lambda: "\n".join(DTAProcessor.nested_list_to_dta(song) for song in parsed),
+    }
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    previous = None
+    if os.path.exists(args.history):
+        with open(args.history, "r") as history_f:
+            runs = [json.loads(line) for line in history_f if line.strip()]
+        previous = next((run for run in reversed(runs) if run["songs"] == args.songs), None)
+    print(f"{size / 1e6:.1f}MB corpus of {len(parsed)} songs, best of {args.repeat}")
+    run = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": commit, "songs": len(parsed), "bytes": size, "stages": {}}
+    for stage, call in stages.items():
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            call()
+            timings.append(time.perf_counter() - start)
+        best = min(timings)
+        run["stages"][stage] = {"seconds": best, "mb_per_s": size / 1e6 / best, "songs_per_s": len(parsed) / best}
+        change = ""
+        if previous is not None and stage in previous["stages"]:
+            change = f" ({best / previous['stages'][stage]['seconds'] - 1:+.0%} time against {previous['commit'] or previous['time']})"
+        print(f"{stage:>10}: {best*1000:.0f}ms {size / 1e6 / best:.1f}MB/s {len(parsed) / best:.0f} songs/s{change}")
+    with open(args.history, "a") as history_f:
+        history_f.write(json.dumps(run) + "\n")
+
+# === Song records ===
+def bench_song_memory(args):
+    '''
+    Memory held by a library of songs, plain objects with fully parsed content against slotted lazy Song records
+    '''
+    import tracemalloc
+    from dta_processor import DTAProcessor
+    from song_manager import Song
+
+    class PlainSong: #how Song stored songs before
+        def __init__(self):
+            self.name = ""
+            self.artist = ""
+            self.content = []
+            self.excluded = False
+
+    def plain(data):
+        songs = []
+        for each in DTAProcessor.dta_to_nested_list(data.decode()):
+            song = PlainSong()
+            song.name, song.artist, song.content = each[1][1].strip('"'), each[2][1].strip('"'), each
+            songs.append(song)
+        return songs
+
+    def lazy(data):
+        songs = []
+        for start, end, fields in DTAProcessor.index_songs(data, ("name", "artist"))[0]:
+            song = Song()
+            song.name, song.artist = fields["name"].strip('"'), fields["artist"].strip('"')
+            song.set_span(data, start, end)
+            songs.append(song)
+        return songs
+
+    def decoded(data):
+        songs = lazy(data)
+        for song in songs:
+            song.rank, song.year #decodes every typed field
+        return songs
+
+    data = make_dta(args.songs).encode()
+    print(f"{args.songs} songs, {len(data) / 1e6:.1f}MB of .dta not counted")
+    for label, build in [("plain", plain), ("lazy", lazy), ("decoded", decoded)]:
+        tracemalloc.start()
+        songs = build(data)
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print(f"{label:>8}: {held / 1e6:.1f}MB {held / len(songs):.0f}B/song")
+        del songs
+
+# === PS3 FTP ===
+class LocalFTPServer(socketserver.ThreadingTCPServer):
+    '''
+    Just enough of an FTP server over a local directory to stand in for a PS3, every command waits 'latency' seconds before it is answered
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, root, latency=0.0):
+        super().__init__(("127.0.0.1", 0), LocalFTPHandler)
+        self.root = root
+        self.latency = latency
+        self.commands = 0
+        self.logins = 0
+        self.cut_after = None #bytes the next RETR sends before the session is dropped
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+class LocalFTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode("latin-1"))
+
+    def local_path(self, path):
+        path = posixpath.normpath(posixpath.join(self.cwd, path))
+        return path, os.path.join(self.server.root, path.lstrip("/"))
+
+    def data_connection(self):
+        connection, _ = self.passive.accept()
+        self.passive.close()
+        return connection
+
+    def handle(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1) #a reply right after another would otherwise wait on a delayed ACK
+        self.cwd = "/"
+        self.reply("220 Local FTP stand-in")
+        for line in self.rfile:
+            time.sleep(self.server.latency)
+            self.server.commands += 1
+            command, _, argument = line.decode("latin-1").rstrip("\r\n").partition(" ")
+            handler = getattr(self, f"ftp_{command.lower()}", None)
+            if handler is None:
+                self.reply("502 Not implemented")
+            elif handler(argument) is False:
+                return
+
+    def ftp_user(self, argument):
+        self.reply("331 Any password")
+
+    def ftp_pass(self, argument):
+        self.server.logins += 1
+        self.reply("230 Logged in")
+
+    def ftp_noop(self, argument):
+        self.reply("200 OK")
+
+    ftp_type = ftp_noop
+
+    def ftp_pwd(self, argument):
+        self.reply(f'257 "{self.cwd}"')
+
+    def ftp_cwd(self, argument):
+        path, local = self.local_path(argument)
+        if not os.path.isdir(local):
+            return self.reply("550 No such directory")
+        self.cwd = path
+        self.reply("250 OK")
+
+    def ftp_pasv(self, argument):
+        self.passive = socket.create_server(("127.0.0.1", 0))
+        port = self.passive.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 0xFF})")
+
+    def ftp_mlsd(self, argument):
+        _, local = self.local_path(argument or ".")
+        if not os.path.isdir(local):
+            return self.reply("550 No such directory")
+        listing = []
+        for entry in os.scandir(local):
+            stat = entry.stat()
+            modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(stat.st_mtime))
+            listing.append(f"type={'dir' if entry.is_dir() else 'file'};size={stat.st_size};modify={modify}; {entry.name}\r\n")
+        self.reply("150 Listing")
+        with self.data_connection() as connection:
+            connection.sendall("".join(listing).encode("latin-1"))
+        self.reply("226 Done")
+
+    def ftp_mlst(self, argument):
+        path, local = self.local_path(argument or ".")
+        if not os.path.exists(local):
+            return self.reply("550 No such file or directory")
+        stat = os.stat(local)
+        modify = time.strftime("%Y%m%d%H%M%S", time.gmtime(stat.st_mtime))
+        self.reply(f"250-Listing {path}")
+        self.reply(f" type={'dir' if os.path.isdir(local) else 'file'};size={stat.st_size};modify={modify}; {path}")
+        self.reply("250 End")
+
+    def ftp_size(self, argument):
+        _, local = self.local_path(argument)
+        if not os.path.isfile(local):
+            return self.reply("550 No such file")
+        self.reply(f"213 {os.path.getsize(local)}")
+
+    def ftp_mdtm(self, argument):
+        _, local = self.local_path(argument)
+        if not os.path.isfile(local):
+            return self.reply("550 No such file")
+        self.reply(f"213 {time.strftime('%Y%m%d%H%M%S', time.gmtime(os.path.getmtime(local)))}")
+
+    def ftp_rest(self, argument):
+        self.offset = int(argument)
+        self.reply(f"350 Restarting at {self.offset}")
+
+    def ftp_retr(self, argument):
+        _, local = self.local_path(argument)
+        offset, self.offset = getattr(self, "offset", 0), 0
+        if not os.path.isfile(local):
+            return self.reply("550 No such file")
+        with open(local, "rb") as file_f:
+            file_f.seek(offset)
+            data = file_f.read()
+        cut, self.server.cut_after = self.server.cut_after, None
+        self.reply("150 Sending")
+        with self.data_connection() as connection:
+            connection.sendall(data if cut is None else data[:cut])
+        if cut is not None:
+            return False #drops the session mid transfer
+        self.reply("226 Done")
+
+    def ftp_stor(self, argument):
+        _, local = self.local_path(argument)
+        self.reply("150 Receiving")
+        with self.data_connection() as connection, open(local, "wb") as file_f:
+            while chunk := connection.recv(65536):
+                file_f.write(chunk)
+        self.reply("226 Done")
+
+    def ftp_rnfr(self, argument):
+        self.rename_from = self.local_path(argument)[1]
+        self.reply("350 Ready")
+
+    def ftp_rnto(self, argument):
+        os.replace(self.rename_from, self.local_path(argument)[1])
+        self.reply("250 Renamed")
+
+    def ftp_dele(self, argument):
+        _, local = self.local_path(argument)
+        if not os.path.isfile(local):
+            return self.reply("550 No such file")
+        os.remove(local)
+        self.reply("250 Deleted")
+
+    def ftp_quit(self, argument):
+        self.reply("221 Bye")
+        return False
+
+def make_ps3_tree(root, games, packs):
+    '''
+    A dev_hdd0/game with 'games' game folders, every other one a Rock Band one with 'packs' song folders in USRDIR
+    '''
+    for game in range(games):
+        game_dir = os.path.join(root, "dev_hdd0", "game", f"BLUS{30000 + game}")
+        os.makedirs(os.path.join(game_dir, "PS3_GAME" if game % 2 else "USRDIR"))
+        if game % 2:
+            continue
+        os.makedirs(os.path.join(game_dir, "USRDIR", "gen"))
+        for pack in range(packs):
+            songs_dir = os.path.join(game_dir, "USRDIR", f"pack{pack}", "songs")
+            os.makedirs(songs_dir)
+            open(os.path.join(songs_dir, "songs.dtab" if pack % 3 == 0 else "songs.dta"), "w").close()
+
+def legacy_ps3_discovery(host, port):
+    '''
+    The one directory at a time cwd and MLSD walk RBManager used before, a login per phase
+    '''
+    from ftplib import FTP
+
+    def session():
+        ftp = FTP(encoding="latin-1", timeout=60)
+        ftp.connect(host, port)
+        ftp.login()
+        return ftp
+
+    with session() as ftp:
+        ftp.cwd("/dev_hdd0/game")
+        game_folders = [os.path.join("/dev_hdd0/game", name) for name, t in ftp.mlsd() if name not in (".", "..") and t["type"] == "dir"]
+    usr_dirs = []
+    with session() as ftp:
+        for game_folder in game_folders:
+            ftp.cwd(game_folder)
+            usr_dirs += [os.path.join(game_folder, "USRDIR") for name, t in ftp.mlsd() if name == "USRDIR" and t["type"] == "dir"]
+            ftp.cwd("/")
+    song_folders = []
+    with session() as ftp:
+        for usr_dir in usr_dirs:
+            ftp.cwd(usr_dir)
+            for name, t in ftp.mlsd():
+                if name in (".", "..") or t["type"] != "dir" or name == "gen":
+                    continue
+                ftp.cwd(os.path.join(usr_dir, name))
+                song_folders += [os.path.join(usr_dir, name, "songs") for songs, t in ftp.mlsd() if songs == "songs" and t["type"] == "dir"]
+                ftp.cwd("/")
+            ftp.cwd("/")
+    dta_dirs = {}
+    with session() as ftp:
+        for song_folder in song_folders:
+            ftp.cwd(song_folder)
+            files = [name for name, t in ftp.mlsd() if t["type"] == "file"]
+            if any(file.endswith(".dtab") for file in files):
+                dta_dirs[song_folder] = True
+            elif any(file.endswith(".dta") for file in files):
+                dta_dirs[song_folder] = False
+            ftp.cwd("/")
+    return dta_dirs
+
+def bench_ftp_crawl(args):
+    '''
+    PS3 song folder discovery over FTP with a per command latency, the old serial walk against RBManager's crawl with a few connection counts, then again reusing its saved listings, before and after a .dta shows up in a songs folder that had none
+    '''
+    from ftp_pool import FTPSessionPool
+    from rb_manager import RBManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, local = os.path.join(tmp, "ps3"), os.path.join(tmp, "local")
+        make_ps3_tree(remote, args.games, args.packs)
+        late_dir = os.path.join(remote, "dev_hdd0", "game", "BLUS30000", "USRDIR", "late", "songs")
+        os.makedirs(late_dir) #empty for now, gets a .dta once the listings are saved
+        server = LocalFTPServer(remote, args.latency)
+        print(f"{args.games} game folders, {args.games // 2 * args.packs} song folders, {args.latency * 1000:.0f}ms per command")
+        start = time.perf_counter()
+        expected = legacy_ps3_discovery("127.0.0.1", server.port)
+        print(f"{'serial':>8}: {time.perf_counter() - start:.2f}s {server.commands} commands {server.logins} logins")
+        for connections in args.connections:
+            rb_manager = RBManager(cwd=local) #buffers and the listings cache stay out of the repo
+            rb_manager.ps3_ip = "127.0.0.1"
+            rb_manager.ftp_pool = FTPSessionPool("127.0.0.1", server.port, max_sessions=connections)
+            for label, rescan in [(f"{connections} x", True), ("reusing", False)]:
+                server.commands = server.logins = 0
+                start = time.perf_counter()
+                if not rb_manager.get_dta_dirs(rescan=rescan):
+                    raise SystemExit("Discovery failed")
+                elapsed = time.perf_counter() - start
+                print(f"{label:>8}: {elapsed:.2f}s {server.commands} commands {server.logins} logins")
+                if rb_manager.dta_dirs != expected or list(rb_manager.dta_dirs) != list(expected):
+                    raise SystemExit(f"Found different song folders with {connections} connections")
+            rb_manager.close()
+        time.sleep(1.1) #MLSD and MLST modify times are in seconds
+        open(os.path.join(late_dir, "songs.dta"), "w").close()
+        expected = legacy_ps3_discovery("127.0.0.1", server.port)
+        rb_manager = RBManager(cwd=local)
+        rb_manager.ps3_ip = "127.0.0.1"
+        rb_manager.ftp_pool = FTPSessionPool("127.0.0.1", server.port, max_sessions=args.connections[-1])
+        server.commands = server.logins = 0
+        start = time.perf_counter()
+        if not rb_manager.get_dta_dirs():
+            raise SystemExit("Discovery failed")
+        print(f"{'new .dta':>8}: {time.perf_counter() - start:.2f}s {server.commands} commands {server.logins} logins")
+        if rb_manager.dta_dirs != expected or list(rb_manager.dta_dirs) != list(expected):
+            raise SystemExit("Missed the .dta added to a songs folder")
+        rb_manager.close()
+        server.shutdown()
+
+def bench_ftp_download(args):
+    '''
+    Downloading .dtas from a PS3 over FTP: everything, again with nothing changed, and with a transfer cut halfway that has to resume
+    '''
+    from ftp_pool import FTPSessionPool
+    from rb_manager import RBManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, local = os.path.join(tmp, "ps3"), os.path.join(tmp, "local")
+        data = make_dta(args.songs).encode()
+        dta_dirs = {}
+        for pack in range(args.packs):
+            songs_dir = f"/dev_hdd0/game/BLUS30050/USRDIR/pack{pack}/songs"
+            os.makedirs(os.path.join(remote, songs_dir.lstrip("/")))
+            with open(os.path.join(remote, songs_dir.lstrip("/"), "songs.dta"), "wb") as dta_f:
+                dta_f.write(data)
+            dta_dirs[songs_dir] = False
+        server = LocalFTPServer(remote, args.latency)
+        rb_manager = RBManager(cwd=local)
+        rb_manager.ps3_ip = "127.0.0.1"
+        rb_manager.dta_dirs = dta_dirs
+        print(f"{args.packs} .dtas of {len(data) / 1e6:.1f}MB, {args.latency * 1000:.0f}ms per command")
+        for label, cut_after in [("cold", None), ("unchanged", None), ("resumed", len(data) // 2)]:
+            if cut_after is not None:
+                changed = time.time() + 60
+                for dir in dta_dirs:
+                    os.utime(os.path.join(remote, dir.lstrip("/"), "songs.dta"), (changed, changed)) #changed on the PS3, so they are downloaded again
+                server.cut_after = cut_after
+            rb_manager.ftp_pool = FTPSessionPool("127.0.0.1", server.port, max_sessions=args.connections)
+            server.commands = 0
+            start = time.perf_counter()
+            if rb_manager.download_dtas() is False:
+                raise SystemExit("Download failed")
+            elapsed = time.perf_counter() - start
+            rb_manager.close()
+            print(f"{label:>10}: {elapsed:.2f}s {server.commands} commands")
+            for dir in dta_dirs:
+                with open(os.path.join(rb_manager.buffer_path("FROM", dir), "songs.dta"), "rb") as dta_f:
+                    if dta_f.read() != data:
+                        raise SystemExit(f"{dir} downloaded wrong")
+        server.shutdown()
+
+def bench_ftp_upload(args):
+    '''
+    Uploading modified .dtas to a PS3 over FTP, one file after another on one session against RBManager's pooled atomic uploads
+    '''
+    from ftplib import FTP
+    from ftp_pool import FTPSessionPool
+    from rb_manager import RBManager
+
+    with tempfile.TemporaryDirectory() as tmp:
+        remote, local = os.path.join(tmp, "ps3"), os.path.join(tmp, "local")
+        original, modified = make_dta(args.songs).encode(), make_dta(args.songs // 2).encode()
+        rb_manager = RBManager(cwd=local)
+        rb_manager.ps3_ip = "127.0.0.1"
+        for pack in range(args.packs):
+            dir = f"/dev_hdd0/game/BLUS30050/USRDIR/pack{pack}/songs"
+            os.makedirs(os.path.join(remote, dir.lstrip("/")))
+            for buffer, files in [("FROM", {"songs.dta": original}), ("TO", {"songs.dta": modified, "songs.dtab": original})]:
+                os.makedirs(rb_manager.buffer_path(buffer, dir))
+                for name, data in files.items():
+                    with open(os.path.join(rb_manager.buffer_path(buffer, dir), name), "wb") as dta_f:
+                        dta_f.write(data)
+            rb_manager.dta_dirs[dir] = False
+        server = LocalFTPServer(remote, args.latency)
+        total = args.packs * (len(original) + len(modified))
+        print(f"{args.packs} directories of {(len(original) + len(modified)) / 1e6:.1f}MB, {args.latency * 1000:.0f}ms per command")
+
+        start = time.perf_counter()
+        with FTP(encoding="latin-1", timeout=60) as ftp:
+            ftp.connect("127.0.0.1", server.port)
+            ftp.login()
+            for dir in rb_manager.dta_dirs:
+                ftp.cwd(dir)
+                for name in ("songs.dta", "songs.dtab"):
+                    with open(os.path.join(rb_manager.buffer_path("TO", dir), name), "rb") as dta_f:
+                        ftp.storbinary(f"STOR {name}", dta_f)
+                ftp.cwd("/")
+        elapsed = time.perf_counter() - start
+        print(f"{'serial':>10}: {elapsed:.2f}s {total / 1e6 / elapsed:.1f}MB/s")
+
+        for connections in args.connections:
+            for dir in rb_manager.dta_dirs:
+                rb_manager.dta_dirs[dir] = False
+            rb_manager.ftp_pool = FTPSessionPool("127.0.0.1", server.port, max_sessions=connections)
+            start = time.perf_counter()
+            if not rb_manager.upload():
+                raise SystemExit("Upload failed")
+            elapsed = time.perf_counter() - start
+            print(f"{connections:>8} x: {elapsed:.2f}s {total / 1e6 / elapsed:.1f}MB/s")
+            rb_manager.close()
+        rb_manager.ftp_pool = FTPSessionPool("127.0.0.1", server.port, max_sessions=args.connections[-1])
+        start = time.perf_counter()
+        if not rb_manager.upload(): #the .dtabs are on the PS3 now and unchanged, only the .dtas go again
+            raise SystemExit("Upload failed")
+        elapsed = time.perf_counter() - start
+        print(f"{'backed up':>10}: {elapsed:.2f}s {args.packs * len(modified) / 1e6 / elapsed:.1f}MB/s")
+        rb_manager.close()
+        for dir in rb_manager.dta_dirs:
+            for name, data in [("songs.dta", modified), ("songs.dtab", original)]:
+                with open(os.path.join(remote, dir.lstrip("/"), name), "rb") as dta_f:
+                    if dta_f.read() != data:
+                        raise SystemExit(f"{dir}/{name} uploaded wrong")
+            if len(os.listdir(os.path.join(remote, dir.lstrip("/")))) != 2:
+                raise SystemExit(f"Temporary files left in {dir}")
+        server.shutdown()
+
+# === Async database ===
+def bench_async_db(args):
+    '''
+    GET latency while a large write is running, with queries called on the event loop versus awaited through AsyncDatabaseManager
+    '''
+    from database_manager import DatabaseManager
+    from async_database_manager import AsyncDatabaseManager
+
+    async def run(mode, db_m, async_db_m):
+        latencies = []
+        version = 0
+
+        async def get_request(arrival):
+            if mode == "sync":
+                db_m.get_page("customs", {}, "artist", None, 100)
+            else:
+                await async_db_m.get_page("customs", {}, "artist", None, 100)
+            latencies.append(time.perf_counter() - arrival)
+
+        async def write_request():
+            nonlocal version
+            for _ in range(args.writes):
+                version += 1
+                songs = make_customs(args.write_rows)
+                for song in songs:
+                    song["title"] += f" v{version}" #forces every row to be rewritten
+                if mode == "sync":
+                    db_m.save_songs(songs, "customs")
+                else:
+                    await async_db_m.save_songs(songs, "customs")
+                await asyncio.sleep(0.01)
+
+        writer = asyncio.create_task(write_request())
+        gets = []
+        while not writer.done():
+            gets.append(asyncio.create_task(get_request(time.perf_counter())))
+            await asyncio.sleep(args.interval)
+        await asyncio.gather(writer, *gets)
+        return latencies
+
+    with tempfile.TemporaryDirectory() as tmp:
+        DatabaseManager.FILE_PATH = os.path.join(tmp, "bench.db")
+        db_m = DatabaseManager()
+        db_m.save_songs(make_customs(args.rows), "customs", chunk_size=5000)
+        async_db_m = AsyncDatabaseManager()
+        print(f"{args.rows} customs, {args.writes} writes of {args.write_rows} rows, a GET every {args.interval*1000:.0f}ms")
+        for mode in ["sync", "async"]:
+            report_latencies(mode, asyncio.run(run(mode, db_m, async_db_m)))
+        AsyncDatabaseManager.shutdown()
+        DatabaseManager.close_connections()
+
+def main():
+    parser = argparse.ArgumentParser(description="RockbandManager benchmarks")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    async_db = benchmarks.add_parser("async-db", help=bench_async_db.__doc__.strip())
+    async_db.add_argument("--rows", type=int, default=100000, help="customs in the database")
+    async_db.add_argument("--writes", type=int, default=5, help="bulk writes to run during the GETs")
+    async_db.add_argument("--write-rows", type=int, default=20000, help="rows per bulk write")
+    async_db.add_argument("--interval", type=float, default=0.005, help="seconds between GETs")
+    async_db.set_defaults(run=bench_async_db)
+
+    dta_parse = benchmarks.add_parser("dta-parse", help=bench_dta_parse.__doc__.strip())
+    dta_parse.add_argument("--songs", type=int, default=10000, help="songs in the generated .dta")
+    dta_parse.add_argument("--file", help="parse this songs.dta instead of a generated one")
+    dta_parse.add_argument("--repeat", type=int, default=3, help="runs per parser")
+    dta_parse.set_defaults(run=bench_dta_parse)
+
+    dta_read = benchmarks.add_parser("dta-read", help=bench_dta_read.__doc__.strip())
+    dta_read.add_argument("--songs", type=int, default=10000, help="songs in the generated .dta")
+    dta_read.add_argument("--file", help="read this songs.dta instead of a generated one")
+    dta_read.set_defaults(run=bench_dta_read)
+
+    dta_write = benchmarks.add_parser("dta-write", help=bench_dta_write.__doc__.strip())
+    dta_write.add_argument("--songs", type=int, default=10000, help="songs in the generated pack")
+    dta_write.set_defaults(run=bench_dta_write)
+
+    song_memory = benchmarks.add_parser("song-memory", help=bench_song_memory.__doc__.strip())
+    song_memory.add_argument("--songs", type=int, default=50000, help="songs in the library")
+    song_memory.set_defaults(run=bench_song_memory)
+
+    dta_parallel = benchmarks.add_parser("dta-parallel", help=bench_dta_parallel.__doc__.strip())
+    dta_parallel.add_argument("--songs", type=int, default=50000, help="songs in the generated .dta")
+    dta_parallel.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8], help="worker counts to try")
+    dta_parallel.set_defaults(run=bench_dta_parallel)
+
+    dta_parallel_fuzz = benchmarks.add_parser("dta-parallel-fuzz", help=bench_dta_parallel_fuzz.__doc__.strip())
+    dta_parallel_fuzz.add_argument("--cases", type=int, default=6000, help="random .dtas to index")
+    dta_parallel_fuzz.add_argument("--seed", type=int, default=0, help="seed of the random .dtas")
+    dta_parallel_fuzz.add_argument("--workers", type=int, default=2, help="worker processes")
+    dta_parallel_fuzz.set_defaults(run=bench_dta_parallel_fuzz)
+
+    dta_stream = benchmarks.add_parser("dta-stream", help=bench_dta_stream.__doc__.strip())
+    dta_stream.add_argument("--songs", type=int, nargs="+", default=[1000, 10000, 50000], help="sizes of the generated .dtas")
+    dta_stream.set_defaults(run=bench_dta_stream)
+
+    dtb_parse = benchmarks.add_parser("dtb-parse", help=bench_dtb_parse.__doc__.strip())
+    dtb_parse.add_argument("--songs", type=int, default=10000, help="songs in the generated .dta and .dtb")
+    dtb_parse.add_argument("--repeat", type=int, default=3, help="runs per decoder")
+    dtb_parse.set_defaults(run=bench_dtb_parse)
+
+    dta_suite = benchmarks.add_parser("dta-suite", help=bench_dta_suite.__doc__.strip())
+    dta_suite.add_argument("--songs", type=int, default=10000, help="songs in the generated corpus")
+    dta_suite.add_argument("--seed", type=int, default=0, help="seed of the generated corpus")
+    dta_suite.add_argument("--check", type=int, default=20, help="corpora checked for round trips before timing")
+    dta_suite.add_argument("--repeat", type=int, default=3, help="runs per stage")
+    dta_suite.add_argument("--history", default="benchmark_history.jsonl", help="file each run's results are appended to")
+    dta_suite.set_defaults(run=bench_dta_suite)
+
+    ftp_crawl = benchmarks.add_parser("ftp-crawl", help=bench_ftp_crawl.__doc__.strip())
+    ftp_crawl.add_argument("--games", type=int, default=200, help="game folders on the stand-in PS3, every other one has song folders")
+    ftp_crawl.add_argument("--packs", type=int, default=3, help="song folders in each of those")
+    ftp_crawl.add_argument("--latency", type=float, default=0.005, help="seconds added to every FTP command")
+    ftp_crawl.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4, 8], help="FTP sessions the crawl may use at once")
+    ftp_crawl.set_defaults(run=bench_ftp_crawl)
+
+    ftp_download = benchmarks.add_parser("ftp-download", help=bench_ftp_download.__doc__.strip())
+    ftp_download.add_argument("--packs", type=int, default=8, help=".dtas on the stand-in PS3")
+    ftp_download.add_argument("--songs", type=int, default=2000, help="songs in each .dta")
+    ftp_download.add_argument("--latency", type=float, default=0.005, help="seconds added to every FTP command")
+    ftp_download.add_argument("--connections", type=int, default=4, help="FTP sessions downloads may use at once")
+    ftp_download.set_defaults(run=bench_ftp_download)
+
+    ftp_upload = benchmarks.add_parser("ftp-upload", help=bench_ftp_upload.__doc__.strip())
+    ftp_upload.add_argument("--packs", type=int, default=8, help="directories to upload to")
+    ftp_upload.add_argument("--songs", type=int, default=2000, help="songs in each original .dta")
+    ftp_upload.add_argument("--latency", type=float, default=0.005, help="seconds added to every FTP command")
+    ftp_upload.add_argument("--connections", type=int, nargs="+", default=[1, 2, 4], help="FTP sessions uploads may use at once")
+    ftp_upload.set_defaults(run=bench_ftp_upload)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == "__main__":
+    main()
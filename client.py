@@ -1,4 +1,6 @@
 import logging, logging.config
+import os
+import json
 from requests import get, post
 from ipaddress import ip_address
 from re import match
@@ -6,6 +8,43 @@ from re import match
 from rb_manager import RBManager
 from song_manager import SongManager
 
+WHITELIST_CACHE = "whitelist.json" #TODO make configurable
+
+def sync_whitelist(server_ip, server_port):
+    '''
+    Brings the locally cached whitelist up to date by only getting the officials that changed since the last sync
+    '''
+    logger = logging.getLogger("Client")
+    version, whitelist = 0, set()
+    if os.path.exists(WHITELIST_CACHE):
+        try:
+            with open(WHITELIST_CACHE, 'r') as cache_f:
+                cache = json.load(cache_f)
+            version, whitelist = cache["version"], {tuple(entry) for entry in cache["whitelist"]}
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable whitelist cache: {e}")
+            version, whitelist = 0, set()
+
+    response = get(f"http://{server_ip}:{server_port}/whitelist", params={"since": version})
+    response.raise_for_status()
+    changes = response.json()
+    if changes["version"] < version: #server's database was replaced, start over
+        logger.warning("Server's change version went backwards, resyncing the whole whitelist")
+        os.remove(WHITELIST_CACHE)
+        return sync_whitelist(server_ip, server_port)
+
+    for entry in changes["deleted"]:
+        whitelist.discard((entry["artist"], entry["title"]))
+    for entry in changes["data"]:
+        if entry["wanted"]:
+            whitelist.add((entry["artist"], entry["title"]))
+        else:
+            whitelist.discard((entry["artist"], entry["title"]))
+    with open(WHITELIST_CACHE, 'w') as cache_f:
+        json.dump({"version": changes["version"], "whitelist": sorted(whitelist)}, cache_f)
+    logger.info(f"Whitelist synced from version {version} to {changes['version']}, {len(changes['data'])} changed and {len(changes['deleted'])} deleted")
+    return list(whitelist)
+
 if __name__ == "__main__":
     logging.config.dictConfig({
         'version': 1,
@@ -44,6 +83,16 @@ if __name__ == "__main__":
                 'level': 'DEBUG',
                 'propagate': False,
             },
+            'DTACache': {
+                'handlers': ['file', 'stdout'],
+                'level': 'DEBUG',
+                'propagate': False,
+            },
+            'FTPSessionPool': {
+                'handlers': ['file', 'stdout'],
+                'level': 'DEBUG',
+                'propagate': False,
+            },
         },
     })
     logger = logging.getLogger("Client")
@@ -113,11 +162,7 @@ if __name__ == "__main__":
 
         logger.info("Getting whitelist information from server")
         try:
-            response = get(f"http://{server_ip}:{server_port}/whitelist")
-            if response.status_code == 204:
-                logger.warning("Server had no table 'officials' in database")
-            else:
-                song_manager.whitelist = [(entry["artist"], entry["title"]) for entry in response.json()]
+            song_manager.whitelist = sync_whitelist(server_ip, server_port)
         except Exception as e:
             logger.error(f"failed updating whitelist: {e}")
         logger.info("Succesfully updated whitelist")
@@ -157,4 +202,6 @@ if __name__ == "__main__":
         #TODO add custom song processing: get wanted customs, download files from url, convert to .pkg, tell RBManager to send them to applicable directory on target
 
     except Exception as e:
-        logger.error(f"General Error:{e}")
\ No newline at end of file
+        logger.error(f"General Error:{e}")
+    finally:
+        rb_manager.close()
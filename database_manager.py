@@ -1,260 +1,801 @@
 import sqlite3
 import threading
+import time
+import json
+import base64
+import weakref
 from contextlib import contextmanager
 import logging
 
+from response_cache import ResponseCache
+from song_matching import make_match_key
+
+
+class _ThreadConnections:
+    '''
+    Holds one thread's connections in its thread-local storage, which goes away with the thread and lets the finalizer close them
+    '''
+    __slots__ = ("connections", "__weakref__")
+
+    def __init__(self):
+        self.connections = {} #database file is key, connection is value
+
 
 class DatabaseManager:
     TABLES = ["customs", "officials"]
     FILE_PATH = "rb.db" #TODO make configurable
+    BUSY_TIMEOUT = 60 #seconds a connection waits on a lock held by another process
+    CHUNK_SIZE = 500 #rows per executemany batch on bulk writes
+    CUSTOMS_FIELDS = ["file_id", "artist", "title", "diff_drums", "diff_guitar", "diff_bass", "diff_vocals", "download_url", "wanted", "downloaded", "download_path"]
+    OFFICIALS_FIELDS = ["artist", "title", "wanted"]
+    SEARCH_LIMIT = 500 #most results a single search can return
+    PAGE_LIMIT = 500 #most rows a single page can return
+    #columns each page sort orders by, every list is unique per row and backed by an index
+    PAGE_SORTS = {
+        "customs": {
+            "artist": ["artist", "title", "file_id"],
+            "title": ["title", "file_id"],
+            **{diff: [f"{diff}_sort", "file_id"] for diff in ["diff_drums", "diff_guitar", "diff_bass", "diff_vocals"]},
+        },
+        "officials": {
+            "artist": ["artist", "title"],
+            "title": ["title", "artist"],
+        },
+    }
+    #filters each page accepts, mapped to their SQL condition and the type of their value
+    PAGE_FILTERS = {
+        "customs": {
+            "wanted": ("wanted = ?", bool),
+            "downloaded": ("downloaded = ?", bool),
+            "artist": ("artist = ?", str),
+            **{f"{diff}_min": (f"{diff}_sort >= ?", int) for diff in ["diff_drums", "diff_guitar", "diff_bass", "diff_vocals"]},
+            **{f"{diff}_max": (f"{diff}_sort <= ?", int) for diff in ["diff_drums", "diff_guitar", "diff_bass", "diff_vocals"]},
+        },
+        "officials": {
+            "wanted": ("wanted = ?", bool),
+            "artist": ("artist = ?", str),
+        },
+    }
+    PAGE_FIELDS = {
+        "customs": ["file_id", "artist", "title", "diff_drums", "diff_guitar", "diff_bass", "diff_vocals", "wanted", "downloaded"],
+        "officials": ["title", "artist", "wanted"],
+    }
+
+    #schema migrations, applied in order, PRAGMA user_version holds how many have been applied
+    MIGRATIONS = [
+        #1: base tables
+        [
+            """
+            CREATE TABLE IF NOT EXISTS customs (
+                file_id TEXT PRIMARY KEY,
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                diff_drums INTEGER,
+                diff_guitar INTEGER,
+                diff_bass INTEGER,
+                diff_vocals INTEGER,
+                download_url TEXT,
+                wanted BOOL NOT NULL,
+                downloaded BOOL NOT NULL,
+                download_path TEXT
+            )
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS officials (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                title TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                wanted BOOLEAN NOT NULL,
+                UNIQUE(title, artist)
+            )
+            """,
+        ],
+        #2: partial covering indexes for the wanted/downloaded queries, artist/title lookups
+        [
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted
+            ON customs(file_id) WHERE wanted = TRUE
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_undownloaded
+            ON customs(file_id) WHERE wanted = TRUE AND downloaded = FALSE
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_wanted
+            ON officials(title, artist) WHERE wanted = TRUE
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_artist_title
+            ON customs(artist, title)
+            """,
+        ],
+        #3: full text search over artist/title, kept in sync by triggers
+        #customs is rebuilt with an INTEGER PRIMARY KEY first, the implicit rowid of a table keyed by TEXT can change on VACUUM and the index would point at the wrong rows
+        [
+            """
+            CREATE TABLE customs_with_id (
+                id INTEGER PRIMARY KEY,
+                file_id TEXT NOT NULL UNIQUE,
+                artist TEXT NOT NULL,
+                title TEXT NOT NULL,
+                diff_drums INTEGER,
+                diff_guitar INTEGER,
+                diff_bass INTEGER,
+                diff_vocals INTEGER,
+                download_url TEXT,
+                wanted BOOL NOT NULL,
+                downloaded BOOL NOT NULL,
+                download_path TEXT
+            )
+            """,
+            """
+            INSERT INTO customs_with_id (file_id, artist, title, diff_drums, diff_guitar, diff_bass, diff_vocals, download_url, wanted, downloaded, download_path)
+            SELECT file_id, artist, title, diff_drums, diff_guitar, diff_bass, diff_vocals, download_url, wanted, downloaded, download_path FROM customs ORDER BY rowid
+            """,
+            """
+            DROP TABLE customs
+            """,
+            """
+            ALTER TABLE customs_with_id RENAME TO customs
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted
+            ON customs(file_id) WHERE wanted = TRUE
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_undownloaded
+            ON customs(file_id) WHERE wanted = TRUE AND downloaded = FALSE
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_artist_title
+            ON customs(artist, title)
+            """,
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS customs_fts USING fts5(
+                artist, title,
+                content='customs', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS customs_fts_insert AFTER INSERT ON customs BEGIN
+                INSERT INTO customs_fts(rowid, artist, title) VALUES (new.id, new.artist, new.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS customs_fts_delete AFTER DELETE ON customs BEGIN
+                INSERT INTO customs_fts(customs_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS customs_fts_update AFTER UPDATE OF artist, title ON customs BEGIN
+                INSERT INTO customs_fts(customs_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+                INSERT INTO customs_fts(rowid, artist, title) VALUES (new.id, new.artist, new.title);
+            END
+            """,
+            """
+            INSERT INTO customs_fts(customs_fts) VALUES ('rebuild')
+            """,
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS officials_fts USING fts5(
+                artist, title,
+                content='officials', content_rowid='id',
+                tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+            )
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS officials_fts_insert AFTER INSERT ON officials BEGIN
+                INSERT INTO officials_fts(rowid, artist, title) VALUES (new.id, new.artist, new.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS officials_fts_delete AFTER DELETE ON officials BEGIN
+                INSERT INTO officials_fts(officials_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+            END
+            """,
+            """
+            CREATE TRIGGER IF NOT EXISTS officials_fts_update AFTER UPDATE OF artist, title ON officials BEGIN
+                INSERT INTO officials_fts(officials_fts, rowid, artist, title) VALUES ('delete', old.id, old.artist, old.title);
+                INSERT INTO officials_fts(rowid, artist, title) VALUES (new.id, new.artist, new.title);
+            END
+            """,
+            """
+            INSERT INTO officials_fts(officials_fts) VALUES ('rebuild')
+            """,
+        ],
+        #4: one index per keyset page sort order, each ends with a unique column so page boundaries are exact
+        [
+            """
+            DROP INDEX IF EXISTS idx_customs_artist_title
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_artist_title_file_id
+            ON customs(artist, title, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_title_file_id
+            ON customs(title, file_id)
+            """,
+            """
+            ALTER TABLE customs ADD COLUMN diff_drums_sort INTEGER GENERATED ALWAYS AS (IFNULL(diff_drums, -1)) VIRTUAL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_diff_drums_sort_file_id
+            ON customs(diff_drums_sort, file_id)
+            """,
+            """
+            ALTER TABLE customs ADD COLUMN diff_guitar_sort INTEGER GENERATED ALWAYS AS (IFNULL(diff_guitar, -1)) VIRTUAL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_diff_guitar_sort_file_id
+            ON customs(diff_guitar_sort, file_id)
+            """,
+            """
+            ALTER TABLE customs ADD COLUMN diff_bass_sort INTEGER GENERATED ALWAYS AS (IFNULL(diff_bass, -1)) VIRTUAL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_diff_bass_sort_file_id
+            ON customs(diff_bass_sort, file_id)
+            """,
+            """
+            ALTER TABLE customs ADD COLUMN diff_vocals_sort INTEGER GENERATED ALWAYS AS (IFNULL(diff_vocals, -1)) VIRTUAL
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_diff_vocals_sort_file_id
+            ON customs(diff_vocals_sort, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_artist_title
+            ON officials(artist, title)
+            """,
+            #the same orders behind the wanted filter, wanted = ? then the sort keys is one range of these
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_artist_title_file_id
+            ON customs(wanted, artist, title, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_title_file_id
+            ON customs(wanted, title, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_diff_drums_sort_file_id
+            ON customs(wanted, diff_drums_sort, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_diff_guitar_sort_file_id
+            ON customs(wanted, diff_guitar_sort, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_diff_bass_sort_file_id
+            ON customs(wanted, diff_bass_sort, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_wanted_diff_vocals_sort_file_id
+            ON customs(wanted, diff_vocals_sort, file_id)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_wanted_artist_title
+            ON officials(wanted, artist, title)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_wanted_title_artist
+            ON officials(wanted, title, artist)
+            """,
+        ],
+        #5: change versions for syncing deltas, rows that exist already count as the first change
+        [
+            """
+            CREATE TABLE IF NOT EXISTS change_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+            """,
+            """
+            INSERT OR IGNORE INTO change_version (id, version) VALUES (1, 1)
+            """,
+            """
+            ALTER TABLE customs ADD COLUMN version INTEGER NOT NULL DEFAULT 0
+            """,
+            """
+            ALTER TABLE officials ADD COLUMN version INTEGER NOT NULL DEFAULT 0
+            """,
+            """
+            UPDATE customs SET version = 1
+            """,
+            """
+            UPDATE officials SET version = 1
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_version
+            ON customs(version)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_version
+            ON officials(version)
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS tombstones (
+                target_table TEXT NOT NULL,
+                key TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                PRIMARY KEY (target_table, key)
+            )
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_tombstones_version
+            ON tombstones(target_table, version)
+            """,
+        ],
+        #6: normalized artist/title keys linking officials to customs, backfilled with the match_key() SQL function
+        [
+            """
+            ALTER TABLE customs ADD COLUMN match_key TEXT
+            """,
+            """
+            ALTER TABLE officials ADD COLUMN match_key TEXT
+            """,
+            """
+            UPDATE customs SET match_key = match_key(artist, title)
+            """,
+            """
+            UPDATE officials SET match_key = match_key(artist, title)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_customs_match_key
+            ON customs(match_key)
+            """,
+            """
+            CREATE INDEX IF NOT EXISTS idx_officials_match_key
+            ON officials(match_key)
+            """,
+        ],
+    ]
+
+    #shared by every DatabaseManager in the process, one is constructed per request/scraped page
+    _write_lock = threading.Lock() #SQLite allows one writer at a time, readers run alongside it in WAL mode
+    _local = threading.local() #long-lived connections, one per thread per database file, closed when their thread exits
+    _connections = set() #every connection still open, so they can be closed on shutdown
+    _migrated = set() #database files whose schema is already up to date in this process
+    _migrate_lock = threading.Lock()
+    _cache = ResponseCache() #serialized read responses, dropped whenever the database is written
+    _cache_lock = threading.Lock()
+    _data_versions = {} #database file is key, (connection only used to watch it, last PRAGMA data_version it gave) is value
+    _stats_lock = threading.Lock()
+    _stats = {
+        "connections_opened": 0,
+        "connections_closed": 0,
+        "connections_reused": 0,
+        "read_cursors": 0,
+        "write_cursors": 0,
+        "write_lock_wait_total": 0.0,
+        "write_lock_wait_max": 0.0,
+    }
 
     def __init__(self):
         self.logger = logging.getLogger("DatabaseManager")
         self.logger.debug("Starting DatabaseManager")
         self.file_path = self.FILE_PATH
-        self._lock = threading.Lock()
         self.init_db()
 
+    @classmethod
+    def _count(cls, stat, amount=1):
+        with cls._stats_lock:
+            cls._stats[stat] += amount
+
+    @classmethod
+    def get_stats(cls):
+        '''
+        Snapshot of connection reuse and write lock wait counters
+        '''
+        with cls._stats_lock:
+            return dict(cls._stats)
+
+    @classmethod
+    def get_cache_stats(cls):
+        '''
+        Snapshot of response cache hit and miss counters
+        '''
+        return cls._cache.get_stats()
+
+    @classmethod
+    def close_connections(cls):
+        '''
+        Closes every pooled connection, used on shutdown
+        '''
+        with cls._cache_lock:
+            cls._data_versions = {}
+        with cls._stats_lock:
+            connections, cls._connections = cls._connections, set()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    @classmethod
+    def _close_thread_connections(cls, connections):
+        '''
+        Finalizer of a _ThreadConnections, closes the connections of a thread that exited
+        '''
+        for conn in connections.values():
+            with cls._stats_lock:
+                if conn not in cls._connections: #already closed by close_connections
+                    continue
+                cls._connections.discard(conn)
+                cls._stats["connections_closed"] += 1
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def get_connection(self): #DEBUG LOGGED
+        '''
+        Gives this thread's long-lived connection to the database, opening it on first use.
+        It is closed once the thread exits, so thread pools that come and go don't pile up connections.
+        '''
+        holder = getattr(self._local, "holder", None)
+        if holder is None:
+            holder = self._local.holder = _ThreadConnections()
+            weakref.finalize(holder, self._close_thread_connections, holder.connections)
+        connections = holder.connections
+        conn = connections.get(self.file_path)
+        if conn is not None:
+            self._count("connections_reused")
+            return conn
+        self.logger.debug(f"Opening connection to {self.file_path}")
+        conn = sqlite3.connect(self.file_path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode = WAL") #readers don't block the writer and vice versa
+        conn.execute("PRAGMA synchronous = NORMAL") #safe with WAL, only fsyncs on checkpoint
+        conn.create_function("match_key", 2, make_match_key, deterministic=True)
+        connections[self.file_path] = conn
+        with self._stats_lock:
+            self._connections.add(conn)
+            self._stats["connections_opened"] += 1
+        return conn
+
     @contextmanager
-    def get_cursor(self): #DEBUG LOGGED
+    def get_cursor(self, read_only=False): #DEBUG LOGGED
         '''
-        Establishes connection to database and gives cursor
+        Gives a cursor on this thread's connection.
+        Read only cursors run alongside the writer, write cursors take the write lock and commit on success.
         '''
-        self.logger.debug("Waiting for lock")
-        with self._lock:
-            self.logger.debug("Getting connection")
-            conn = sqlite3.connect(self.file_path, timeout=60)
-            self.logger.debug("Getting cursor")
+        conn = self.get_connection()
+        if read_only:
+            self._count("read_cursors")
             cursor = conn.cursor()
             try:
-                self.logger.debug("Yielding cursor to requestor")
                 yield cursor
             finally:
-                self.logger.debug("Cleaning up connection")
                 cursor.close()
+            return
+
+        self.logger.debug("Waiting for write lock")
+        wait_start = time.perf_counter()
+        with self._write_lock:
+            waited = time.perf_counter() - wait_start
+            with self._stats_lock:
+                self._stats["write_cursors"] += 1
+                self._stats["write_lock_wait_total"] += waited
+                self._stats["write_lock_wait_max"] = max(self._stats["write_lock_wait_max"], waited)
+            cursor = conn.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE") #take SQLite's write lock up front instead of upgrading mid transaction
+                self.logger.debug("Yielding cursor to requestor")
+                yield cursor
                 conn.commit()
-                conn.close()
-                self.logger.debug("Connection cleaned up")
+                self._check_data_version(after_write=True)
+            except BaseException:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                self.logger.debug("Write finished")
 
     def init_db(self): #DEBUG LOGGED
         '''
-        Set up and connect to database
+        Set up the database schema, migrations only run the first time a process opens the database
+        '''
+        with self._migrate_lock:
+            if self.file_path in self._migrated:
+                return
+            self.migrate()
+            self._migrated.add(self.file_path)
+
+    def migrate(self): #DEBUG LOGGED
+        '''
+        Applies every migration newer than the database's 'user_version' in one transaction, then refreshes planner statistics
         '''
         try:
             with self.get_cursor() as cursor:
-                self.logger.debug("Creating 'customs' table")
-                cursor.execute("""
-                    CREATE TABLE IF NOT EXISTS customs (
-                        file_id TEXT PRIMARY KEY,
-                        artist TEXT NOT NULL,
-                        title TEXT NOT NULL,
-                        diff_drums INTEGER,
-                        diff_guitar INTEGER,
-                        diff_bass INTEGER,
-                        diff_vocals INTEGER,
-                        download_url TEXT,
-                        wanted BOOL NOT NULL,
-                        downloaded BOOL NOT NULL,
-                        download_path TEXT
-                    )
-                """)
-                self.logger.debug("Creating 'officials' table")
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS officials (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        title TEXT NOT NULL,
-                        artist TEXT NOT NULL,
-                        wanted BOOLEAN NOT NULL,
-                        UNIQUE(title, artist)
-                    )
-                ''')
+                cursor.execute("PRAGMA user_version")
+                version = cursor.fetchone()[0]
+                if version >= len(self.MIGRATIONS):
+                    self.logger.debug(f"Database schema is up to date at version {version}")
+                    return
+                for number, statements in enumerate(self.MIGRATIONS[version:], start=version+1):
+                    self.logger.info(f"Migrating database schema to version {number}")
+                    for statement in statements:
+                        cursor.execute(statement)
+                    cursor.execute(f"PRAGMA user_version = {number}")
+                self.logger.debug("Analyzing database so the query planner uses the new indexes")
+                cursor.execute("ANALYZE")
         except Exception as e:
-            self.logger.error(f"Could not initialize to database: {e}")
+            self.logger.error(f"Could not migrate database: {e}")
             raise
     
-    def save_songs(self, songs, target_table=""): #DEBUG LOGGED
+    def _prepare_rows(self, songs, fields, key_fields=None): #DEBUG LOGGED
+        '''
+        Validates 'songs' in one pass and turns them into parameter tuples ordered like 'fields'.
+        When 'key_fields' is given, later songs with the same key replace earlier ones.
+        '''
+        self.logger.debug("Checking if 'songs' is a list")
+        if not isinstance(songs, list):
+            raise ValueError(f"'songs' needs to be a list")
+        self.logger.debug("Checking if there are songs")
+        if not len(songs) > 0:
+            raise ValueError(f"'songs' needs to have a nonzero length")
+        self.logger.debug("Checking if every song is a dictionary with the required fields")
+        required = frozenset(fields)
+        rows = [] if key_fields is None else {}
+        for song in songs:
+            if not isinstance(song, dict):
+                raise ValueError(f"Every song in the list must be a dictionary")
+            if not required <= song.keys():
+                raise ValueError(f"Every song needs to have the necessary fields: ({fields})")
+            row = tuple(song[field] for field in fields)
+            if key_fields is None:
+                rows.append(row)
+            else:
+                rows[tuple(song[field] for field in key_fields)] = row
+        return rows if key_fields is None else list(rows.values())
+
+    def _write_in_batches(self, cursor, sql, rows, chunk_size=None, count_existing=None): #DEBUG LOGGED
+        '''
+        Runs 'sql' over 'rows' with one executemany per chunk, inside the caller's transaction.
+        Returns how many rows each chunk inserted, updated and left unchanged.
+        'count_existing' counts the rows of a chunk already in the table, without it every row is treated as existing.
+        '''
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if chunk_size < 1:
+            raise ValueError("'chunk_size' needs to be positive")
+        batches = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start+chunk_size]
+            existing = count_existing(cursor, chunk) if count_existing else len(chunk)
+            cursor.executemany(sql, chunk)
+            changed = cursor.rowcount #rows this statement changed, not counting the ones its triggers changed
+            inserted = len(chunk) - existing
+            updated = changed - inserted
+            batches.append({"inserted": inserted, "updated": updated, "unchanged": len(chunk) - inserted - updated})
+            self.logger.debug(f"Batch {len(batches)}: {batches[-1]}")
+        return batches
+
+    def _update_in_batches(self, cursor, sql, rows, target_table, key_column, chunk_size=None): #DEBUG LOGGED
+        '''
+        Runs the UPDATE 'sql' for each of 'rows', (value, key, value) tuples, inside the caller's transaction.
+        Returns per chunk how many of the given rows updated something, matched rows that already had the value, or matched no row at all.
+        Counts are per given row, one key can match several rows (every spelling of an official shares its match key).
+        '''
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        if chunk_size < 1:
+            raise ValueError("'chunk_size' needs to be positive")
+        limit = cursor.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+        batches = []
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start+chunk_size]
+            found = set()
+            for part_start in range(0, len(chunk), limit):
+                keys = [row[1] for row in chunk[part_start:part_start+limit]]
+                cursor.execute(
+                    f"""
+                    SELECT DISTINCT {key_column} FROM {target_table}
+                    WHERE {key_column} IN ({", ".join("?" * len(keys))})
+                    """,
+                    keys
+                )
+                found.update(key for key, in cursor.fetchall())
+            batch = {"inserted": 0, "updated": 0, "unchanged": 0, "not_found": 0}
+            for row in chunk:
+                if row[1] not in found:
+                    batch["not_found"] += 1
+                    continue
+                cursor.execute(sql, row)
+                batch["updated" if cursor.rowcount else "unchanged"] += 1
+            batches.append(batch)
+            self.logger.debug(f"Batch {len(batches)}: {batch}")
+        return batches
+
+    @staticmethod
+    def _count_existing_customs(cursor, chunk):
+        limit = cursor.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) #one parameter per row, a statement can't bind more than this
+        existing = 0
+        for start in range(0, len(chunk), limit):
+            part = chunk[start:start+limit]
+            cursor.execute(
+                f"""
+                SELECT COUNT(*) FROM customs
+                WHERE file_id IN ({", ".join("?" * len(part))})
+                """,
+                [row[0] for row in part]
+            )
+            existing += cursor.fetchone()[0]
+        return existing
+
+    @staticmethod
+    def _count_existing_officials(cursor, chunk):
+        limit = cursor.connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER) // 2 #two parameters per row
+        existing = 0
+        for start in range(0, len(chunk), limit):
+            part = chunk[start:start+limit]
+            cursor.execute(
+                f"""
+                SELECT COUNT(*) FROM officials
+                WHERE (title, artist) IN (VALUES {", ".join(["(?, ?)"] * len(part))})
+                """,
+                [value for artist, title, *_ in part for value in (title, artist)]
+            )
+            existing += cursor.fetchone()[0]
+        return existing
+
+    def save_songs(self, songs, target_table="", chunk_size=None): #DEBUG LOGGED
+        '''
+        Inserts new songs and updates existing ones in a single transaction.
+        Returns the inserted/updated/unchanged counts of every batch.
+        '''
         self.logger.debug(f"Saving {len(songs)} songs to {target_table}")
         try:
             self.logger.debug("Checking if 'target_table' is valid")
             if target_table not in self.TABLES:
                 raise ValueError(f"Provide a valid target table you want to save songs to ({self.TABLES})")
-            self.logger.debug("Checking if 'songs' is a list")
-            if not isinstance(songs, list):
-                raise ValueError(f"'songs' needs to be a list")
-            self.logger.debug("Checking if there are songs")
-            if not len(songs) > 0:
-                raise ValueError(f"'songs' needs to have a nonzero length")
-            self.logger.debug("Checking if any songs are not a dictionary")
-            if any([not isinstance(song, dict) for song in songs]):
-                raise ValueError(f"Every song in the list must be a dictionary")
-            
+
             if target_table == "customs":
-                self.logger.debug("Checking if every song has the required fields")
-                necessary_fields = ["file_id", "artist", "title", "diff_drums", "diff_guitar", "diff_bass", "diff_vocals", "download_url", "wanted", "downloaded", "download_path"]
-                for field in necessary_fields:
-                    if any([not field in song for song in songs]):
-                        raise ValueError(f"Every song needs to have the necessary fields: ({necessary_fields})")
-                try:
-                    with self.get_cursor() as cursor:
-                        for song in songs:
-                            self.logger.debug(f"Adding song {song} to database")
-                            cursor.execute(
-                                """
-                                INSERT OR REPLACE INTO customs 
-                                    (file_id, artist, title, diff_drums, diff_guitar, diff_bass, diff_vocals, download_url, wanted, downloaded, download_path)
-                                    VALUES
-                                    (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                                """, 
-                                (
-                                    song["file_id"], 
-                                    song["artist"], 
-                                    song["title"], 
-                                    song["diff_drums"], 
-                                    song["diff_guitar"], 
-                                    song["diff_bass"], 
-                                    song["diff_vocals"], 
-                                    song["download_url"], 
-                                    song["wanted"], 
-                                    song["downloaded"], 
-                                    song["download_path"],
-                                )
-                            )
-                except Exception as e:
-                    self.logger.error(f"Failed saving songs to database: {e}")
-                    raise
+                rows = [row + (make_match_key(row[1], row[2]),) for row in self._prepare_rows(songs, self.CUSTOMS_FIELDS, key_fields=["file_id"])]
+                fields = self.CUSTOMS_FIELDS + ["match_key"]
+                sql = f"""
+                    INSERT INTO customs ({", ".join(fields)}, version)
+                    VALUES ({", ".join("?" * len(fields))}, (SELECT version FROM change_version))
+                    ON CONFLICT(file_id) DO UPDATE SET
+                        {", ".join(f"{field} = excluded.{field}" for field in fields[1:])},
+                        version = excluded.version
+                    WHERE ({", ".join(f"customs.{field}" for field in fields[1:])})
+                        IS NOT ({", ".join(f"excluded.{field}" for field in fields[1:])})
+                """
+                count_existing = self._count_existing_customs
             elif target_table == "officials":
-                self.logger.debug("Checking if every song has the required fields for the 'officials' table")
-                necessary_fields = ["artist", "title", "wanted"]
-                for field in necessary_fields:
-                    if any([not field in song for song in songs]):
-                        raise ValueError(f"Every song needs to have the necessary fields: ({necessary_fields})")
-                try:
-                    with self.get_cursor() as cursor:
-                        for song in songs:
-                            self.logger.debug(f"Adding song {song} to database")
-                            cursor.execute(
-                                """
-                                INSERT OR REPLACE INTO officials 
-                                    (artist, title, wanted)
-                                    VALUES
-                                    (?, ?, ?)
-                                """, 
-                                (
-                                    song["artist"], 
-                                    song["title"], 
-                                    song["wanted"],  
-                                )
-                            )
-                except Exception as e:
-                    self.logger.error(f"Failed saving songs to database: {e}")
-                    raise
+                rows = [row + (make_match_key(row[0], row[1]),) for row in self._prepare_rows(songs, self.OFFICIALS_FIELDS, key_fields=["artist", "title"])]
+                sql = """
+                    INSERT INTO officials (artist, title, wanted, match_key, version)
+                    VALUES (?, ?, ?, ?, (SELECT version FROM change_version))
+                    ON CONFLICT(title, artist) DO UPDATE SET
+                        wanted = excluded.wanted,
+                        version = excluded.version
+                    WHERE officials.wanted IS NOT excluded.wanted
+                """
+                count_existing = self._count_existing_officials
+            try:
+                with self.get_cursor() as cursor:
+                    self._next_version(cursor)
+                    batches = self._write_in_batches(cursor, sql, rows, chunk_size, count_existing)
+            except Exception as e:
+                self.logger.error(f"Failed saving songs to database: {e}")
+                raise
+            self.logger.info(f"Saved {len(rows)} songs to {target_table} in {len(batches)} batches")
+            return batches
         except Exception as e:
             self.logger.error(f"Failed to save songs to database: {e}")
             raise
     
-    def update_download_paths(self, songs): #DEBUG LOGGED
+    def update_download_paths(self, songs, chunk_size=None): #DEBUG LOGGED
+        '''
+        Sets the 'download_path' of the given customs in a single transaction.
+        Returns the updated/unchanged/not_found counts of every batch.
+        '''
         self.logger.debug(f"Updating {len(songs)} songs' 'download_path's")
         try:
-            self.logger.debug("Checking if 'songs' is a list")
-            if not isinstance(songs, list):
-                raise ValueError(f"'songs' needs to be a list")
-            self.logger.debug("Checking if there are songs")
-            if not len(songs) > 0:
-                raise ValueError(f"'songs' needs to have a nonzero length")
-            self.logger.debug("Checking if any songs are not a dictionary")
-            if any([not isinstance(song, dict) for song in songs]):
-                raise ValueError(f"Every song in the list must be a dictionary")
-            self.logger.debug("Checking if every song has the required fields")
-            necessary_fields = ["file_id", "download_path"]
-            for field in necessary_fields:
-                if any([not field in song for song in songs]):
-                    raise ValueError(f"Every song needs to have the necessary fields: ({necessary_fields})")
+            rows = [(path, file_id, path) for file_id, path in self._prepare_rows(songs, ["file_id", "download_path"])]
             with self.get_cursor() as cursor:
-                for song in songs:
-                    self.logger.debug(f"Updating {song["file_id"]}'s 'download_path' to {song["download_path"]}")
-                    cursor.execute(
-                        """
-                        UPDATE customs
-                        SET download_path = ?
-                        WHERE file_id = ?
-                        """,
-                        (
-                        song["download_path"],
-                        song["file_id"],
-                        )
-                    )
+                self._next_version(cursor)
+                return self._update_in_batches(
+                    cursor,
+                    """
+                    UPDATE customs
+                    SET download_path = ?, version = (SELECT version FROM change_version)
+                    WHERE file_id = ? AND download_path IS NOT ?
+                    """,
+                    rows,
+                    "customs",
+                    "file_id",
+                    chunk_size
+                )
         except Exception as e:
             self.logger.error(f"Failed to update download paths: {e}")
             raise
     
-    def update_wanted(self, songs, target_table=""):
+    def update_wanted(self, songs, target_table="", chunk_size=None): #DEBUG LOGGED
+        '''
+        Sets 'wanted' for the given songs in a single transaction.
+        Returns the updated/unchanged/not_found counts of every batch, a song that matches no row is counted as not_found.
+        '''
         self.logger.debug("Checking if 'target_table' is valid")
         if target_table not in self.TABLES:
             raise ValueError(f"Provide a valid target table you want to save songs to ({self.TABLES})")
-        self.logger.debug("Checking if 'songs' is a list")
-        if not isinstance(songs, list):
-            raise ValueError(f"'songs' needs to be a list")
-        self.logger.debug("Checking if there are songs")
-        if not len(songs) > 0:
-            raise ValueError(f"'songs' needs to have a nonzero length")
-        self.logger.debug("Checking if any songs are not a dictionary")
-        if any([not isinstance(song, dict) for song in songs]):
-            raise ValueError(f"Every song in the list must be a dictionary")
 
         if target_table == "customs":
-            self.logger.debug("Checking if every song has the required fields")
-            necessary_fields = ["file_id", "wanted"]
-            for field in necessary_fields:
-                if any([not field in song for song in songs]):
-                    raise ValueError(f"Every song needs to have the necessary fields: ({necessary_fields})")
-            try:
-                with self.get_cursor() as cursor:
-                    for song in songs:
-                        self.logger.debug(f"Updating wanted for {song}")
-                        cursor.execute(
-                            """
-                            UPDATE customs
-                            SET wanted = ?
-                            WHERE file_id = ?
-                            """, 
-                            (
-                                song["wanted"],
-                                song["file_id"], 
-                            )
-                        )
-            except Exception as e:
-                self.logger.error(f"Failed updating wanted: {e}")
-                raise
+            rows = [(wanted, file_id, wanted) for file_id, wanted in self._prepare_rows(songs, ["file_id", "wanted"])]
+            sql = """
+                UPDATE customs
+                SET wanted = ?, version = (SELECT version FROM change_version)
+                WHERE file_id = ? AND wanted IS NOT ?
+            """
+            key_column = "file_id"
         elif target_table == "officials":
-            self.logger.debug("Checking if every song has the required fields")
-            necessary_fields = ["title", "artist", "wanted"]
-            for field in necessary_fields:
-                if any([not field in song for song in songs]):
-                    raise ValueError(f"Every song needs to have the necessary fields: ({necessary_fields})")
-            try:
-                with self.get_cursor() as cursor:
-                    for song in songs:
-                        self.logger.debug(f"Updating wanted for {song}")
-                        cursor.execute(
-                            """
-                            UPDATE customs
-                            SET wanted = ?
-                            WHERE (title = ? AND artist = ?)
-                            """, 
-                            (
-                                song["wanted"],
-                                song["title"],
-                                song["artist"], 
-                            )
-                        )
-            except Exception as e:
-                self.logger.error(f"Failed updating wanted: {e}")
-                raise
+            #every spelling of the song shares its match key, so they're all updated together
+            rows = [(wanted, make_match_key(artist, title), wanted) for title, artist, wanted in self._prepare_rows(songs, ["title", "artist", "wanted"])]
+            sql = """
+                UPDATE officials
+                SET wanted = ?, version = (SELECT version FROM change_version)
+                WHERE match_key = ? AND wanted IS NOT ?
+            """
+            key_column = "match_key"
+        try:
+            with self.get_cursor() as cursor:
+                self._next_version(cursor)
+                return self._update_in_batches(cursor, sql, rows, target_table, key_column, chunk_size)
+        except Exception as e:
+            self.logger.error(f"Failed updating wanted: {e}")
+            raise
+
+    def delete_songs(self, songs, target_table="", chunk_size=None): #DEBUG LOGGED
+        '''
+        Deletes the given songs in a single transaction, leaving a tombstone for each so syncing clients learn about it.
+        Returns how many rows each batch deleted.
+        '''
+        self.logger.debug("Checking if 'target_table' is valid")
+        if target_table not in self.TABLES:
+            raise ValueError(f"Provide a valid target table you want to delete songs from ({self.TABLES})")
+
+        if target_table == "customs":
+            rows = self._prepare_rows(songs, ["file_id"])
+            key = "json_object('file_id', file_id)"
+            where = "file_id = ?"
+        elif target_table == "officials":
+            rows = self._prepare_rows(songs, ["title", "artist"])
+            key = "json_object('title', title, 'artist', artist)"
+            where = "title = ? AND artist = ?"
+        chunk_size = chunk_size or self.CHUNK_SIZE
+        try:
+            with self.get_cursor() as cursor:
+                self._next_version(cursor)
+                batches = []
+                for start in range(0, len(rows), chunk_size):
+                    chunk = rows[start:start+chunk_size]
+                    cursor.executemany(
+                        f"""
+                        INSERT INTO tombstones (target_table, key, version)
+                        SELECT '{target_table}', {key}, (SELECT version FROM change_version) FROM {target_table}
+                        WHERE {where}
+                        ON CONFLICT(target_table, key) DO UPDATE SET version = excluded.version
+                        """,
+                        chunk
+                    )
+                    cursor.executemany(f"DELETE FROM {target_table} WHERE {where}", chunk)
+                    batches.append({"deleted": cursor.rowcount})
+            self.logger.info(f"Deleted {sum(batch['deleted'] for batch in batches)} songs from {target_table}")
+            return batches
+        except Exception as e:
+            self.logger.error(f"Failed deleting songs: {e}")
+            raise
+
+    def _next_version(self, cursor):
+        '''
+        Allocates the change version that every row this transaction writes is stamped with
+        '''
+        cursor.execute("UPDATE change_version SET version = version + 1")
     # === Get All ===
     def get_all_file_ids(self): #DEBUG LOGGED
         self.logger.debug("Getting all 'file_id's")
         try:
-            with self.get_cursor() as cursor:
+            with self.get_cursor(read_only=True) as cursor:
                 cursor.execute(
                     """
                     SELECT file_id FROM customs
@@ -268,7 +809,7 @@ class DatabaseManager:
     def get_wanted_official_songs(self): #DEBUG LOGGED
         self.logger.debug("Getting all wanted songs in 'official'")
         try:
-            with self.get_cursor() as cursor:
+            with self.get_cursor(read_only=True) as cursor:
                 cursor.execute(
                     """
                     SELECT title, artist FROM officials
@@ -283,7 +824,7 @@ class DatabaseManager:
     def get_wanted_file_ids_customs(self): #DEBUG LOGGED
         self.logger.debug("Getting all 'file_id's of wanted songs")
         try:
-            with self.get_cursor() as cursor:
+            with self.get_cursor(read_only=True) as cursor:
                 cursor.execute(
                     """
                     SELECT file_id FROM customs
@@ -298,7 +839,7 @@ class DatabaseManager:
     def get_wanted_undownloaded_file_ids_customs(self): #DEBUG LOGGED
         self.logger.debug("Getting all 'file_id's of wanted and undownloaded songs")
         try:
-            with self.get_cursor() as cursor:
+            with self.get_cursor(read_only=True) as cursor:
                 cursor.execute(
                     """
                     SELECT file_id FROM customs
@@ -310,44 +851,86 @@ class DatabaseManager:
             self.logger.error(f"Failed to get wanted custom songs: {e}")
             raise
 
-    # === Get Certain ===
-    def find_file_ids(self, file_ids):#DEBUG LOGGED
-        self.logger.debug(f"Looking if any 'file_id's are in the database that matches: {file_ids}")
-        if not len(file_ids) > 0:
-            raise ValueError("'file_ids' cannot be empty")
-        return [file_id for file_id in self.get_all_file_ids() if file_id in file_ids]
-
-    def find_download_urls(self, file_ids):#DEBUG LOGGED
-        self.logger.debug(f"Looking for any 'download_url's that have a 'file_id' that matches: {file_ids}")
+    def get_customs_for_wanted_officials(self): #DEBUG LOGGED
+        '''
+        Finds the custom charts of every wanted official song by joining on the normalized match key
+        '''
+        self.logger.debug("Getting customs matching wanted officials")
         try:
-            if not len(file_ids) > 0:
-                raise ValueError("'file_ids' cannot be empty")
-            with self.get_cursor() as cursor:
+            with self.get_cursor(read_only=True) as cursor:
                 cursor.execute(
                     """
-                    SELECT file_id, download_url FROM customs
+                    SELECT officials.title, officials.artist, customs.file_id, customs.artist, customs.title, customs.wanted, customs.downloaded FROM officials
+                    JOIN customs ON customs.match_key = officials.match_key
+                    WHERE officials.wanted = TRUE
+                    ORDER BY officials.id
                     """
                 )
-                all_download_urls = cursor.fetchall()
-                return [entry[1] for entry in all_download_urls if entry[0] in file_ids]
+                matches = {}
+                for entry in cursor.fetchall():
+                    official = matches.setdefault((entry[0], entry[1]), {"title":entry[0], "artist":entry[1], "customs":[]})
+                    official["customs"].append({"file_id":entry[2], "artist":entry[3], "title":entry[4], "wanted":entry[5], "downloaded":entry[6]})
+                return list(matches.values())
         except Exception as e:
-            self.logger.error(f"Failed to find download urls: {e}")
+            self.logger.error(f"Failed to get customs for wanted officials: {e}")
             raise
-    
-    def find_artist_and_title_customs(self, file_ids):#DEBUG LOGGED #TODO remove?
-        self.logger.debug(f"Looking for 'artist' and 'title' that have a 'file_id' that matches: {file_ids}")
+
+    # === Get Certain ===
+    def _find_customs(self, columns, file_ids): #DEBUG LOGGED
+        '''
+        Looks up 'columns' of the customs whose 'file_id' is in 'file_ids' with chunked primary key IN queries.
+        Returns the found rows keyed by 'file_id', 'file_id's that aren't in the database are left out.
+        '''
         if not len(file_ids) > 0:
             raise ValueError("'file_ids' cannot be empty")
-        try:
-            with self.get_cursor() as cursor:
+        file_ids = list(dict.fromkeys(file_ids))
+        found = {}
+        with self.get_cursor(read_only=True) as cursor:
+            for start in range(0, len(file_ids), self.CHUNK_SIZE):
+                chunk = file_ids[start:start+self.CHUNK_SIZE]
                 cursor.execute(
-                    """
-                    SELECT file_id, artist, title FROM customs
-                    """
+                    f"""
+                    SELECT file_id{"".join(f", {column}" for column in columns)} FROM customs
+                    WHERE file_id IN ({", ".join("?" * len(chunk))})
+                    """,
+                    chunk
                 )
-                return [(entry[1], entry[2]) for entry in cursor.fetchall() if entry[0] in file_ids]
+                for entry in cursor.fetchall():
+                    found[entry[0]] = entry[1:]
+        self.logger.debug(f"Found {len(found)} of {len(file_ids)} 'file_id's in the database")
+        return found
+
+    def find_file_ids(self, file_ids):#DEBUG LOGGED
+        '''
+        Returns the set of 'file_ids' that are already in the database
+        '''
+        self.logger.debug(f"Looking if any of {len(file_ids)} 'file_id's are in the database")
+        try:
+            return set(self._find_customs([], file_ids))
         except Exception as e:
-            self.logger.error(f"Failed to get artists and titles for {file_id}: {e}")
+            self.logger.error(f"Failed to find file ids: {e}")
+            raise
+
+    def find_download_urls(self, file_ids):#DEBUG LOGGED
+        '''
+        Returns the 'download_url' of each given custom, keyed by 'file_id'
+        '''
+        self.logger.debug(f"Looking for the 'download_url's of {len(file_ids)} 'file_id's")
+        try:
+            return {file_id: entry[0] for file_id, entry in self._find_customs(["download_url"], file_ids).items()}
+        except Exception as e:
+            self.logger.error(f"Failed to find download urls: {e}")
+            raise
+    
+    def find_artist_and_title_customs(self, file_ids):#DEBUG LOGGED
+        '''
+        Returns the ('artist', 'title') of each given custom, keyed by 'file_id'
+        '''
+        self.logger.debug(f"Looking for the 'artist' and 'title' of {len(file_ids)} 'file_id's")
+        try:
+            return self._find_customs(["artist", "title"], file_ids)
+        except Exception as e:
+            self.logger.error(f"Failed to get artists and titles: {e}")
             raise
     
     def get_all_fields(self, target_table=""):
@@ -356,7 +939,7 @@ class DatabaseManager:
             raise ValueError(f"Provide a valid target table you want to save songs to ({self.TABLES})")
         try:
             if target_table == "officials":
-                with self.get_cursor() as cursor:
+                with self.get_cursor(read_only=True) as cursor:
                     cursor.execute(
                         '''
                         SELECT title, artist, wanted FROM officials
@@ -364,7 +947,7 @@ class DatabaseManager:
                     )
                     return [{"title":entry[0], "artist":entry[1], "wanted":entry[2]} for entry in cursor.fetchall()]
             elif target_table == "customs":
-                with self.get_cursor() as cursor:
+                with self.get_cursor(read_only=True) as cursor:
                     cursor.execute(
                         """
                         SELECT file_id, artist, title, diff_drums, diff_guitar, diff_bass, diff_vocals, wanted, downloaded FROM customs
@@ -375,6 +958,212 @@ class DatabaseManager:
             self.logger.error(f"Failed to get all fields for {target_table}: {e}")
             raise
 
+    # === Cached ===
+    def get_cached(self, key, produce): #DEBUG LOGGED
+        '''
+        Gives the JSON bytes and ETag of a read, 'produce' is only called when the response cache has nothing for 'key'.
+        Writes from this process drop the cache on commit, writes from other processes are noticed through PRAGMA data_version.
+        '''
+        self._check_data_version()
+        return self._cache.get((self.file_path, key), lambda: json.dumps(produce()).encode())
+
+    def _check_data_version(self, after_write=False):
+        '''
+        Drops the response cache if the database changed since the last check, or right after a write from this process.
+        PRAGMA data_version only compares with what the same connection gave before, so one connection per database file is kept just to watch it.
+        The version seen right after a write from this process is taken as up to date, so that write doesn't drop the cache again on the next read.
+        '''
+        with self._cache_lock:
+            watcher = self._data_versions.get(self.file_path)
+            if watcher is None:
+                conn = sqlite3.connect(self.file_path, timeout=self.BUSY_TIMEOUT, check_same_thread=False)
+                with self._stats_lock:
+                    self._connections.add(conn)
+                    self._stats["connections_opened"] += 1
+                last_version = None #nothing seen yet, whatever is cached may be from before another process wrote
+            else:
+                conn, last_version = watcher
+            data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+            self._data_versions[self.file_path] = (conn, data_version)
+            if after_write or data_version != last_version:
+                if not after_write:
+                    self.logger.debug("Database changed on another connection, invalidating response cache")
+                self._cache.invalidate() #after reading the version, so a write committed before it can't be missed
+
+    # === Pages ===
+    @staticmethod
+    def _encode_page_cursor(sort, values):
+        return base64.urlsafe_b64encode(json.dumps([sort, values]).encode()).decode()
+
+    @staticmethod
+    def _decode_page_cursor(cursor, sort):
+        try:
+            cursor_sort, values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except Exception:
+            raise ValueError("'cursor' is not a valid page cursor")
+        if cursor_sort != sort:
+            raise ValueError("'cursor' belongs to a different sort order")
+        return values
+
+    @staticmethod
+    def _filter_value(name, value, value_type):
+        '''
+        Converts a filter value, which may come straight from a query string, to its type
+        '''
+        if value_type is bool and isinstance(value, str):
+            if value.lower() not in ("true", "false", "1", "0"):
+                raise ValueError(f"Filter '{name}' needs to be true or false")
+            return value.lower() in ("true", "1")
+        try:
+            return value_type(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Filter '{name}' needs to be of type {value_type.__name__}")
+
+    def get_page(self, target_table="", filters=None, sort="artist", cursor=None, limit=100): #DEBUG LOGGED
+        '''
+        Gets one page of filtered and sorted rows using keyset pagination, so every page costs the same no matter how deep it is.
+        'sort' is one of PAGE_SORTS, prefixed with '-' for descending, 'filters' maps PAGE_FILTERS names to values.
+        Every sort has an index of its own and one behind 'wanted', the other filters are checked along that index,
+        except 'artist' with a difficulty sort, which sorts that artist's songs on each page.
+        Returns the page's rows and the cursor of the next page, which is None on the last page.
+        '''
+        self.logger.debug(f"Getting page of {target_table} sorted by {sort} with filters {filters} after {cursor}")
+        if target_table not in self.TABLES:
+            raise ValueError(f"Provide a valid target table you want to get a page of ({self.TABLES})")
+        if not 0 < limit <= self.PAGE_LIMIT:
+            raise ValueError(f"'limit' needs to be between 1 and {self.PAGE_LIMIT}")
+        descending = sort.startswith("-")
+        key_columns = self.PAGE_SORTS[target_table].get(sort.lstrip("-"))
+        if key_columns is None:
+            raise ValueError(f"'sort' needs to be one of {list(self.PAGE_SORTS[target_table])}, optionally prefixed with '-'")
+
+        conditions = []
+        params = []
+        for name, value in (filters or {}).items():
+            if name not in self.PAGE_FILTERS[target_table]:
+                raise ValueError(f"Unknown filter '{name}', filters are {list(self.PAGE_FILTERS[target_table])}")
+            condition, value_type = self.PAGE_FILTERS[target_table][name]
+            conditions.append(condition)
+            params.append(self._filter_value(name, value, value_type))
+        if cursor is not None:
+            values = self._decode_page_cursor(cursor, sort)
+            if not isinstance(values, list) or len(values) != len(key_columns):
+                raise ValueError("'cursor' is not a valid page cursor")
+            conditions.append(f"({', '.join(key_columns)}) {'<' if descending else '>'} ({', '.join('?' * len(key_columns))})")
+            params += values
+
+        fields = self.PAGE_FIELDS[target_table]
+        try:
+            with self.get_cursor(read_only=True) as db_cursor:
+                db_cursor.execute(
+                    f"""
+                    SELECT {", ".join(fields + key_columns)} FROM {target_table}
+                    {"WHERE " + " AND ".join(conditions) if conditions else ""}
+                    ORDER BY {", ".join(f"{column} {'DESC' if descending else 'ASC'}" for column in key_columns)}
+                    LIMIT ?
+                    """,
+                    params + [limit + 1]
+                )
+                entries = db_cursor.fetchall()
+        except Exception as e:
+            self.logger.error(f"Failed to get page of {target_table}: {e}")
+            raise
+        next_cursor = None
+        if len(entries) > limit:
+            entries = entries[:limit]
+            next_cursor = self._encode_page_cursor(sort, list(entries[-1][len(fields):]))
+        return [dict(zip(fields, entry)) for entry in entries], next_cursor
+
+    # === Changes ===
+    def get_changes(self, target_table="", since=0): #DEBUG LOGGED
+        '''
+        Gets every row written and every row deleted after change version 'since'.
+        Clients apply 'deleted' before 'data', then pass the returned 'version' as 'since' next time.
+        '''
+        self.logger.debug(f"Getting changes to {target_table} since version {since}")
+        if target_table not in self.TABLES:
+            raise ValueError(f"Provide a valid target table you want to get changes of ({self.TABLES})")
+        fields = self.PAGE_FIELDS[target_table]
+        try:
+            with self.get_cursor(read_only=True) as cursor:
+                cursor.execute("SELECT version FROM change_version")
+                version = cursor.fetchone()[0]
+                #rows committed after the version was read are left for the next sync
+                cursor.execute(
+                    f"""
+                    SELECT {", ".join(fields)}, version FROM {target_table}
+                    WHERE version > ? AND version <= ?
+                    ORDER BY version
+                    """,
+                    (since, version)
+                )
+                data = [dict(zip(fields + ["version"], entry)) for entry in cursor.fetchall()]
+                cursor.execute(
+                    """
+                    SELECT key, version FROM tombstones
+                    WHERE target_table = ? AND version > ? AND version <= ?
+                    ORDER BY version
+                    """,
+                    (target_table, since, version)
+                )
+                deleted = [{**json.loads(entry[0]), "version": entry[1]} for entry in cursor.fetchall()]
+            return {"version": version, "data": data, "deleted": deleted}
+        except Exception as e:
+            self.logger.error(f"Failed to get changes to {target_table}: {e}")
+            raise
+
+    # === Search ===
+    @staticmethod
+    def _fts_query(query):
+        '''
+        Turns free text into an FTS5 query where every word has to prefix match
+        '''
+        words = [word.replace('"', '""') for word in query.split() if any(char.isalnum() for char in word)]
+        return " ".join(f'"{word}"*' for word in words)
+
+    def search(self, query, target_table="", limit=50, offset=0): #DEBUG LOGGED
+        '''
+        Full text searches artist and title, best matches first
+        '''
+        self.logger.debug(f"Searching {target_table} for {query!r}")
+        if target_table not in self.TABLES:
+            raise ValueError(f"Provide a valid target table you want to search ({self.TABLES})")
+        if not 0 < limit <= self.SEARCH_LIMIT or offset < 0:
+            raise ValueError(f"'limit' needs to be between 1 and {self.SEARCH_LIMIT} and 'offset' can't be negative")
+        match = self._fts_query(query)
+        if not match:
+            return []
+        try:
+            if target_table == "officials":
+                with self.get_cursor(read_only=True) as cursor:
+                    cursor.execute(
+                        '''
+                        SELECT officials.title, officials.artist, officials.wanted FROM officials_fts
+                        JOIN officials ON officials.id = officials_fts.rowid
+                        WHERE officials_fts MATCH ?
+                        ORDER BY officials_fts.rank
+                        LIMIT ? OFFSET ?
+                        ''',
+                        (match, limit, offset)
+                    )
+                    return [{"title":entry[0], "artist":entry[1], "wanted":entry[2]} for entry in cursor.fetchall()]
+            elif target_table == "customs":
+                with self.get_cursor(read_only=True) as cursor:
+                    cursor.execute(
+                        """
+                        SELECT customs.file_id, customs.artist, customs.title, customs.diff_drums, customs.diff_guitar, customs.diff_bass, customs.diff_vocals, customs.wanted, customs.downloaded FROM customs_fts
+                        JOIN customs ON customs.id = customs_fts.rowid
+                        WHERE customs_fts MATCH ?
+                        ORDER BY customs_fts.rank
+                        LIMIT ? OFFSET ?
+                        """,
+                        (match, limit, offset)
+                    )
+                    return [{"file_id": entry[0], "artist":entry[1], "title":entry[2], "diff_drums":entry[3], "diff_guitar":entry[4], "diff_bass":entry[5], "diff_vocals":entry[6], "wanted":entry[7], "downloaded":entry[8]} for entry in cursor.fetchall()]
+        except Exception as e:
+            self.logger.error(f"Failed to search {target_table}: {e}")
+            raise
+
 #RUN COMMANDS ON DATABASE HERE
 # db_m = DatabaseManager()
 # with db_m.get_cursor() as cursor:
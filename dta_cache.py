@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import marshal
+import os
+import threading
+import time
+
+from dta_processor import DTAProcessor
+
+
+class DTACache:
+    '''
+    Keeps where the songs of a songs.dta are and their extracted fields on disk, so a .dta that hasn't changed isn't indexed again.
+    Entries are keyed by a hash of the file's bytes, the parser version and the fields asked for, and evicted by age then by total size.
+    '''
+    DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), "dta_cache") #next to the scripts like RBManager's buffers, not wherever the process was started #TODO make configurable
+    MAX_BYTES = 64 * 1024 * 1024
+    MAX_AGE = 30 * 24 * 60 * 60 #seconds since an entry was last used
+    TEMP_MAX_AGE = 60 * 60 #seconds after which a temporary file is taken as left behind by a crash, younger ones may still be being written
+
+    def __init__(self, directory=DIRECTORY, max_bytes=MAX_BYTES, max_age=MAX_AGE):
+        self.logger = logging.getLogger("DTACache")
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def make_key(data: bytes, fields) -> str:
+        '''
+        Same bytes indexed by the same parser for the same fields always get the same key
+        '''
+        digest = hashlib.sha256(data)
+        digest.update(f"|{DTAProcessor.PARSER_VERSION}|{','.join(fields)}".encode())
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.bin")
+
+    def load(self, key):
+        '''
+        Gives the (spans, trailer) stored for 'key' like DTAProcessor.index_songs returns them, None if there is no usable entry
+        '''
+        path = self._path(key)
+        try:
+            with open(path, "rb") as cache_f:
+                version, packed, trailer = marshal.load(cache_f)
+            if version != DTAProcessor.PARSER_VERSION:
+                raise ValueError(f"entry is from parser version {version}")
+            spans = DTAProcessor.unpack_spans(packed)
+            os.utime(path) #last used time, what eviction goes by
+        except FileNotFoundError:
+            self._count("misses")
+            return None
+        except Exception as e:
+            self.logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            self._remove(path)
+            self._count("misses")
+            return None
+        self._count("hits")
+        return spans, tuple(trailer)
+
+    def store(self, key, spans, trailer):
+        '''
+        Saves what DTAProcessor.index_songs returned for 'key', written to a temporary file first so a crash never leaves half an entry
+        '''
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self._path(key)
+            temp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(temp_path, "wb") as cache_f:
+                marshal.dump((DTAProcessor.PARSER_VERSION, DTAProcessor.pack_spans(spans), tuple(trailer)), cache_f)
+            os.replace(temp_path, path)
+        except Exception as e:
+            self.logger.warning(f"Failed caching {key}: {e}")
+
+    def evict(self):
+        '''
+        Removes entries not used within max_age, then the least recently used ones until the cache fits in max_bytes.
+        Temporary files of entries being stored don't count, ones left behind by a crash are removed.
+        '''
+        try:
+            entries = []
+            with os.scandir(self.directory) as scan:
+                for entry in scan:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                    if entry.name.endswith(".bin"):
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    elif entry.name.endswith(".tmp") and stat.st_mtime < time.time() - self.TEMP_MAX_AGE:
+                        self._remove(entry.path)
+        except FileNotFoundError:
+            return
+        entries.sort() #least recently used first
+        oldest_allowed = time.time() - self.max_age
+        total = sum(size for _, size, _ in entries)
+        for used, size, path in entries:
+            if used >= oldest_allowed and total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+            self._count("evictions")
+        self.logger.debug(f"Cache holds {total} bytes after eviction")
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,112 @@
+'''
+Generated .dta corpora and round trip checks for DTAProcessor, run the checks over a few seeds with:
+python -m dta_corpus [--seeds N] [--songs N]
+'''
+import argparse
+import random
+
+from dta_processor import DTAProcessor
+
+_FIRST_WORDS = ["The", "Los", "Die", "Café", "Señor", "Björk", "Mötley", "Sigur", "Déjà", "Über", "Crüe", "Naïve", "Hüsker", "Ñu", "Blue", "Black", "Iron"]
+_WORDS = ["Sabbath", "Rós", "Vu", "Crüe", "Dü", "Élan", "Maiden", "Öyster", "Cult", "Garçon", "Fiancée", "Smörgåsbord", "Night", "Fire", "Road", "Heart", "Love", "Storm"]
+_GENRES = ["rock", "metal", "alternative", "punk", "poprock", "indierock", "numetal", "prog", "southernrock", "glam", "grunge", "emo", "fusion", "other"]
+_INSTRUMENTS = ["drum", "bass", "guitar", "vocals", "keys", "real_keys", "real_guitar"]
+_EDGE_SYMBOLS = ["'quoted symbol'", "'5'", "'-1.5'", "'TRUE'", "'false'", "''", "'with (parens)'", "weird;semicolon", "dots.in.symbol", "-", "trailing.", "1_0.5"]
+_BOOLEANS = ["TRUE", "FALSE", "true", "False"]
+
+def _title(rng):
+    return " ".join([rng.choice(_FIRST_WORDS)] + rng.sample(_WORDS, rng.randint(1, 3)))
+
+def _float(rng):
+    return rng.choice([f"{rng.uniform(-12, 12):.{rng.randint(1, 3)}f}", "-1.0", "0.0", "-0.5", ".5", "-.25", "1.", "1.5e3", "-2.0e-3"])
+
+def make_song(rng, i):
+    '''
+    .dta text of one song like customs packs have them, with nested tracks, comments, both kinds of quotes, latin-1 names and parser edge cases
+    '''
+    track_lines, count = [], 0
+    for name in rng.sample(_INSTRUMENTS, rng.randint(1, len(_INSTRUMENTS))):
+        width = rng.randint(1, 3)
+        track_lines.append(f"({name} ({' '.join(str(channel) for channel in range(count, count + width))}))")
+        count += width
+    vols = " ".join(_float(rng) for _ in range(count))
+    pans = " ".join(rng.choice(["-1.0", "1.0", "0.0", "-0.5"]) for _ in range(count))
+    cores = " ".join(rng.choice(["-1", "1"]) for _ in range(count))
+    ranks = " ".join(f"({name} {rng.randint(0, 500)})" for name in rng.sample(_INSTRUMENTS + ["band"], 4))
+    comment = rng.choice(["", f";{_title(rng)} by a custom author\n", ";;(old_field 'removed')\n", "; ( unbalanced comment\n"])
+    shortname = f"'song{i}'" if rng.random() < 0.2 else f"song{i}"
+    bank = rng.choice(["tambourine", "cowbell", "handclap"])
+    return f"""{comment}({shortname}
+   (name "{_title(rng)}")
+   (artist "{_title(rng)}")
+   (master {rng.choice(_BOOLEANS)})
+   (song
+      (name "songs/song{i}/song{i}")
+      (tracks ({" ".join(track_lines)}))
+      ;(crowd_channels {count} {count + 1})
+      (vols ({vols}))
+      (pans ({pans}))
+      (cores ({cores}))
+      (vocal_parts {rng.randint(0, 3)})
+      (hopo_threshold {rng.choice([90, 170, 250])})
+   )
+   (song_scroll_speed {rng.choice([2300, 2500, -1])})
+   (bank sfx/{bank}_bank.milo)
+   (rank {ranks})
+   (genre '{rng.choice(_GENRES)}')
+   (sub_genre subgenre_{rng.choice(_GENRES)})
+   (year_released {rng.randint(1950, 2025)})
+   (preview {rng.randint(0, 60000)} {rng.randint(60000, 120000)})
+   (tuning_offset_cents {_float(rng)})
+   (edge_cases {" ".join(rng.sample(_EDGE_SYMBOLS, 3))} {rng.randint(-100, 100)} {_float(rng)})
+)
+"""
+
+def make_corpus(songs=1000, seed=0):
+    '''
+    A songs.dta of 'songs' generated songs, the same seed always gives the same text.
+    The text only uses latin-1 characters, like .dtas without an (encoding utf8) song.
+    '''
+    rng = random.Random(seed)
+    return "".join(make_song(rng, i) for i in range(songs))
+
+def check_round_trip(dta: str):
+    '''
+    Parses 'dta', writes it back and parses that again, raises ValueError at the first top level item that didn't come back the same.
+    Items are compared by repr so TRUE can't pass for 1, nor 1.0 for 1.
+    '''
+    parsed = DTAProcessor.dta_to_nested_list(dta)
+    written = "\n".join(DTAProcessor.nested_list_to_dta(item) for item in parsed)
+    reparsed = DTAProcessor.dta_to_nested_list(written)
+    for i, (before, after) in enumerate(zip(parsed, reparsed)):
+        if repr(before) != repr(after):
+            raise ValueError(f"Item {i} changed writing it back: {before!r} became {after!r}")
+    if len(parsed) != len(reparsed):
+        raise ValueError(f"{len(parsed)} items became {len(reparsed)} writing them back")
+    if "\n".join(DTAProcessor.nested_list_to_dta(item) for item in reparsed) != written:
+        raise ValueError("Writing the reparsed items gave different text")
+    return True
+
+def check_edge_symbols():
+    '''
+    Each of _EDGE_SYMBOLS has to parse to a symbol, not a number or a boolean, and round trip on its own and next to the others.
+    Raises ValueError at the first one that doesn't.
+    '''
+    for symbol in _EDGE_SYMBOLS:
+        dta = f"(edge_cases {symbol})\n"
+        parsed = DTAProcessor.dta_to_nested_list(dta)[0][1]
+        if not isinstance(parsed, str):
+            raise ValueError(f"{symbol} parsed to {parsed!r} instead of a symbol")
+        check_round_trip(dta)
+    check_round_trip(f"(edge_cases {' '.join(_EDGE_SYMBOLS)})\n")
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Round trip checks of DTAProcessor over generated .dtas")
+    parser.add_argument("--seeds", type=int, default=20, help="corpora to check, seeds 0 to N-1")
+    parser.add_argument("--songs", type=int, default=200, help="songs in each corpus")
+    args = parser.parse_args()
+    assert check_edge_symbols()
+    for seed in range(args.seeds):
+        assert check_round_trip(make_corpus(args.songs, seed))
+    print(f"{len(_EDGE_SYMBOLS)} edge case symbols and {args.seeds} corpora of {args.songs} songs round trip")
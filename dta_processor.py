@@ -1,42 +1,126 @@
-from re import findall
+import mmap
+import os
+import re
+import struct
+from functools import lru_cache, reduce
+from itertools import islice
+
+_TOKEN_PATTERN = re.compile(r'\'[^\']*\'|\"[^\"]*\"|\(|\)|;[^\n]*|[^\s()]+') #compiled once instead of on every tokenize
+_SPAN_PATTERN = re.compile(rb'''(\()|(\))|'[^']*'|"[^"]*"|;[^\n]*|['"][^\s()]*|(?:\s+|[^\s()'";][^\s()]*)+''') #same tokens as _TOKEN_PATTERN but atoms and whitespace between parentheses are skipped in one match
+_FIELD_KEY_PATTERN = re.compile(rb"""\(\s*'?([^\s()'";]+)""")
+_PLAIN_PATTERN = re.compile(rb"""[^()'";]*+""") #anything but parentheses and what could start a string or comment
+_BALANCED_PATTERN = re.compile(reduce(lambda inner, _: rb"""(?:[^()'";]++|\(""" + inner + rb"""\))*+""", range(8), rb"""[^()'";]*+""")) #plain text and lists nested up to 8 deep that close before any string or comment
+_ATOM_PATTERN = re.compile(rb"[^\s()]*")
+_BARE_SYMBOL_PATTERN = re.compile(r"""[^\s()'";][^\s()]*""") #symbol that is read back as one token without quotes
+_TOKEN_BOUNDARIES = frozenset(b" \t\n\r\x0b\x0c()")
+_OPEN, _CLOSE, _COMMENT = b"();"
+_ENCODING_PATTERN = re.compile(rb"\(\s*'?encoding'?\s+'?utf-?8'?\s*\)", re.IGNORECASE)
+_MISSING = object()
+_ABSENT = None #stands in for a field a song doesn't have in packed spans, a parsed DTA value is never None
+
+#node types of compiled .dtb files
+DTB_INT, DTB_FLOAT, DTB_VARIABLE, DTB_FUNC, DTB_OBJECT, DTB_SYMBOL, DTB_EMPTY = 0x00, 0x01, 0x02, 0x03, 0x04, 0x05, 0x06
+DTB_IFDEF, DTB_ELSE, DTB_ENDIF = 0x07, 0x08, 0x09
+DTB_ARRAY, DTB_COMMAND, DTB_STRING, DTB_PROPERTY, DTB_GLOB = 0x10, 0x11, 0x12, 0x13, 0x14
+DTB_DEFINE, DTB_INCLUDE, DTB_MERGE, DTB_IFNDEF, DTB_AUTORUN, DTB_UNDEF = 0x20, 0x21, 0x22, 0x23, 0x24, 0x25
+_DTB_ARRAYS = {DTB_ARRAY, DTB_COMMAND, DTB_PROPERTY}
+_DTB_TEXT_TOKENS = {DTB_FUNC: "", DTB_OBJECT: "", DTB_GLOB: "", DTB_IFDEF: "#ifdef ", DTB_DEFINE: "#define ", DTB_INCLUDE: "#include ", DTB_MERGE: "#merge ", DTB_IFNDEF: "#ifndef ", DTB_UNDEF: "#undef "} #nodes holding a name, and what their text form starts with
+_DTB_VALUE_TOKENS = {DTB_EMPTY: "", DTB_ELSE: "#else", DTB_ENDIF: "#endif", DTB_AUTORUN: "#autorun"} #nodes holding a 32 bit value nobody uses, kept to write it back
+_DTB_AMBIGUOUS = ('"', "$")
+_DTB_HEADER = struct.Struct("<HIH") #array item count, line it was on, id
+_DTB_U32 = struct.Struct("<I")
+_DTB_I32 = struct.Struct("<i")
+_DTB_NODE = struct.Struct("<Ii") #node type and the 32 bit value or length after it
+_DTB_F32 = struct.Struct("<f")
+
+@lru_cache(maxsize=4096)
+def _format_symbol(symbol):
+    if _BARE_SYMBOL_PATTERN.fullmatch(symbol) and DTAProcessor.parse_atom(symbol) is symbol:
+        return symbol
+    return f"'{symbol}'" if "'" not in symbol else symbol #a symbol with a ' in it can't be quoted in DTA, best left as it is
+
+class DTBArray(list):
+    '''
+    List decoded from a .dtb, remembers what kind of array it was and its line and id so it is encoded back to the same bytes
+    '''
+    __slots__ = ("kind", "line", "id")
+
+    def __init__(self, items=(), kind=DTB_ARRAY, line=0, id=0):
+        super().__init__(items)
+        self.kind = kind
+        self.line = line
+        self.id = id
+
+class DTBToken(str):
+    '''
+    .dtb node with no plain value, like a directive, its text is what it would be in a .dta and 'payload' what the .dtb stores
+    '''
+    __slots__ = ("kind", "payload")
+
+    def __new__(cls, text, kind, payload):
+        token = super().__new__(cls, text)
+        token.kind = kind
+        token.payload = payload
+        return token
 
 class DTAProcessor:
     '''Processes DTAs and turns them into native Python data collections, and vice versa'''
-    #TODO: Currently nested list. Convert nested list to dictionary. On write back convert from dict to nested then nested to .dta
+    DEFAULT_ENCODING = "latin-1" #what PS3 .dtas are in unless a song says otherwise
+    BLOCK_SIZE = 64 * 1024 #bytes iter_dta reads at a time
+    PARSER_VERSION = 4 #bump whenever index_songs or the parsing it relies on changes what it returns, cached indexes of older versions are ignored
 
     @staticmethod
     def tokenize(dta: str):
-        return findall(r'\'[^\']*\'|\"[^\"]*\"|\(|\)|;[^\n]*|[^\s()]+', dta)
+        return _TOKEN_PATTERN.findall(dta)
 
     @staticmethod
     def parse_tokens(tokens, i=0):
-        parsed = []
-        while i < len(tokens):
-            token = tokens[i]
-
+        '''
+        Builds the nested list from tokens[i:] with an explicit stack, so deep nesting can't hit the recursion limit.
+        Returns the index it stopped at, an unmatched ')' ends the parse and unclosed lists are closed at the end.
+        '''
+        parsed = current = []
+        stack = []
+        atoms = {} #token to parsed atom, songs repeat the same keys and numbers over and over
+        append = current.append
+        for i, token in enumerate(islice(tokens, i, None), i):
             if token == '(':
-                i, subtree = DTAProcessor.parse_tokens(tokens, i + 1)
-                parsed.append(subtree)
+                subtree = []
+                append(subtree)
+                stack.append(current)
+                current = subtree
+                append = current.append
             elif token == ')':
-                return i, parsed
-            elif token.startswith(';'):
-                pass
+                if not stack:
+                    return i, parsed
+                current = stack.pop()
+                append = current.append
             else:
-                parsed_atom = DTAProcessor.parse_atom(token)
-                parsed.append(parsed_atom)
-            i += 1
-        return i, parsed
+                atom = atoms.get(token, _MISSING)
+                if atom is _MISSING:
+                    first = token[0]
+                    if first == '"': #double quoted strings are kept as written
+                        append(token)
+                        continue
+                    if first == ';': #comment
+                        continue
+                    if first == "'" and len(token) > 1 and token[-1] == "'": #single quoted strings are never repeated enough to be worth remembering
+                        append(token[1:-1])
+                        continue
+                    atom = atoms[token] = DTAProcessor.parse_atom(token)
+                append(atom)
+        return len(tokens), parsed
 
     @staticmethod
     def parse_atom(token):
-        if token.startswith("\'") and token.endswith("\'"):
+        if len(token) > 1 and token.startswith("\'") and token.endswith("\'"):
             return token[1:-1]
         if token.upper() == 'TRUE':
             return True
         if token.upper() == 'FALSE':
             return False
         try:
-            if '.' in token:
+            if '.' in token and '_' not in token: #float() would also take 1_0.5
                 return float(token)
             elif token.isdecimal() or (token[0] == '-' and token[1:].isdecimal()):
                 return int(token)
@@ -45,6 +129,19 @@ class DTAProcessor:
         except ValueError:
             return token
 
+    @staticmethod
+    def format_atom(atom):
+        '''
+        Text that parse_atom reads back as 'atom'. Symbols that would otherwise be split, dropped or read as a number or boolean are single quoted,
+        floats always get a '.' so they aren't read back as symbols.
+        '''
+        if atom.__class__ is str:
+            return atom if len(atom) > 1 and atom[0] == '"' and atom[-1] == '"' else _format_symbol(atom)
+        if atom.__class__ is float:
+            text = repr(atom)
+            return text if "." in text or "e" not in text else text.replace("e", ".0e", 1)
+        return str(atom)
+
     @staticmethod
     def dta_to_nested_list(dta):
         tokens = DTAProcessor.tokenize(dta)
@@ -52,65 +149,400 @@ class DTAProcessor:
         return parsed
 
     @staticmethod
-    def nested_list_to_dta(nested,level=1,indent="   "):
-        s = ""
-        if isinstance(nested, list):
-            s = "("
-            if any(isinstance(each,list) for each in nested):
-                for i,each in enumerate(nested):
-                    s += "\n"+(indent*level) + (DTAProcessor.nested_list_to_dta(each,level+1) + " " if i != len(nested)-1 else DTAProcessor.nested_list_to_dta(each,level+1))
-                s += "\n"+(indent*(level-1))+")"
+    def index_songs(data: bytes, fields=("name", "artist")):
+        '''
+        Finds where each top level song starts and ends in the raw .dta bytes without building it, only the 'fields' asked for are decoded and parsed.
+        'data' can be anything bytes-like that regexes work on, like an mmap of the file.
+        Returns a list of (start, end, {field: value}) where each span starts right after the previous song so the comments above a song stay with it,
+        and the (start, end) of whatever follows the last song.
+        '''
+        spans, trailer, _, _ = DTAProcessor.index_range(data, fields)
+        return spans, trailer
+
+    @staticmethod
+    def index_range(data: bytes, fields=("name", "artist"), start=0, end=None, final=True):
+        '''
+        index_songs over data[start:end] only, offsets stay relative to the whole of 'data'.
+        Also returns how deep in an unclosed song the range ended and if an unmatched ')' stopped it, a range that was cut between songs ends with (0, False).
+        After an unmatched ')' the trailer runs to the end of the range, so nothing after it is lost writing the spans back.
+        When more of the file follows the range ('final' is False) it stops before anything that could still change, the song it is in and a quote not yet closed,
+        a quote still open at the end of the range is left out of the trailer so it ends before 'end'.
+        '''
+        wanted = {field.encode() for field in fields}
+        spans = []
+        depth = 0
+        previous_end = song_start = start
+        length = len(data) if end is None else end
+        pos = special_end = start
+        while True:
+            #inside a song, balanced lists without strings or comments are skipped by the regex engine, only the rest is looked at here
+            pos = (_BALANCED_PATTERN if depth else _PLAIN_PATTERN).match(data, pos, length).end()
+            if pos >= length:
+                break
+            char = data[pos]
+            if char == _OPEN:
+                if depth == 0:
+                    song_start = pos
+                depth += 1
+                pos += 1
+            elif char == _CLOSE:
+                if depth == 0: #unmatched ')' ends the parse like it does in parse_tokens
+                    return spans, (previous_end, length), depth, True
+                depth -= 1
+                pos += 1
+                if depth == 0:
+                    spans.append((previous_end, pos, DTAProcessor._read_fields(data, song_start, pos, wanted)))
+                    previous_end = pos
             else:
-                for i,each in enumerate(nested):
-                    s += (DTAProcessor.nested_list_to_dta(each, level) + " ") if i != len(nested)-1 else DTAProcessor.nested_list_to_dta(each,level)
-                s += ")"
-        else:
-            s = str(nested)
-        return s
-
-    @staticmethod
-    def __nested_list_to_dict__(nest:list):
-        if len(nest) == 2:
-            if all(isinstance(item, str) for item in nest) or (isinstance(nest[0],str) and (isinstance(nest[1], int) or isinstance(nest[1], float))):
-                k= nest[0]
-                v = nest[1]
-                return {k:v}
-            elif all(isinstance(item, str) for item in nest) or all(isinstance(item, int) for item in nest) or all(isinstance(item, float) for item in nest):
-                return nest
-            
-            elif isinstance(nest[0], str) and isinstance(nest[1], list):
-                k = nest[0]
-                v = nest_to_dict(nest[1])
-                return {k:v}
-            
-            elif isinstance(nest[0], str) and all(isinstance(item, list) for item in nest[1]):
-                k = nest[0]
-                v = [nest_to_dict(item) for item in nest[1:]]
-                return {k:v}
-        else:
-            if isinstance(nest[0], str) and all(isinstance(item,list) for item in nest[1:]):
-                k = nest[0]
-                v = [nest_to_dict(item) for item in nest[1:]]
-                return {k:v}
-            elif all(isinstance(item, list) for item in nest):
-                return [nest_to_dict(item) for item in nest]
-            elif all(isinstance(item, str) for item in nest) or all(isinstance(item, int) for item in nest) or all(isinstance(item, float) for item in nest):
-                return nest
+                #strings and comments only start a token, a quote or ';' inside an atom is part of it
+                if pos != special_end and data[pos - 1] not in _TOKEN_BOUNDARIES:
+                    pos = _ATOM_PATTERN.match(data, pos, length).end()
+                elif char == _COMMENT:
+                    pos = data.find(b"\n", pos, length)
+                    pos = length if pos == -1 else pos
+                else:
+                    closing = data.find(data[pos:pos + 1], pos + 1, length)
+                    if closing == -1 and not final: #its closing quote may be in what follows
+                        return spans, (previous_end, pos), depth, False
+                    pos = closing + 1 if closing != -1 else _ATOM_PATTERN.match(data, pos, length).end()
+                special_end = pos
+        if depth > 0 and final: #unclosed song runs to the end of the file
+            spans.append((previous_end, length, DTAProcessor._read_fields(data, song_start, length, wanted)))
+            previous_end = length
+        return spans, (previous_end, length), depth, False
+
+    @staticmethod
+    def iter_dta(source, fields=("name", "artist"), block_size=BLOCK_SIZE):
+        '''
+        Yields (span, {field: value}) for each top level song as soon as it is read, from a path, a binary file or a bytes-like buffer like an mmap.
+        What follows the last song comes last with None for its fields, so writing every span out again gives back the source byte for byte.
+        Files are read a block at a time and only the song being read is kept, spans of a buffer are memoryviews of it.
+        '''
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as dta_f:
+                yield from DTAProcessor.iter_dta(dta_f, fields, block_size)
+            return
+        read = getattr(source, "read", None)
+        data = b"" if read else source
+        start = 0
+        end = 0 if read else min(len(data), block_size)
+        while True:
+            if read:
+                block = read(block_size)
+                data = data[start:] + block #only the unfinished song is carried over
+                start, end = 0, len(data)
+                final = not block
             else:
-                return nest
-
-    @staticmethod
-    def __dict_to_nested_list__(dta_dict):
-        if isinstance(dta_dict, list) and all(isinstance(item,dict) for item in dta_dict):
-            lod = [dict_to_nested(item) for item in dta_dict]
-            return [dict_to_nested(item) for item in dta_dict]
-        elif isinstance(dta_dict, dict):
-            if len(dta_dict.items()) == 1:
-                dict_list = list(list(dta_dict.items())[0])
-                if isinstance(dict_list[1], list):
-                    keyed_nest = [dict_list[0]] + [[dict_to_nested(item) for item in dict_list[1]]]
-                    return keyed_nest
+                final = end == len(data)
+            spans, (trailer_start, trailer_end), _, stopped = DTAProcessor.index_range(data, fields, start, end, final)
+            for span_start, span_end, values in spans:
+                yield (data[span_start:span_end] if read else memoryview(data)[span_start:span_end]), values
+            if stopped: #nothing after an unmatched ')' is parsed, the rest of the source is the trailer
+                yield (data[trailer_start:] + read() if read else memoryview(data)[trailer_start:]), None
+                return
+            if final:
+                yield (data[trailer_start:trailer_end] if read else memoryview(data)[trailer_start:trailer_end]), None
+                return
+            start = trailer_start
+            if not read:
+                end = min(len(data), end + block_size)
+
+    @staticmethod
+    def split_at_songs(data: bytes, parts: int):
+        '''
+        Cuts 'data' into about 'parts' (start, end) ranges at lines starting with '(', where a new song usually begins.
+        Nothing is parsed, so a cut can still land inside a song, index_file checks every range before trusting it.
+        '''
+        length = len(data)
+        target = max(1, length // max(1, parts))
+        bounds = [0]
+        while bounds[-1] + target < length:
+            cut = data.find(b"\n(", bounds[-1] + target)
+            if cut == -1:
+                break
+            bounds.append(cut + 1)
+        bounds.append(length)
+        return list(zip(bounds, bounds[1:]))
+
+    @staticmethod
+    def index_file(path: str, data: bytes, fields=("name", "artist"), executor=None, parts=1):
+        '''
+        index_songs over the file at 'path' whose bytes are 'data', split into 'parts' ranges that a process pool 'executor' indexes in parallel.
+        Without an executor it is indexed right here, and it is indexed here in one go when a range didn't start and end between songs.
+        Every range but the last is indexed knowing more follows, so one ending inside a song, inside a quote or at an unmatched ')' shows the cut was wrong.
+        '''
+        if executor is None:
+            return DTAProcessor.index_songs(data, fields)
+        ranges = DTAProcessor.split_at_songs(data, parts)
+        futures = [executor.submit(index_file_range, path, tuple(fields), start, end, i == len(ranges) - 1) for i, (start, end) in enumerate(ranges)]
+        results = [future.result() for future in futures]
+
+        spans = []
+        trailer_start = 0
+        for i, (packed, trailer, depth, stopped) in enumerate(results):
+            last = i == len(results) - 1
+            if not last and (depth or stopped or trailer[1] != ranges[i][1]):
+                return DTAProcessor.index_songs(data, fields)
+            range_spans = DTAProcessor.unpack_spans(packed)
+            if range_spans:
+                _, end, values = range_spans[0]
+                range_spans[0] = (trailer_start, end, values) #comments after the last song of the previous range belong to this one
+                spans.extend(range_spans)
+                trailer_start = trailer[0]
+            if stopped:
+                return spans, (trailer_start, trailer[1])
+        return spans, (trailer_start, len(data))
+
+    @staticmethod
+    def pack_spans(spans):
+        '''
+        index_songs spans as flat lists, one for the starts, one for the ends and one per field, far cheaper to marshal or pickle than a dict per song
+        '''
+        fields = sorted({field for _, _, values in spans for field in values})
+        columns = [[values.get(field, _ABSENT) for _, _, values in spans] for field in fields]
+        return [start for start, _, _ in spans], [end for _, end, _ in spans], fields, columns
+
+    @staticmethod
+    def unpack_spans(packed):
+        '''
+        Undoes pack_spans
+        '''
+        starts, ends, fields, columns = packed
+        return [
+            (start, end, {field: value for field, value in zip(fields, values) if value is not _ABSENT})
+            for start, end, values in zip(starts, ends, zip(*columns) if columns else [()] * len(starts))
+        ]
+
+    @staticmethod
+    def song_encoding(data: bytes, start=0, end=None):
+        '''
+        Encoding of the song in data[start:end], songs say (encoding utf8) when they are UTF-8 and are latin-1 otherwise
+        '''
+        if _ENCODING_PATTERN.search(data, start, len(data) if end is None else end):
+            return "utf-8"
+        return DTAProcessor.DEFAULT_ENCODING
+
+    @staticmethod
+    def _read_fields(data: bytes, start, end, wanted):
+        '''
+        Parses only the top level fields of the song in data[start:end] whose key is in 'wanted', stops once all of them are found
+        '''
+        values = {}
+        if not wanted:
+            return values
+        encoding = DTAProcessor.song_encoding(data, start, end)
+        depth = 0
+        field_start = start
+        for match in _SPAN_PATTERN.finditer(data, start, end):
+            kind = match.lastindex
+            if kind == 1:
+                if depth == 1:
+                    field_start = match.start()
+                depth += 1
+            elif kind == 2:
+                depth -= 1
+                if depth == 1:
+                    DTAProcessor._read_field(data, field_start, match.end(), wanted, values, encoding)
+                    if len(values) == len(wanted):
+                        return values
+        if depth > 1: #field left open at the end of the file
+            DTAProcessor._read_field(data, field_start, end, wanted, values, encoding)
+        return values
+
+    @staticmethod
+    def _read_field(data: bytes, start, end, wanted, values, encoding):
+        key = _FIELD_KEY_PATTERN.match(data, start)
+        if key is None or key.group(1) in wanted: #a key that isn't a plain atom right after the '(' is parsed to be sure
+            field = DTAProcessor.dta_to_nested_list(data[start:end].decode(encoding, errors="replace"))[0]
+            if len(field) > 1 and isinstance(field[0], str) and field[0].encode() in wanted:
+                values.setdefault(field[0], field[1])
+
+    @staticmethod
+    def write_dta(nested, write, level=1, indent="   "):
+        '''
+        Writes 'nested' as .dta text piece by piece through 'write', like a file's write or a list's append.
+        Lists holding other lists get one item per line, flat lists are written on one line, walked with an explicit stack.
+        '''
+        format_atom = DTAProcessor.format_atom
+        def flat(items):
+            return "(" + " ".join([str(atom) if atom.__class__ is int else format_atom(atom) for atom in items]) + ")" #ints are most atoms and never need more than str
+        if not isinstance(nested, list):
+            write(format_atom(nested))
+            return
+        if not any(isinstance(each, list) for each in nested):
+            write(flat(nested))
+            return
+        write("(")
+        stack = [[nested, 0, level]] #list being written, index of its next item, its level
+        while stack:
+            frame = stack[-1]
+            items, i, level = frame
+            if i == len(items):
+                stack.pop()
+                write("\n" + indent * (level - 1) + ")")
+                continue
+            frame[1] = i + 1
+            separator = ("\n" if i == 0 else " \n") + indent * level
+            each = items[i]
+            if not isinstance(each, list):
+                write(separator + format_atom(each))
+            elif any(isinstance(item, list) for item in each):
+                write(separator + "(")
+                stack.append([each, 0, level + 1])
+            else:
+                write(separator + flat(each))
+
+    @staticmethod
+    def nested_list_to_dta(nested,level=1,indent="   "):
+        buffer = []
+        DTAProcessor.write_dta(nested, buffer.append, level, indent)
+        return "".join(buffer)
+
+    @staticmethod
+    def dtb_to_nested_list(data: bytes, encoding=DEFAULT_ENCODING):
+        '''
+        Decodes a compiled .dtb into the nested list dta_to_nested_list gives for its text, with DTBArray lists and symbols kept as they were written.
+        Strings keep their double quotes like in the text parse, floats get the shortest text that is the same 32 bit float.
+        '''
+        if not data or data[0] != 1:
+            raise ValueError("Not an unencrypted .dtb")
+        count, line, id = _DTB_HEADER.unpack_from(data, 1)
+        pos = 9
+        root = DTBArray(kind=DTB_ARRAY, line=line, id=id)
+        stack = [(root, count)] #arrays still being filled and how many items they still need
+        names = {} #raw bytes to decoded text, songs use the same few symbols over and over
+        floats = {}
+        unpack_node, unpack_header = _DTB_NODE.unpack_from, _DTB_HEADER.unpack_from
+        new_array = list.__new__ #skips DTBArray.__init__, its attributes are set right after
+        while stack:
+            array, remaining = stack.pop()
+            append = array.append
+            while remaining:
+                remaining -= 1
+                kind, value = unpack_node(data, pos) #every node is a type and at least 4 more bytes, most are a type and one 32 bit value
+                pos += 8
+                if kind == DTB_INT:
+                    append(value)
+                elif kind == DTB_SYMBOL or kind == DTB_STRING or kind == DTB_VARIABLE or kind in _DTB_TEXT_TOKENS:
+                    raw = data[pos:pos + value]
+                    pos += value
+                    text = names.get(raw)
+                    if text is None:
+                        text = names[raw] = raw.decode(encoding, errors="surrogateescape") #surrogateescape so any bytes survive encoding back
+                    if kind == DTB_SYMBOL:
+                        append(text if text[:1] not in _DTB_AMBIGUOUS else DTBToken(text, kind, text)) #would be read back as a string or variable otherwise
+                    elif kind == DTB_STRING:
+                        append(f'"{text}"')
+                    elif kind == DTB_VARIABLE:
+                        append(DTBToken("$" + text, kind, text))
+                    else:
+                        append(DTBToken(_DTB_TEXT_TOKENS[kind] + text, kind, text))
+                elif kind in _DTB_ARRAYS:
+                    child = new_array(DTBArray)
+                    count, child.line, child.id = unpack_header(data, pos - 4)
+                    child.kind = kind
+                    pos += 4
+                    append(child)
+                    stack.append((array, remaining))
+                    stack.append((child, count))
+                    break
+                elif kind == DTB_FLOAT:
+                    number = floats.get(value)
+                    if number is None:
+                        number = floats[value] = DTAProcessor._shortest_float(data[pos - 4:pos])
+                    append(number)
+                elif kind in _DTB_VALUE_TOKENS:
+                    append(DTBToken(_DTB_VALUE_TOKENS[kind], kind, value & 0xFFFFFFFF))
                 else:
-                    return dict_list
-        else:
-            return dta_dict
\ No newline at end of file
+                    raise ValueError(f"Unknown .dtb node type {kind:#x} at byte {pos - 8}")
+        return root
+
+    @staticmethod
+    def _shortest_float(raw: bytes) -> float:
+        value, = _DTB_F32.unpack(raw)
+        for precision in range(1, 10):
+            candidate = float(f"{value:.{precision}g}")
+            if _DTB_F32.pack(candidate) == raw:
+                return candidate
+        return value
+
+    @staticmethod
+    def nested_list_to_dtb(nested: list, encoding=DEFAULT_ENCODING) -> bytes:
+        '''
+        Encodes a nested list into a .dtb, the undo of dtb_to_nested_list and also usable on what dta_to_nested_list gives.
+        Symbols are plain str, "quoted" str are strings and $str are variables, True and False are 1 and 0 like the TRUE and FALSE macros.
+        '''
+        out = bytearray(b"\x01")
+        out += _DTB_HEADER.pack(len(nested), getattr(nested, "line", 0), getattr(nested, "id", 0))
+        stack = [iter(nested)]
+        pack_u32, pack_i32 = _DTB_U32.pack, _DTB_I32.pack
+        while stack:
+            item = next(stack[-1], _MISSING)
+            if item is _MISSING:
+                stack.pop()
+            elif isinstance(item, list):
+                out += pack_u32(getattr(item, "kind", DTB_ARRAY))
+                out += _DTB_HEADER.pack(len(item), getattr(item, "line", 0), getattr(item, "id", 0))
+                stack.append(iter(item))
+            elif isinstance(item, DTBToken):
+                out += pack_u32(item.kind)
+                if isinstance(item.payload, str):
+                    raw = item.payload.encode(encoding, errors="surrogateescape")
+                    out += pack_u32(len(raw)) + raw
+                else:
+                    out += pack_u32(item.payload)
+            elif isinstance(item, bool) or isinstance(item, int):
+                out += pack_u32(DTB_INT) + pack_i32(int(item))
+            elif isinstance(item, float):
+                out += pack_u32(DTB_FLOAT) + _DTB_F32.pack(item)
+            else:
+                text = str(item)
+                if len(text) > 1 and text[0] == '"' and text[-1] == '"':
+                    kind, text = DTB_STRING, text[1:-1]
+                elif text.startswith("$"):
+                    kind, text = DTB_VARIABLE, text[1:]
+                else:
+                    kind = DTB_SYMBOL
+                raw = text.encode(encoding, errors="surrogateescape")
+                out += pack_u32(kind) + pack_u32(len(raw)) + raw
+        return bytes(out)
+
+    @staticmethod
+    def nested_list_to_dict(nest):
+        '''
+        Turns every list that starts with a key into {key: value}, (key x) gives {key: x} and (key x y) or (key) give {key: [x, y]} or {key: []}.
+        A single value that is itself a plain list is wrapped, (key (x y)) gives {key: [[x, y]]}, so dict_to_nested_list can always undo it.
+        '''
+        if not isinstance(nest, list):
+            return nest
+        if not nest or not isinstance(nest[0], str):
+            return [DTAProcessor.nested_list_to_dict(item) for item in nest]
+        key, values = nest[0], nest[1:]
+        if len(values) == 1:
+            value = DTAProcessor.nested_list_to_dict(values[0])
+            return {key: [value] if isinstance(value, list) else value}
+        return {key: [DTAProcessor.nested_list_to_dict(item) for item in values]}
+
+    @staticmethod
+    def dict_to_nested_list(dta_dict):
+        '''
+        Undoes nested_list_to_dict
+        '''
+        if isinstance(dta_dict, dict):
+            (key, value), = dta_dict.items()
+            if isinstance(value, list):
+                return [key] + [DTAProcessor.dict_to_nested_list(item) for item in value]
+            return [key, DTAProcessor.dict_to_nested_list(value)]
+        if isinstance(dta_dict, list):
+            return [DTAProcessor.dict_to_nested_list(item) for item in dta_dict]
+        return dta_dict
+
+def index_file_range(path, fields, start, end, final=True):
+    '''
+    Process pool worker for DTAProcessor.index_file, maps the file itself so only offsets and the packed result cross processes
+    '''
+    with open(path, "rb") as dta_f:
+        data = mmap.mmap(dta_f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        spans, trailer, depth, stopped = DTAProcessor.index_range(data, fields, start, end, final)
+    return DTAProcessor.pack_spans(spans), trailer, depth, stopped
@@ -0,0 +1,137 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from ftplib import FTP, all_errors, error_perm
+
+
+class FTPSessionPool:
+    '''
+    Keeps logged in FTP sessions to one host open and hands them out again, so every operation doesn't pay for a new connection and login.
+    Sessions idle for a while are checked with NOOP before being handed out, dead ones are replaced with a new login.
+    '''
+    MAX_SESSIONS = 4 #webMAN and multiMAN only take a few connections at once
+    CHECK_AFTER = 5 #seconds a session can sit idle before it is checked with NOOP
+
+    def __init__(self, host, port=21, max_sessions=MAX_SESSIONS, check_after=CHECK_AFTER, timeout=60, encoding="latin-1"):
+        self.logger = logging.getLogger("FTPSessionPool")
+        self.host = host
+        self.port = port
+        self.max_sessions = max_sessions
+        self.check_after = check_after
+        self.timeout = timeout
+        self.encoding = encoding
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_sessions)
+        self._idle = [] #(session, time it was returned), most recently returned last
+        self._closed = False
+        self._stats = {"logins": 0, "reuses": 0, "dead": 0, "discarded": 0}
+
+    def _login(self):
+        ftp = FTP(encoding=self.encoding, timeout=self.timeout)
+        try:
+            ftp.connect(self.host, self.port)
+            ftp.login()
+        except all_errors:
+            self._close(ftp)
+            raise
+        self._count("logins")
+        self.logger.debug(f"Logged in to {self.host}")
+        return ftp
+
+    def _alive(self, ftp):
+        try:
+            ftp.voidcmd("NOOP")
+            return True
+        except all_errors as e:
+            self.logger.debug(f"Idle session to {self.host} is dead: {e}")
+            self._count("dead")
+            self._close(ftp)
+            return False
+
+    def acquire(self):
+        '''
+        Gives an idle session that still answers, or logs in a new one, blocks while max_sessions are handed out
+        '''
+        self._slots.acquire()
+        try:
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    ftp, returned = self._idle.pop()
+                if time.monotonic() - returned < self.check_after or self._alive(ftp):
+                    self._count("reuses")
+                    return ftp
+            return self._login()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, ftp, broken=False):
+        '''
+        Takes a session back, 'broken' ones that failed mid command are closed instead of handed out again
+        '''
+        try:
+            if broken:
+                self._count("discarded")
+                self._close(ftp)
+                return
+            with self._lock:
+                if not self._closed:
+                    self._idle.append((ftp, time.monotonic()))
+                    return
+            self._close(ftp)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def session(self):
+        '''
+        Session for the duration of a with block, it goes back to the pool afterwards unless something other than a refused command escaped the block
+        '''
+        ftp = self.acquire()
+        try:
+            yield ftp
+        except error_perm:
+            self.release(ftp) #the server refused a command and said so, the session is fine
+            raise
+        except BaseException:
+            self.release(ftp, broken=True) #could have been left mid transfer with a reply still unread
+            raise
+        self.release(ftp)
+
+    def close(self):
+        '''
+        Logs out of every idle session, sessions still handed out are closed when they come back
+        '''
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+        for ftp, _ in idle:
+            try:
+                ftp.quit()
+            except all_errors:
+                self._close(ftp)
+        stats = self.get_stats()
+        self.logger.info(f"FTP sessions to {self.host}: {stats['logins']} logins, {stats['reuses']} reuses, {stats['dead']} found dead, {stats['discarded']} discarded after errors")
+
+    def _close(self, ftp):
+        try:
+            ftp.close()
+        except all_errors:
+            pass
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,20 +1,32 @@
+import hashlib
+import json
 import os
-from ftplib import FTP
+import time
+from re import match
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from ftplib import error_perm
 from shutil import copy
 import logging
 from retry import retryable, RetryError
+from ftp_pool import FTPSessionPool
 
 class RBManager:
     '''
     Manage transfering of data between data source and data processor
     '''
-    def __init__(self):
+    DIRS_CACHE = "dta_dirs_cache.json" #TODO make configurable
+    DIRS_CACHE_VERSION = 2 #2: listings keep .dtb/.dtbb files too
+    SONG_FILES = (".dta", ".dtab", ".dtb", ".dtbb") #files a songs folder is listed for, a compiled .dtb is only used without a .dta
+
+    def __init__(self, cwd=None):
         self.logger = logging.getLogger("RBManager")
-        self.cwd = os.path.abspath(os.path.join(os.path.realpath(__file__), os.pardir)) #keep track of the CWD
+        self.cwd = cwd or os.path.abspath(os.path.join(os.path.realpath(__file__), os.pardir)) #keep track of the CWD, where the buffers and listings cache go
         self.dta_dirs = {} #dirs containing .dta/.dtabs on PS3, path is key, value is true if dtab is found, false otherwise
+        self.dtb_dirs = set() #dirs of dta_dirs that only have a compiled songs.dtb, their backup is a .dtbb instead of a .dtab
         self.make_buffers()
         self.ps3_ip = None
         self.emu_path = None
+        self.ftp_pool = None #logged in sessions to the PS3 shared by every operation, made once its IP is known
 
     def make_buffers(self):
         '''
@@ -27,265 +39,266 @@ class RBManager:
         except Exception as e:
             self.logger.debug(f"Error making buffers: {e}")
 
-    def get_dta_dirs(self):
+    def get_dta_dirs(self, rescan=False):
         '''
-        Looks for the directories containing .dta files
+        Looks for the directories containing .dta files.
+        Listings from the last run are reused for directories whose modify time (MLSD/MLST fact, or st_mtime for an emulator) hasn't changed, 'rescan' lists everything again.
+        A directory's modify time only changes with its own entries, so a reused listing is only trusted for folders whose parent was listed this run, and 'songs' folders are checked with MLST first.
         '''
-        def ps3():
+        @retryable()
+        def ps3_list_dir(path):
             '''
-            Helper function to seperate PS3 logic
+            Helper function to list a PS3 directory by absolute path, no cwd needed so any pooled session can take it
             '''
-            @retryable()
-            def get_game_folders():
-                '''
-                Helper function to find game folders
-                '''
-                try:
-                    game_folders = []
-                    with FTP(self.ps3_ip, encoding="latin-1", timeout=60) as ftp:
-                        self.logger.info("Connected to PS3, logging in and finding game folders...")
-                        ftp.login()
-                        ftp.cwd("/dev_hdd0/game")
-                        for game_folder, t in ftp.mlsd():
-                            if game_folder == "." or game_folder == "..":
-                                continue
-                            elif t["type"] == "dir":
-                                game_folders.append(os.path.join("/dev_hdd0/game",game_folder))
-                    self.logger.info("Found game folders")
-                    return game_folders
-                except Exception as e:
-                    self.logger.error(f"Error finding game folders: {e}, retry...")
-                    raise RetryError(e)
-            
-            @retryable()
-            def get_usr_dirs(game_folders):
-                '''
-                Helper function to find 'USRDIR' folders
-                '''
-                try:
-                    usr_dirs = []
-                    with FTP(self.ps3_ip, encoding="latin-1", timeout=60) as ftp:
-                        self.logger.info("Connected to PS3, logging in and finding USRDIRs...")
-                        ftp.login()
-                        for game_folder in game_folders:
-                            ftp.cwd(self.to_ps3_dir(game_folder))
-                            for in_game_folder, t in ftp.mlsd():
-                                if in_game_folder == "USRDIR":
-                                    usr_dirs.append(os.path.join(game_folder, "USRDIR"))
-                            ftp.cwd("/")
-                    self.logger.info("Found game folders containig 'USRDIR'")
-                    return usr_dirs
-                except Exception as e:
-                    self.logger.error(f"Error finding USRDIRs: {e}, retry...")
-                    raise RetryError(e)
-            
-            @retryable()
-            def get_song_folders(usr_dirs):
-                '''
-                Helper function to find song folders
-                '''
-                try:
-                    song_folders = []
-                    with FTP(self.ps3_ip, encoding="latin-1", timeout=60) as ftp:
-                        self.logger.info("Connected to PS3, logging in and finding song folders...")
-                        ftp.login()
-                        for usr_dir in usr_dirs:
-                            ftp.cwd(self.to_ps3_dir(usr_dir))
-                            for in_usr_dir,t in ftp.mlsd():
-                                if in_usr_dir == "." or in_usr_dir == "..":
-                                    continue
-                                if t["type"] == "dir" and in_usr_dir != "gen":
-                                    path = os.path.join(usr_dir, in_usr_dir)
-                                    ftp.cwd(self.to_ps3_dir(path))
-                                    for song_folder,t in ftp.mlsd():
-                                        if songs == "songs":
-                                            song_folders.append(os.path.join(usr_dir, in_usr_dir, "songs"))
-                                            ftp.cwd("/")
-                                            break
-                                ftp.cwd("/")
-                            ftp.cwd("/")                              
-                    self.logger.info("Found song folders")
-                    return song_folders
-                except Exception as e:
-                    self.logger.error(f"Error finding song folders: {e}, retry...")
-                    raise RetryError(e)
-
-            @retryable()
-            def find_dta_files(song_folders):
-                '''
-                Helper function to find .dta files
-                '''
-                try:
-                    dta_dirs = {}
-                    with FTP(self.ps3_ip, encoding="latin-1", timeout=60) as ftp:
-                        self.logger.info("Connected to PS3, logging in and finding .dta files...")
-                        ftp.login()
-                        for song_folder in song_folders:
-                            ftp.cwd(self.to_ps3_dir(song_folder))
-                            dta_found = False
-                            dtab_found = False
-                            for file,t in ftp.mlsd():
-                                if t["type"] == "file":
-                                    if file.endswith(".dtab"):
-                                        dtab_found = True
-                                        break
-                                    elif file.endswith(".dta"):
-                                        dta_found = True
-                                        break
-                            if dtab_found:
-                                dta_dirs[song_folder] = True
-                                ftp.cwd("/")
-                                break
-                            elif dta_found:
-                                dta_dirs[song_folder] = False
-                            ftp.cwd("/")
-                    self.logger.info("Found .dta files")
-                    return dta_dirs
-                except Exception as e:
-                    self.logger.error(f"Error finding .dta files: {e}, retry...")
-                    raise RetryError(e)
-
-            game_folders = get_game_folders()
-            usr_dirs = get_usr_dirs(game_folders)
-            song_folders = get_song_folders(usr_dirs)
-            return find_dta_files(song_folders)
+            try:
+                with self.ftp_pool.session() as ftp:
+                    return [(name, facts.get("type"), facts.get("modify")) for name, facts in ftp.mlsd(self.to_ps3_dir(path)) if name != "." and name != ".."]
+            except Exception as e:
+                self.logger.error(f"Error listing {path}: {e}, retry...")
+                raise RetryError(e)
 
-        def emu():
+        @retryable()
+        def ps3_stat_dir(path):
             '''
-            Helper function to seperate emulator logic
+            Helper function to get the modify time of a PS3 directory with MLST, no data connection needed. None if the server can't tell, the folder is listed then
             '''
-            @retryable()
-            def get_game_folders():
-                '''
-                Helper function to find game folders
-                '''
-                self.logger.info("Looking for game folders...")
-                try:
-                    game_folders = []
-                    path = os.path.join(self.emu_path, "dev_hdd0/game")
-                    for game_folder in os.listdir(path):
-                        game_folders.append(os.path.join(path, game_folder))
-                    self.logger.info("Found game folders")
-                    return game_folders
-                except Exception as e:
-                    self.logger.error(f"Error finding game folders: {e}, retry...")
-                    raise RetryError(e)
-            
-            @retryable()
-            def get_usr_dirs(game_folders):
-                '''
-                Helper function to find game folders
-                '''
-                self.logger.info("Looking for 'USRDIR' folders...")
-                try:
-                    usr_dirs = []
-                    for game_folder in game_folders:
-                        path = os.path.join(game_folder, "USRDIR")
-                        if os.path.isdir(path):
-                            usr_dirs.append(path)
-                    self.logger.info("Found game folders containig 'USRDIR'")
-                    return usr_dirs
-                except Exception as e:
-                    self.logger.error(f"Error finding USRDIRs: {e}, retry...")
-                    raise RetryError(e)
-            
-            @retryable()
-            def get_song_folders(usr_dirs):
-                '''
-                Helper function to find game folders
-                '''
-                self.logger.info("Looking for song folders...")
-                try:
-                    song_folders = []
-                    for usr_dir in usr_dirs:
-                        for in_usr_dir in os.listdir(usr_dir):
-                            if in_usr_dir == 'gen':
-                                continue
-                            songs_path = os.path.join(usr_dir, in_usr_dir, "songs")
-                            if os.path.isdir(songs_path):
-                                song_folders.append(songs_path)
-                    self.logger.info("Found song folders")
-                    return song_folders
-                except Exception as e:
-                    self.logger.error(f"Error finding song folders: {e}, retry...")
-                    raise RetryError(e)
-
-            @retryable()
-            def find_dta_files(song_folders):
+            try:
+                with self.ftp_pool.session() as ftp:
+                    try:
+                        reply = ftp.sendcmd(f"MLST {self.to_ps3_dir(path)}")
+                    except error_perm:
+                        return None
+                for line in reply.splitlines()[1:-1]: #facts are on the lines between '250-' and '250 '
+                    facts, _, _ = line.strip().partition(" ")
+                    facts = dict(fact.split("=", 1) for fact in facts.split(";") if "=" in fact)
+                    return {key.lower(): value for key, value in facts.items()}.get("modify")
+                return None
+            except Exception as e:
+                self.logger.error(f"Error getting modify time of {path}: {e}, retry...")
+                raise RetryError(e)
+
+        @retryable()
+        def emu_list_dir(path):
+            '''
+            Helper function to list an emulator directory
+            '''
+            try:
+                with os.scandir(path) as scan:
+                    return [(entry.name, "dir" if entry.is_dir() else "file", str(entry.stat().st_mtime_ns)) for entry in scan]
+            except Exception as e:
+                self.logger.error(f"Error listing {path}: {e}, retry...")
+                raise RetryError(e)
+
+        def emu_stat_dir(path):
+            '''
+            Helper function to get the modify time of an emulator directory, same format as emu_list_dir
+            '''
+            return str(os.stat(path).st_mtime_ns)
+
+        def walk(root, list_dir, stat_dir, workers, cached):
+            '''
+            Helper function that walks game folders, their USRDIR, the folders in it but 'gen' and their 'songs' with up to 'workers' listings at once.
+            The game folders and every USRDIR are always listed. A game folder or pack folder listing from last run is reused if the modify time its parent's fresh listing gives is unchanged.
+            A 'songs' folder's own modify time is asked with 'stat_dir' (its parent's listing may be a reused one) and it is only listed again if that changed.
+            Returns the song folders with whether they have a backup and whether they only have a compiled .dtb, and the listings to reuse next run.
+            '''
+            GAMES, GAME, USRDIR, PACK, SONGS = range(5) #what is being listed at each depth of the walk
+            listings = {} #path is key, [its modify time, the entries the walk cares about] is value
+            dta_dirs = []
+            reused = 0
+            def refresh(depth, path, modify, listing):
                 '''
-                Helper function to find .dta files
+                Runs in the pool, the modify time to save for 'path', its entries and whether they're the ones from last run
                 '''
-                self.logger.info("Looking for .dta files...")
-                try:
-                    dta_dirs = {}
-                    for song_folder in song_folders:
-                        dta_found = False
-                        dtab_found = False
-                        for file in os.listdir(song_folder):
-                            if file.endswith(".dtab"):
-                                dtab_found = True
-                                break
-                            elif file.endswith(".dta"):
-                                dta_found = True
-                        if dtab_found:
-                            dta_dirs[os.path.relpath(song_folder, self.emu_path)] = True
-                            continue
-                        elif dta_found:
-                            dta_dirs[os.path.relpath(song_folder, self.emu_path)] = False
-                    self.logger.info("Found .dta files")
-                    return dta_dirs
-                except Exception as e:
-                    self.logger.error(f"Error finding .dta files: {e}, retry...")
-                    raise RetryError(e)
-    
-            game_folders = get_game_folders()
-            usr_dirs = get_usr_dirs(game_folders)
-            song_folders = get_song_folders(usr_dirs)
-            return find_dta_files(song_folders)
-            
+                if depth == SONGS and listing is not None:
+                    modify = stat_dir(path)
+                    if modify is not None and listing[0] == modify:
+                        return modify, listing[1], True
+                return modify, list_dir(path), False
+
+            def handle(depth, path, order, modify, entries):
+                if depth == SONGS:
+                    files = [entry for entry in entries if entry[1] == "file" and entry[0].endswith(self.SONG_FILES)]
+                    listings[path] = [modify, files]
+                    if files:
+                        compiled = not any(name.endswith((".dta", ".dtab")) for name, _, _ in files)
+                        dta_dirs.append((order, path, any(name.endswith(".dtbb" if compiled else ".dtab") for name, _, _ in files), compiled))
+                    return
+                children = [entry for entry in entries if entry[1] == "dir" and (depth == GAMES or (depth == GAME and entry[0] == "USRDIR") or (depth == USRDIR and entry[0] != "gen") or (depth == PACK and entry[0] == "songs"))]
+                listings[path] = [modify, children]
+                for i, (name, _, child_modify) in enumerate(children):
+                    ready.append((depth + 1, os.path.join(path, name), order + (i,), child_modify))
+
+            ready = [(GAMES, root, (), None)]
+            pending = {}
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while ready or pending:
+                    while ready:
+                        depth, path, order, modify = ready.pop()
+                        listing = cached.get(path)
+                        if listing is not None and depth in (GAME, PACK) and modify is not None and listing[0] == modify: #'modify' comes from the parent's listing, fresh for these depths
+                            reused += 1
+                            handle(depth, path, order, modify, listing[1])
+                        else:
+                            pending[executor.submit(refresh, depth, path, modify, listing)] = (depth, path, order)
+                    if pending:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            depth, path, order = pending.pop(future)
+                            modify, entries, unchanged = future.result()
+                            reused += unchanged
+                            handle(depth, path, order, modify, entries)
+            dta_dirs.sort() #the order a one by one walk finds them in, not the order the listings came back
+            self.logger.info(f"Found .dta files in {len(dta_dirs)} song folders, {len(listings) - reused} directories listed and {reused} unchanged since last run")
+            return [(path, backup_found, compiled) for _, path, backup_found, compiled in dta_dirs], listings
+
         self.logger.info("Getting .dta directories...")
         try:
             if self.ps3_ip != None:
-                self.dta_dirs = ps3()
+                self.logger.info("Connected to PS3, finding .dta files...")
+                source = f"ps3:{self.ps3_ip}"
+                cached = {} if rescan else self.load_dirs_cache(source)
+                dta_dirs, listings = walk("/dev_hdd0/game", ps3_list_dir, ps3_stat_dir, self.ftp_pool.max_sessions, cached)
+                self.dta_dirs = {path: backup_found for path, backup_found, _ in dta_dirs}
+                self.dtb_dirs = {path for path, _, compiled in dta_dirs if compiled}
             elif self.emu_path != None:
-                self.dta_dirs = emu()
+                self.logger.info("Looking for .dta files...")
+                source = f"emu:{os.path.abspath(self.emu_path)}"
+                cached = {} if rescan else self.load_dirs_cache(source)
+                dta_dirs, listings = walk(os.path.join(self.emu_path, "dev_hdd0/game"), emu_list_dir, emu_stat_dir, 4, cached)
+                self.dta_dirs = {os.path.relpath(path, self.emu_path): backup_found for path, backup_found, _ in dta_dirs}
+                self.dtb_dirs = {os.path.relpath(path, self.emu_path) for path, _, compiled in dta_dirs if compiled}
             else:
                 raise ValueError("PS3 IP and Emulator path not defined")
+            self.save_dirs_cache(source, listings)
             return True
         except Exception as e:
             self.logger.error(f"Error getting .dta dirs: {e}")
             return False
 
+    def load_dirs_cache(self, source):
+        '''
+        Directory listings the last walk of 'source' saved, empty if there are none
+        '''
+        try:
+            with open(os.path.join(self.cwd, self.DIRS_CACHE), "r") as cache_f:
+                cache = json.load(cache_f)
+            if cache.get("version") != self.DIRS_CACHE_VERSION:
+                return {}
+            return cache["sources"].get(source, {})
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            self.logger.warning(f"Ignoring unreadable .dta directory cache: {e}")
+            return {}
+
+    def remember_dtabs(self):
+        '''
+        Marks every .dta directory as having a .dtab (.dtbb for a .dtb) once upload put one there.
+        The upload changes the songs folder's modify time, so the next walk lists it again and sees the backup by itself.
+        '''
+        for dir in self.dta_dirs:
+            self.dta_dirs[dir] = True
+
+    def save_dirs_cache(self, source, listings):
+        '''
+        Saves the listings of a walk of 'source' for the next run, written to a temporary file first so a crash never leaves half of it
+        '''
+        path = os.path.join(self.cwd, self.DIRS_CACHE)
+        try:
+            try:
+                with open(path, "r") as cache_f:
+                    cache = json.load(cache_f)
+                if cache.get("version") != self.DIRS_CACHE_VERSION:
+                    raise ValueError("old version")
+            except Exception:
+                cache = {"version": self.DIRS_CACHE_VERSION, "sources": {}}
+            cache["sources"][source] = listings
+            with open(f"{path}.tmp", "w") as cache_f:
+                json.dump(cache, cache_f)
+            os.replace(f"{path}.tmp", path)
+        except Exception as e:
+            self.logger.warning(f"Failed saving .dta directory cache: {e}")
+
     def download_dtas(self):
         '''
         Downloads/copies .dta files from target source
         '''
+        def read_facts(path):
+            try:
+                with open(f"{path}.facts", "r") as facts_f:
+                    return json.load(facts_f)
+            except (OSError, ValueError):
+                return None
+
+        def write_facts(path, facts):
+            with open(f"{path}.facts", "w") as facts_f:
+                json.dump(facts, facts_f)
+
+        def remote_facts(ftp, remote):
+            '''
+            Helper function for the remote file's size and modify time, None for whichever the server won't give
+            '''
+            facts = {"remote": remote, "size": None, "modify": None}
+            try:
+                facts["size"] = ftp.size(remote)
+            except error_perm:
+                pass
+            try:
+                facts["modify"] = ftp.sendcmd(f"MDTM {remote}")[4:].strip()
+            except error_perm:
+                pass
+            return facts
+
         @retryable()
-        def ps3():
+        def ps3_download(dir):
             '''
-            Helper function to seperate PS3 logic
+            Helper function to download one .dta/.dtab, retried on its own.
+            It is skipped when the remote file's size and modify time match the last download, and resumed with REST from a partial download of the same file.
             '''
             try:
-                dtas = {}
-                with FTP(self.ps3_ip, encoding="latin-1", timeout=60) as ftp:
-                    self.logger.info("Connected to PS3, logging in and downloading .dta/dtab...")
-                    ftp.login()
-                    for dir in self.dta_dirs.keys():
-                        ftp.cwd(self.to_ps3_dir(dir))
-                        downloaded_dta_path = os.path.join(self.cwd, "FROM", dir)
-                        if not os.path.exists(downloaded_dta_path):
-                            self.logger.info("Making dir for .dta download")
-                            os.makedirs(downloaded_dta_path)
-                        extension = "songs.dtab" if self.dta_dirs[dir] else "songs.dta"
-                        with open(os.path.join(downloaded_dta_path, "songs.dta"), "wb") as dta_f:
-                            ftp.retrbinary(f"RETR {extension}", dta_f.write)
-                            dtas[downloaded_dta_path] = ""
-                        ftp.cwd("/")
-                return dtas
+                backup, songs = self.song_files(dir)
+                remote = f"{self.to_ps3_dir(dir)}/{backup if self.dta_dirs[dir] else songs}"
+                downloaded_dta_path = self.buffer_path("FROM", dir)
+                os.makedirs(downloaded_dta_path, exist_ok=True)
+                local = os.path.join(downloaded_dta_path, songs)
+                partial = f"{local}.part"
+                start = time.perf_counter()
+                with self.ftp_pool.session() as ftp:
+                    ftp.voidcmd("TYPE I") #SIZE is only exact in binary mode
+                    facts = remote_facts(ftp, remote)
+                    known = facts["size"] is not None and facts["modify"] is not None #enough to tell it is the same file as before
+                    if known and read_facts(local) == facts and os.path.exists(local) and os.path.getsize(local) == facts["size"]:
+                        self.logger.info(f"Skipped {remote}, unchanged since it was downloaded")
+                        return downloaded_dta_path
+                    offset = os.path.getsize(partial) if known and read_facts(partial) == facts and os.path.exists(partial) else 0
+                    if offset > (facts["size"] or 0):
+                        offset = 0
+                    write_facts(partial, facts)
+                    with open(partial, "ab" if offset else "wb") as dta_f:
+                        ftp.retrbinary(f"RETR {remote}", dta_f.write, rest=offset or None)
+                size = os.path.getsize(partial)
+                if facts["size"] is not None and size != facts["size"]:
+                    raise IOError(f"Got {size} of {facts['size']} bytes")
+                os.replace(partial, local)
+                os.replace(f"{partial}.facts", f"{local}.facts")
+                elapsed = time.perf_counter() - start
+                resumed = f", resumed at byte {offset}" if offset else ""
+                self.logger.info(f"Downloaded {remote}: {size - offset} bytes in {elapsed:.2f}s, {(size - offset) / 1e6 / max(elapsed, 1e-9):.2f}MB/s{resumed}")
+                return downloaded_dta_path
             except Exception as e:
-                self.logger.error(f"Error downloading .dtas: {e}, retry...")
+                self.logger.error(f"Error downloading {dir}: {e}, retry...")
                 raise RetryError(e)
 
+        def ps3():
+            '''
+            Helper function to seperate PS3 logic, downloads over as many pooled sessions at once as the pool allows
+            '''
+            self.logger.info("Connected to PS3, downloading .dta/dtab...")
+            with ThreadPoolExecutor(max_workers=self.ftp_pool.max_sessions) as executor:
+                downloads = [executor.submit(ps3_download, dir) for dir in self.dta_dirs.keys()]
+                return {future.result(): "" for future in downloads}
+
         @retryable()
         def emu():
             '''
@@ -295,11 +308,12 @@ class RBManager:
                 dtas = {}
                 self.logger.info("Copying .dta...")
                 for dir in self.dta_dirs.keys():
-                    downloaded_dta_path = os.path.join(self.cwd, "FROM", dir)
+                    downloaded_dta_path = self.buffer_path("FROM", dir)
                     emu_path = os.path.join(self.emu_path, dir)
                     os.makedirs(downloaded_dta_path, exist_ok=True)
-                    extension = "songs.dtab" if os.path.exists(os.path.join(emu_path, "songs.dtab")) else "songs.dta"
-                    copy(os.path.join(emu_path, extension), os.path.join(downloaded_dta_path, "songs.dta"))
+                    backup, songs = self.song_files(dir)
+                    extension = backup if os.path.exists(os.path.join(emu_path, backup)) else songs
+                    copy(os.path.join(emu_path, extension), os.path.join(downloaded_dta_path, songs))
                     dtas[downloaded_dta_path] = ""
                 return dtas
             except Exception as e:
@@ -321,56 +335,97 @@ class RBManager:
 
     def upload(self):
         '''
-        Uploads modified .dta files back to target source
+        Uploads modified .dta files back to target source.
+        Each file is written under a temporary name and renamed into place so an interrupted upload never leaves a truncated .dta,
+        files whose content is what the target already has are skipped.
         '''
+        def file_hash(path):
+            with open(path, "rb") as file_f:
+                return hashlib.file_digest(file_f, "sha256").digest()
+
+        def unchanged(dir, name, path):
+            '''
+            Helper function that tells if 'name' on the target is the file downloaded to FROM, and 'path' has the same content
+            '''
+            backup, songs = self.song_files(dir)
+            downloaded = os.path.join(self.buffer_path("FROM", dir), songs)
+            source = backup if self.dta_dirs[dir] else songs
+            return name == source and os.path.exists(downloaded) and file_hash(downloaded) == file_hash(path)
+
         @retryable()
-        def ps3():
+        def ps3_upload(dir, name, path):
             '''
-            Helper function to seperate PS3 logic
+            Helper function to upload one file in binary mode to a temporary name, check its size and rename it over the old one, retried on its own
             '''
+            remote = f"{self.to_ps3_dir(dir)}/{name}"
+            temp = f"{self.to_ps3_dir(dir)}/.{name}.{os.getpid()}.tmp"
             try:
-                with FTP(self.ps3_ip, encoding='latin-1', timeout=60) as ftp:
-                    ftp.login()
-                    for dir in self.dta_dirs.keys():
-                        path = os.path.join(self.cwd, "TO", dir)
-                        self.logger.info(f"Uploading .dta at {path}, to {dir}")
-                        ftp.cwd(self.to_ps3_dir(dir))
-                        with open(os.path.join(path, "songs.dta")) as dta_f:
-                            ftp.storbinary("STOR songs.dta", dta_f)
-                        with open(os.path.join(path, "songs.dtab")) as dtab_f:
-                            ftp.storbinary("STOR songs.dtab", dtab_f)
-                        ftp.cwd("/")
+                start = time.perf_counter()
+                with self.ftp_pool.session() as ftp:
+                    with open(path, "rb") as upload_f:
+                        ftp.storbinary(f"STOR {temp}", upload_f) #a retry overwrites whatever a failed try left there
+                    size, uploaded = os.path.getsize(path), ftp.size(temp)
+                    if uploaded != size:
+                        raise IOError(f"Target has {uploaded} of {size} bytes")
+                    try:
+                        ftp.rename(temp, remote)
+                    except error_perm: #some servers won't rename over a file that exists
+                        ftp.delete(remote)
+                        ftp.rename(temp, remote)
+                return size, time.perf_counter() - start
             except Exception as e:
-                self.logger.error(f"Error uploading .dtas: {e}, retry...")
+                self.logger.error(f"Error uploading {path} to {remote}: {e}, retry...")
                 raise RetryError(e)
 
         @retryable()
-        def emu():
+        def emu_upload(dir, name, path):
             '''
-            Helper function to seperate emulator logic
+            Helper function to copy one file to a temporary name next to the old one and replace it, retried on its own
             '''
+            target = os.path.join(self.emu_path, dir, name)
             try:
-                for dir in self.dta_dirs.keys():
-                    path = os.path.join(self.cwd, "TO", dir)
-                    emu_path = os.path.join(self.emu_path, dir)
-                    self.logger.info(f"Copying .dta at {path}, to {emu_path}")
-                    copy(os.path.join(path, "songs.dta"), os.path.join(emu_path, "songs.dta"))
-                    copy(os.path.join(path, "songs.dtab"), os.path.join(emu_path, "songs.dtab"))
+                start = time.perf_counter()
+                copy(path, f"{target}.tmp")
+                os.replace(f"{target}.tmp", target)
+                return os.path.getsize(path), time.perf_counter() - start
             except Exception as e:
-                self.logger.error(f"Error uploading .dtas: {e}, retry...")
+                self.logger.error(f"Error copying {path} to {target}: {e}, retry...")
                 raise RetryError(e)
 
+        def upload_dir(dir, upload_file):
+            '''
+            Helper function to upload the .dtab backup then the .dta of a directory (.dtbb then .dtb), in that order so the original is always on the target first
+            '''
+            uploaded = skipped = 0
+            for name in self.song_files(dir):
+                path = os.path.join(self.buffer_path("TO", dir), name)
+                if unchanged(dir, name, path):
+                    self.logger.info(f"Skipped {name} in {dir}, the target already has it")
+                    skipped += 1
+                    continue
+                size, elapsed = upload_file(dir, name, path)
+                self.logger.info(f"Uploaded {path} to {dir}: {size} bytes in {elapsed:.2f}s, {size / 1e6 / max(elapsed, 1e-9):.2f}MB/s")
+                uploaded += size
+            return uploaded, skipped
+
         try:
             if self.ps3_ip != None:
-                ps3()
+                upload_file, workers = ps3_upload, self.ftp_pool.max_sessions
             elif self.emu_path != None:
-                emu()
+                upload_file, workers = emu_upload, 1
             else:
                 raise ValueError("PS3 IP and Emulator path not defined")
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = [future.result() for future in [executor.submit(upload_dir, dir, upload_file) for dir in self.dta_dirs.keys()]]
+            elapsed = time.perf_counter() - start
+            uploaded, skipped = sum(result[0] for result in results), sum(result[1] for result in results)
+            self.logger.info(f"Uploaded {uploaded} bytes in {elapsed:.2f}s, {uploaded / 1e6 / max(elapsed, 1e-9):.2f}MB/s, {skipped} files skipped as unchanged")
+            self.remember_dtabs()
             return True
         except Exception as e:
             self.logger.error(f"Error uploading .dtas: {e}")
-            return false
+            return False
 
     def restore_dtas(self):
         '''
@@ -382,15 +437,15 @@ class RBManager:
             Helper function to seperate PS3 logic
             '''
             try:
-                with FTP(self.ps3_ip, encoding='latin-1', timeout=60) as ftp:
-                    ftp.login()
+                with self.ftp_pool.session() as ftp:
                     for dir in self.dta_dirs.keys():
-                        path = os.path.join(self.cwd, "FROM", dir, "songs.dta")
+                        _, songs = self.song_files(dir)
+                        path = os.path.join(self.buffer_path("FROM", dir), songs)
                         if not os.path.exists(path):
                             continue
                         ftp.cwd(self.to_ps3_dir(dir))
                         with open(path, 'rb') as dta_f:
-                            ftp.storbinary(f"STOR songs.dta", dta_f)
+                            ftp.storbinary(f"STOR {songs}", dta_f)
                         ftp.cwd("/")
             except Exception as e:
                 self.logger.error(f"Error restoring .dtas: {e}, retry...")
@@ -403,10 +458,11 @@ class RBManager:
             '''
             try:
                 for dir in self.dta_dirs.keys():
-                    path = os.join(self.cwd, "FROM", dir, "songs.dta")
+                    _, songs = self.song_files(dir)
+                    path = os.path.join(self.buffer_path("FROM", dir), songs)
                     if not os.path.exists(path):
                         continue
-                    copy(path, os.path.join(self.emu_path, dir, "songs.dta"))
+                    copy(path, os.path.join(self.emu_path, dir, songs))
             except Exception as e:
                 self.logger.error(f"Error restoring .dtas: {e}, retry...")
                 raise RetryError(e)
@@ -423,6 +479,26 @@ class RBManager:
             self.logger.error(f"Error reuploading .dtas: {e}")
             return False
 
+    def close(self):
+        '''
+        Logs out of the PS3 sessions kept open between operations
+        '''
+        if self.ftp_pool is not None:
+            self.ftp_pool.close()
+            self.ftp_pool = None
+
+    def song_files(self, dir: str):
+        '''
+        Names of the backup and the songs file of a .dta directory, songs.dtbb and songs.dtb where the songs are only compiled
+        '''
+        return ("songs.dtbb", "songs.dtb") if dir in self.dtb_dirs else ("songs.dtab", "songs.dta")
+
+    def buffer_path(self, buffer, dir: str):
+        '''
+        Local copy of a .dta directory in the FROM or TO buffer, PS3 directories are absolute so they are made relative to it first
+        '''
+        return os.path.join(self.cwd, buffer, dir.lstrip("/\\"))
+
     def to_ps3_dir(self, dir: str):
         '''Helper function for converting Windows path schema to PS3 schema'''
         return dir.replace('\\','/')
@@ -431,7 +507,6 @@ class RBManager:
         '''
         Attempts to get valid PS3 connection details from user
         '''
-        from ipaddress import ip_address
         try:
             pattern = r"(\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}):(\d{1,5})"
             res = match(pattern, input("Please enter the IP and port (x.x.x.x:xxxxx)>: "))
@@ -442,9 +517,13 @@ class RBManager:
             if any(o <0 or o > 255 for o in octets):
                 raise Exception()
 
-            with FTP(ip, encoding='latin-1', timeout=60) as ftp:
+            ftp_pool = FTPSessionPool(ip, int(port))
+            with ftp_pool.session():
                 self.logger.info("PS3 Connection Validated")
                 self.ps3_ip = ip
+            if self.ftp_pool is not None:
+                self.ftp_pool.close()
+            self.ftp_pool = ftp_pool #the session that validated the connection is the first one reused
             if self.ps3_ip is None:
                 raise Exception("Connection could not be established with provided IP")
             return True
@@ -0,0 +1,62 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    '''
+    Keeps the serialized bytes of read responses until the data behind them is written to
+    '''
+    MAX_ENTRIES = 256 #TODO make configurable
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.logger = logging.getLogger("ResponseCache")
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() #key is the request, value is (body, etag), least recently used first
+        self._generation = 0 #bumped on every invalidation so a response built during a write is never stored
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    @staticmethod
+    def make_etag(body):
+        '''
+        Strong ETag, the same bytes always get the same tag
+        '''
+        return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+    def get(self, key, produce):
+        '''
+        Gives the (body, etag) stored for 'key', calling 'produce' for the body bytes on a miss
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self._stats["hits"] += 1
+                return entry
+            self._stats["misses"] += 1
+            generation = self._generation
+
+        body = produce()
+        entry = (body, self.make_etag(body))
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = entry
+                if len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        '''
+        Drops every stored response, called after a write commits
+        '''
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._stats["invalidations"] += 1
+        self.logger.debug("Response cache invalidated")
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries))
@@ -125,7 +125,7 @@ class RVScraper:
                     raise Exception(f"[Page {page_number}] No valid songs.")
                 database_manager = DatabaseManager()
                 existing_ids = database_manager.find_file_ids(file_ids)
-                if len(existing_ids) == len(file_ids): # If ALL songs on page exist in database, signal to stop crawling
+                if len(existing_ids) == len(set(file_ids)): # If ALL songs on page exist in database, signal to stop crawling
                     self.logger.info(f"[Page {page_number}] All songs already in DB, stopping further scraping.")
                     return False  # signal to stop
                 else:
@@ -260,20 +260,17 @@ class RVScraper:
             self.logger.debug(f"Got back the following 'artist' and 'title's: {wanted_artists_titles}")
             wanted_download_urls = database_manager.find_download_urls(wanted_file_ids)
             self.logger.debug(f"Got back the following 'download_url's: {wanted_download_urls}")
-            self.logger.debug("Zipping together all info for wanted songs")
-            self.logger.debug(f"Before: {wanted_file_id}, {wanted_artists_titles}, {wanted_download_urls}")
-            wanted = list(zip(wanted_file_ids, wanted_artists_titles, wanted_download_urls))
-            self.logger.debug(f"After: {wanted}")
             updated_songs = []
-            for song in wanted:
+            for file_id in wanted_file_ids:
+                artist, title = wanted_artists_titles[file_id]
                 self.logger.debug("Downloading the song")
-                dl_path = download_song(song[0], song[2])
+                dl_path = download_song(file_id, wanted_download_urls[file_id])
                 if not dl_path:
                     continue
                 self.logger.debug("Processing the downloaded file")
-                pkg_path = process_download(song[1][0], song[1][1], dl_path)
+                pkg_path = process_download(artist, title, dl_path)
                 self.logger.debug("Adding song to list")
-                updated_songs.append({"file_id":song[0], "download_path":pkg_path})
+                updated_songs.append({"file_id":file_id, "download_path":pkg_path})
             self.logger.debug("Updating database with new paths to .pkg files")
             database_manager.update_download_paths(updated_songs)
         except Exception as e:
@@ -14,6 +14,7 @@ from fastapi.staticfiles import StaticFiles
 
 from rv_scraper import RVScraper
 from database_manager import DatabaseManager
+from async_database_manager import AsyncDatabaseManager
 
 logging.config.dictConfig({
     'version': 1,
@@ -57,6 +58,16 @@ logging.config.dictConfig({
             'level': 'DEBUG',
             'propagate': False,
         },
+        'AsyncDatabaseManager': {
+            'handlers': ['file', 'stdout'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
+        'ResponseCache': {
+            'handlers': ['file', 'stdout'],
+            'level': 'DEBUG',
+            'propagate': False,
+        },
     },
 })
 
@@ -73,7 +84,7 @@ def run_rv_scraper():
 async def daily_update():
     while True:
         try:
-            run_rv_scraper()
+            await asyncio.to_thread(run_rv_scraper) #scraping blocks, keep it off the event loop
             logger.info("Daily update complete. Sleeping until midnight...")
             print(f"The secret code is: {secret_code}")
         except Exception as e:
@@ -81,6 +92,19 @@ async def daily_update():
         
         await asyncio.sleep(get_time_until_midnight())        
 
+async def cached_json_response(request: fastapi.Request, produce):
+    '''
+    Serves a read from the response cache with a strong ETag, answering 304 when the client already has it.
+    'produce' is given a DatabaseManager and runs on the database read pool.
+    '''
+    db_m = AsyncDatabaseManager()
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    body, etag = await db_m.get_cached(key, lambda: produce(DatabaseManager()))
+    if_none_match = [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]
+    if etag in if_none_match or "*" in if_none_match:
+        return fastapi.Response(status_code=304, headers={"ETag": etag})
+    return fastapi.Response(content=body, media_type="application/json", headers={"ETag": etag})
+
 from typing import List, Dict, Any
 from pydantic import BaseModel
 
@@ -105,6 +129,7 @@ if __name__ == "__main__":
 
     @contextlib.asynccontextmanager
     async def lifespan(app: fastapi.FastAPI):
+        DatabaseManager() #migrates the database schema once at startup
         task = asyncio.create_task(daily_update())
         try:
             yield
@@ -114,6 +139,8 @@ if __name__ == "__main__":
                 await task
             except asyncio.CancelledError:
                 pass
+            AsyncDatabaseManager.shutdown()
+            DatabaseManager.close_connections()
 
     app = fastapi.FastAPI(lifespan=lifespan)
 
@@ -143,30 +170,61 @@ if __name__ == "__main__":
 
 
     @app.get("/api/customs")
-    async def get_customs():
-        """Get all customs data as JSON"""
+    async def get_customs(request: fastapi.Request, sort: str = "artist", cursor: str = None, limit: int = 100, since: int = None):
+        """Get one page of customs data as JSON, every other query parameter is a filter. With 'since' get only what changed after that version"""
         try:
-            db_m = DatabaseManager()
-            customs_data = db_m.get_all_fields("customs")
-            return {
-                "data":customs_data
-            }
+            filters = {name: value for name, value in request.query_params.items() if name not in ("sort", "cursor", "limit", "since")}
+            def produce(db_m):
+                if since is not None:
+                    return db_m.get_changes("customs", since)
+                customs_data, next_cursor = db_m.get_page("customs", filters, sort, cursor, limit)
+                return {
+                    "data":customs_data,
+                    "next_cursor":next_cursor
+                }
+            return await cached_json_response(request, produce)
         except Exception as e:
             logger.error(f"Error getting customs: {e}")
-            raise fastapi.responses.JSONResponse({"error":"Error getting customs"}, status_code=400)
+            return fastapi.responses.JSONResponse({"error":f"Error getting customs: {e}"}, status_code=400)
 
     @app.get("/api/officials")
-    async def get_officials():
-        """Get all officials data as JSON"""
+    async def get_officials(request: fastapi.Request, sort: str = "artist", cursor: str = None, limit: int = 100, since: int = None):
+        """Get one page of officials data as JSON, every other query parameter is a filter. With 'since' get only what changed after that version"""
+        try:
+            filters = {name: value for name, value in request.query_params.items() if name not in ("sort", "cursor", "limit", "since")}
+            def produce(db_m):
+                if since is not None:
+                    return db_m.get_changes("officials", since)
+                officials_data, next_cursor = db_m.get_page("officials", filters, sort, cursor, limit)
+                return {
+                    "data":officials_data,
+                    "next_cursor":next_cursor
+                }
+            return await cached_json_response(request, produce)
+        except Exception as e:
+            logger.error(f"Error getting officials: {e}")
+            return fastapi.responses.JSONResponse({"error":f"Error getting officials: {e}"}, status_code=400)
+
+    @app.get("/api/search")
+    async def search(q: str, table: str = "customs", limit: int = 50, offset: int = 0):
+        """Full text search customs or officials by artist and title, best matches first"""
         try:
-            db_m = DatabaseManager()
-            officials_data = db_m.get_all_fields("officials")
+            db_m = AsyncDatabaseManager()
             return {
-                "data":officials_data
+                "data":await db_m.search(q, target_table=table, limit=limit, offset=offset)
             }
         except Exception as e:
-            logger.error(f"Error getting officials: {e}")
-            raise fastapi.responses.JSONResponse({"error":"Error getting officials"}, status_code=400)
+            logger.error(f"Error searching {table}: {e}")
+            return fastapi.responses.JSONResponse({"error":f"Error searching {table}: {e}"}, status_code=400)
+
+    @app.get("/api/matches")
+    async def get_matches(request: fastapi.Request):
+        """Get the custom charts of every wanted official song"""
+        try:
+            return await cached_json_response(request, lambda db_m: {"data":db_m.get_customs_for_wanted_officials()})
+        except Exception as e:
+            logger.error(f"Error getting matches: {e}")
+            return fastapi.responses.JSONResponse({"error":f"Error getting matches: {e}"}, status_code=400)
 
     @app.post("/api/customs/update")
     async def update_customs(request: fastapi.Request):
@@ -175,9 +233,11 @@ if __name__ == "__main__":
             data = await request.json()
             if "updates" not in data:
                 raise ValueError("Request does not have 'update'")
-            db_m = DatabaseManager()
-            db_m.update_wanted(data["updates"], target_table="customs")
-            return {"success": True, "message": f"Updated {len(data["updates"])} customs songs"}
+            db_m = AsyncDatabaseManager()
+            batches = await db_m.update_wanted(data["updates"], target_table="customs")
+            updated = sum(batch["updated"] for batch in batches)
+            not_found = sum(batch["not_found"] for batch in batches)
+            return {"success": True, "message": f"Updated {updated} of {len(data["updates"])} customs songs, {not_found} not found", "batches": batches}
         except Exception as e:
             logger.error(f"Error updating customs: {e}")
             return fastapi.responses.JSONResponse({"error":f"Error updating customs: {e}"},status_code=400)
@@ -189,18 +249,28 @@ if __name__ == "__main__":
             data = await request.json()
             if "updates" not in data:
                 raise ValueError("Request does not have 'update'")
-            db_m = DatabaseManager()
-            db_m.update_wanted(data["updates"], target_table="officials")
-            return {"success": True, "message": f"Updated {len(data["updates"])} officials songs"}
+            db_m = AsyncDatabaseManager()
+            batches = await db_m.update_wanted(data["updates"], target_table="officials")
+            updated = sum(batch["updated"] for batch in batches)
+            not_found = sum(batch["not_found"] for batch in batches)
+            return {"success": True, "message": f"Updated {updated} of {len(data["updates"])} officials songs, {not_found} not found", "batches": batches}
         except Exception as e:
             logger.error(f"Error updating officials: {e}")
             return fastapi.responses.JSONResponse({"error":f"Error updating officials: {e}"},status_code=400)
 
+    @app.get("/api/stats")
+    async def get_stats():
+        """Get database connection reuse, lock wait and response cache counters"""
+        return {"database": DatabaseManager.get_stats(), "cache": DatabaseManager.get_cache_stats()}
+
     @app.get("/whitelist")
-    def get_whitelist(response: fastapi.Response):
+    async def get_whitelist(request: fastapi.Request, response: fastapi.Response, since: int = None):
         try:
-            db_m = DatabaseManager()
-            return db_m.get_wanted_official_songs()
+            def produce(db_m):
+                if since is not None:
+                    return db_m.get_changes("officials", since)
+                return db_m.get_wanted_official_songs()
+            return await cached_json_response(request, produce)
         except Exception as e:
             logger.error(f"[Server] Error getting whitelist: {e}")
             response.status_code = 400
@@ -216,9 +286,10 @@ if __name__ == "__main__":
             if not isinstance(songs, list):
                 raise ValueError("Expected list of songs")
             logger.debug("Firing up DatabaseManager")
-            db_m = DatabaseManager()
+            db_m = AsyncDatabaseManager()
             logger.debug("Saving songs to 'officials'")
-            db_m.save_songs(songs, "officials")                
+            batches = await db_m.save_songs(songs, "officials")
+            logger.debug(f"Saved 'officials' in {len(batches)} batches: {batches}")
             return "OK"
         except Exception as e:
             logger.error(f"Error during updating db: {e}")
@@ -1,21 +1,156 @@
 import logging
+import mmap
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from multiprocessing import get_context
 from shutil import copy
 from webbrowser import open as web_open
 from retry import retryable, RetryError
 
-from dta_processor import DTAProcessor
+from dta_cache import DTACache
+from dta_processor import DTAProcessor, DTBArray
+from song_matching import make_match_key
+
+def _find_field(content, key):
+    '''
+    First (key ...) list directly inside 'content'
+    '''
+    for item in content[1:]:
+        if isinstance(item, list) and item and item[0] == key:
+            return item
+    return None
+
+def _field_value(content, key):
+    field = _find_field(content, key)
+    return field[1] if field is not None and len(field) > 1 else None
+
+def _decode_shortname(content):
+    return content[0] if content and isinstance(content[0], str) else None
+
+def _decode_song_id(content):
+    return _field_value(content, "song_id")
+
+def _decode_rank(content):
+    field = _find_field(content, "rank")
+    if field is None:
+        return {}
+    return {item[0]: item[1] for item in field[1:] if isinstance(item, list) and len(item) > 1}
+
+def _decode_genre(content):
+    genre = _field_value(content, "genre")
+    return genre.strip('"') if isinstance(genre, str) else genre
+
+def _decode_year(content):
+    year = _field_value(content, "year_released")
+    return year if isinstance(year, int) and not isinstance(year, bool) else None
+
+def _decode_vocal_parts(content):
+    song = _find_field(content, "song") #vocal_parts belongs in the song's (song ...) but some customs put it at the top
+    vocal_parts = _field_value(song, "vocal_parts") if song is not None else None
+    return vocal_parts if vocal_parts is not None else _field_value(content, "vocal_parts")
 
 class Song:
     '''
-    Store the name and artist of a song, if it was excluded and why, and all the text content
+    Store the name and artist of a song, if it was excluded and why, and all the text content.
+    The raw bytes of the song are the source of truth, they are only parsed and typed fields only decoded when first asked for.
     '''
+    __slots__ = ("name", "artist", "excluded", "_buffer", "_start", "_end", "_content", "_fields")
+
+    FIELD_DECODERS = {
+        "shortname": _decode_shortname,
+        "song_id": _decode_song_id,
+        "rank": _decode_rank,
+        "genre": _decode_genre,
+        "year": _decode_year,
+        "vocal_parts": _decode_vocal_parts,
+    }
+
     def __init__(self):
         self.name = "" #name of song
         self.artist = "" #artist of song
-        self.content = [] #song data from DTA as nested list
         self.excluded = False #should the song be excluded
+        self._buffer = b"" #bytes of the .dta the song was read from, shared with every other song in it
+        self._start = 0 #where the song starts in _buffer, comments above it included
+        self._end = 0
+        self._content = None #parsed song, only filled when asked for
+        self._fields = None #decoded typed fields, only filled when asked for
+
+    def set_span(self, buffer, start:int, end:int):
+        '''
+        Points the song at buffer[start:end] without copying it
+        '''
+        self._buffer, self._start, self._end = buffer, start, end
+        self._content = self._fields = None
+
+    @property
+    def span(self):
+        '''
+        Raw bytes of the song in its .dta, a memoryview of the file when it was read from one
+        '''
+        return memoryview(self._buffer)[self._start:self._end]
+
+    @span.setter
+    def span(self, span):
+        self.set_span(span, 0, len(span))
+
+    @property
+    def content(self)->list:
+        '''
+        Song data from DTA as nested list, only parsed from the span when asked for
+        '''
+        if self._content is None:
+            self._content = self._parse_span()
+        return self._content
+
+    def _parse_span(self)->list:
+        span = self.span
+        parsed = DTAProcessor.dta_to_nested_list(bytes(span).decode(DTAProcessor.song_encoding(span), errors="replace"))
+        return next((item for item in parsed if isinstance(item, list)), [])
+
+    @content.setter
+    def content(self, content:list):
+        '''
+        Replaces the song data, the song is then written from it instead of its original bytes
+        '''
+        self.set_span(b"", 0, 0)
+        self._content = content
+
+    def get_field(self, field:str):
+        '''
+        Typed value of one of FIELD_DECODERS, None if the song doesn't have it.
+        The first one asked for decodes them all from a throwaway parse of the span, so the song never holds its whole parsed content just for them.
+        '''
+        if self._fields is None:
+            content = self._content if self._content is not None else self._parse_span()
+            self._fields = {name: decode(content) for name, decode in self.FIELD_DECODERS.items()}
+        return self._fields[field]
+
+    shortname = property(lambda self: self.get_field("shortname"), doc="Symbol the song is known by in the .dta")
+    song_id = property(lambda self: self.get_field("song_id"), doc="Numeric song_id, or the symbol some customs use instead")
+    rank = property(lambda self: self.get_field("rank"), doc="Instrument to rank, like {'drum': 300}")
+    genre = property(lambda self: self.get_field("genre"), doc="Genre symbol, like 'rock'")
+    year = property(lambda self: self.get_field("year"), doc="year_released as an int")
+    vocal_parts = property(lambda self: self.get_field("vocal_parts"), doc="How many vocal parts the song has")
+
+    def to_dict(self)->dict:
+        '''
+        Song data as nested dicts, see DTAProcessor.nested_list_to_dict
+        '''
+        return DTAProcessor.nested_list_to_dict(self.content)
+
+    @classmethod
+    def from_dict(cls, song_dict:dict)->'Song':
+        '''
+        Song built from to_dict output, written back with DTAProcessor.write_dta
+        '''
+        song = cls()
+        song.content = DTAProcessor.dict_to_nested_list(song_dict)
+        name = _field_value(song.content, "name")
+        artist = _field_value(song.content, "artist")
+        song.name = str(name).strip('"') if name is not None else ""
+        song.artist = str(artist).strip('"') if artist is not None else ""
+        return song
 
     def __eq__(self, other:'Song')->bool:
         return (self.name == other.name) and (self.artist == other.artist)
@@ -28,19 +163,26 @@ class SongManager:
     '''
     Manage processing of song data locally
     '''
-    def __init__(self):
+    POOL_MIN_BYTES = 256 * 1024 #smaller .dtas are indexed on their thread, starting work in another process costs more than they take
+    CHUNK_BYTES = 2 * 1024 * 1024 #larger .dtas are split into ranges about this big for the process pool
+
+    def __init__(self, workers=None):
         self.logger = logging.getLogger("SongManager")
+        self.workers = workers or os.cpu_count() or 1 #processes that index .dtas, 1 indexes them on the reading threads
         self.songs = {} #all the songs that program can recognize, path is key, all songs in that file is value
         self.kept = [] #which songs to keep
         self.excluded = [] #which songs to exclude
         self.whitelist = [] #TODO self.whitelist needed, list of tuples [(artist,song_name)...]
+        self.trailers = {} #path is key, whatever follows the last song in that file is value
+        self.dta_cache = DTACache() #song indexes of .dtas already read, by content
+        self.dtb_roots = {} #path is key, decoded songs.dtb read there instead of a songs.dta is value
 
     def read_dtas(self, dta_dirs):
         '''
         Open each .dta that was downloaded and process it
         '''
         @retryable()
-        def process_dta(file_path):
+        def process_dta(file_path, parser_pool):
             '''
             Helper function that sends .dta to be processed and return list of songs.
             '''
@@ -48,38 +190,72 @@ class SongManager:
                 self.logger.debug(f"Processing .dta file at {file_path}")
                 processor = DTAProcessor()
                 song_list = []
-                with open(os.path.join(file_path, "songs.dta"), 'r') as dta_f:
-                    nested = processor.dta_to_nested_list(dta_f.read())
-                self.logger.debug(f"Got back a nested list from {file_path}, extracting songs")
-                for each in nested:
-                    #checks if every song returned is in a valid format
-                    if not isinstance(each,list) or (isinstance(each,list) and len(each) < 2) or (isinstance(each,list) and len(each) >= 2 and ((not isinstance(each[1],list) or not isinstance(each[2],list)))):
-                        self.logger.debug(f"Item of nested list not in expected format: {each}")
-                        continue
-                    if not isinstance(each[1][1], str):
-                        self.logger.debug(f"{str(each[1][1])} processed as {type(each[1][1])}")
-                    if not isinstance(each[2][1], str):
-                        self.logger.debug(f"{str(each[2][1])} processed as {type(each[2][1])}")
+                if not os.path.exists(os.path.join(file_path, "songs.dta")) and os.path.exists(os.path.join(file_path, "songs.dtb")):
+                    return process_dtb(file_path)
+                with open(os.path.join(file_path, "songs.dta"), 'rb') as dta_f:
+                    #mapped instead of read so the file is paged in by the OS and never copied, songs keep the map open for finalize
+                    data = mmap.mmap(dta_f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(dta_f.fileno()).st_size else b""
+                fields = ("name", "artist")
+                key = self.dta_cache.make_key(data, fields)
+                cached = self.dta_cache.load(key)
+                if cached is None:
+                    executor = parser_pool if len(data) >= self.POOL_MIN_BYTES else None
+                    parts = max(1, min(self.workers, len(data) // self.CHUNK_BYTES))
+                    spans, (trailer_start, trailer_end) = processor.index_file(os.path.join(file_path, "songs.dta"), data, fields, executor, parts)
+                    self.dta_cache.store(key, spans, (trailer_start, trailer_end))
+                    self.logger.debug(f"Found {len(spans)} songs in {file_path}")
+                else:
+                    spans, (trailer_start, trailer_end) = cached
+                    self.logger.debug(f"Found {len(spans)} songs in {file_path}, unchanged since it was cached")
+                for start, end, fields in spans:
+                    if "name" not in fields or "artist" not in fields:
+                        self.logger.debug(f"Song without a name or artist in {file_path}: {data[start:min(end, start + 100)]}")
                     s = Song()
-                    s.name = each[1][1].strip('"') if each[1][0] == "name" else ""
-                    s.artist = each[2][1].strip('"') if each[2][0] == "artist" else ""
-                    s.content = each
+                    s.name = str(fields.get("name", "")).strip('"')
+                    s.artist = str(fields.get("artist", "")).strip('"')
+                    s.set_span(data, start, end) #songs share the file's bytes instead of copying them
                     song_list.append(s)
+                self.trailers[file_path] = memoryview(data)[trailer_start:trailer_end]
                 self.songs[file_path] = song_list
                 return True
             except Exception as e:
                 self.logger.debug(f"Error processing .dta: {e}, retry...")
                 raise RetryError(e)
                 
+        def process_dtb(file_path):
+            '''
+            Helper function that decodes a compiled .dtb, its songs are built from their decoded content as it has no text to point into
+            '''
+            with open(os.path.join(file_path, "songs.dtb"), 'rb') as dtb_f:
+                root = DTAProcessor.dtb_to_nested_list(dtb_f.read())
+            song_list = []
+            for content in root:
+                if not isinstance(content, list):
+                    continue
+                s = Song()
+                s.name = str(_field_value(content, "name") or "").strip('"')
+                s.artist = str(_field_value(content, "artist") or "").strip('"')
+                s.content = content
+                song_list.append(s)
+            self.logger.debug(f"Found {len(song_list)} songs in {file_path}, compiled")
+            self.dtb_roots[file_path] = root
+            self.songs[file_path] = song_list
+            return True
+
         self.logger.info("Processing downloaded .dtas")
         try:
-            with ThreadPoolExecutor() as executor:
-                dta_process_futures = [executor.submit(process_dta, dir) for dir in dta_dirs]
+            #parsing is CPU bound so it is spread over processes, the threads only read, hash and wait on them
+            parser_pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=get_context("spawn")) if self.workers > 1 else nullcontext()
+            with parser_pool, ThreadPoolExecutor() as executor:
+                dta_process_futures = [executor.submit(process_dta, dir, parser_pool if self.workers > 1 else None) for dir in dta_dirs]
                 for future in as_completed(dta_process_futures):
                     if not future.result():
                         raise Exception("Failed processing .dtas")
                 amount_of_songs = len([song for songs in self.songs.values() for song in songs])
                 self.logger.info(f"{amount_of_songs} total songs found.")
+            cache_stats = self.dta_cache.get_stats()
+            self.logger.info(f"{cache_stats['hits']} .dtas unchanged since last run, {cache_stats['misses']} parsed")
+            self.dta_cache.evict()
             return True
         except Exception as e:
             self.logger.error(f"Error reading .dtas: {e}")
@@ -89,6 +265,7 @@ class SongManager:
         '''
         Excludes not wanted songs
         '''
+        whitelist_keys = {make_match_key(artist, title) for artist, title in self.whitelist} #normalized once, matched in O(1) per song
         @retryable()
         def process_exclusion(songs):
             '''
@@ -96,7 +273,7 @@ class SongManager:
             '''
             try:
                 for song in songs:
-                    if (song.artist, song.name) in self.whitelist:
+                    if make_match_key(song.artist, song.name) in whitelist_keys:
                         self.logger.debug(f"Whitelisted {song}")
                         song.excluded = False
                         self.kept.append(song)
@@ -123,6 +300,59 @@ class SongManager:
             self.logger.debug(f"Error during automatic exclusion: {e}")
             return False
 
+    def stream_dtas(self, dta_dirs):
+        '''
+        Reads, excludes and writes each .dta one song at a time, so only the song being looked at is in memory.
+        For runs without manual confirmation, kept and excluded get the songs' names and artists but self.songs stays empty.
+        '''
+        whitelist_keys = {make_match_key(artist, title) for artist, title in self.whitelist}
+        @retryable()
+        def stream_dta(dir):
+            '''
+            Helper function to pipe the songs of one .dta through exclusion into its modified file
+            '''
+            try:
+                destination_path = dir.replace("FROM", "TO")
+                os.makedirs(destination_path, exist_ok=True) #make path if doesn't exist
+                copy(os.path.join(dir, "songs.dta"), os.path.join(destination_path, "songs.dtab")) #create backup .dta
+                kept, excluded = [], []
+                with open(os.path.join(destination_path, "songs.dta"), "wb") as dta_f:
+                    for span, fields in DTAProcessor.iter_dta(os.path.join(dir, "songs.dta"), ("name", "artist")):
+                        if fields is None: #what follows the last song
+                            dta_f.write(span)
+                            continue
+                        song = Song()
+                        song.name = str(fields.get("name", "")).strip('"')
+                        song.artist = str(fields.get("artist", "")).strip('"')
+                        song.excluded = make_match_key(song.artist, song.name) not in whitelist_keys
+                        if song.excluded:
+                            self.logger.debug(f"Excluded {song}")
+                            excluded.append(song)
+                        else:
+                            self.logger.debug(f"Whitelisted {song}")
+                            kept.append(song)
+                            dta_f.write(span)
+                self.kept.extend(kept)
+                self.excluded.extend(excluded)
+                self.logger.debug(f"Streamed {len(kept) + len(excluded)} songs from {dir} to {destination_path}")
+                return True
+            except Exception as e:
+                self.logger.debug(f"Error streaming .dta from {dir}: {e}")
+                raise RetryError(e)
+
+        self.logger.info("Streaming .dtas through exclusion")
+        try:
+            with ThreadPoolExecutor() as executor:
+                stream_futures = [executor.submit(stream_dta, dir) for dir in dta_dirs]
+                for future in as_completed(stream_futures):
+                    if not future.result():
+                        raise Exception("Failed streaming a .dta")
+            self.logger.info(f"{len(self.kept)} songs kept and {len(self.excluded)} excluded")
+            return True
+        except Exception as e:
+            self.logger.error(f"Error streaming .dtas: {e}")
+            return False
+
     def manual_confirmation(self):
         '''
         Allow the user to keep excluded songs or confirm exclusion of songs manually.
@@ -181,59 +411,63 @@ class SongManager:
         '''
         Finalize changes and create the files
         '''
-        modified_dtas = {}#temporary dictionary, key is path value is modifed contents
-        @retryable()
-        def create_modified_dta(dir):
-            '''
-            Helper function to create modified .dta file strings before writing them
-            '''
-            try:
-                self.logger.debug(f"Finalizing {len(self.songs[dir])} songs at {dir}")
-                processor = DTAProcessor()
-                modified_content = ""
-                for song in self.songs[dir]:
-                    if song in self.kept:
-                        self.logger.debug(f"Adding {song} back to .dta at {dir}")
-                        modified_content += processor.nested_list_to_dta(song.content) + "\n"
-                modified_dtas[dir] = modified_content
-                return True
-            except Exception as e:
-                self.logger.debug(f"Error creating modified .dta strings from {dir}: {e}")
-                raise RetryError(e)
-
+        kept = set(self.kept)
         @retryable()
         def write_modified_dta(dir):
             '''
-            Helper function to write modified .dta file string
+            Helper function to stream the kept songs of a .dta to its modified file
             '''
             try:
+                self.logger.debug(f"Finalizing {len(self.songs[dir])} songs at {dir}")
                 destination_path = dir.replace("FROM", "TO")
                 os.makedirs(destination_path, exist_ok=True) #make path if doesn't exist
+                if dir in self.dtb_roots:
+                    return write_modified_dtb(dir, destination_path)
                 copy(os.path.join(dir, "songs.dta"), os.path.join(destination_path, "songs.dtab")) #create backup .dta
                 self.logger.debug(f"Writing modified content to {destination_path}")
-                with open(os.path.join(destination_path, "songs.dta"), "w") as dta_f: #make the dta
-                    dta_f.write(modified_dtas[dir])
+                with open(os.path.join(destination_path, "songs.dta"), "wb") as dta_f:
+                    for song in self.songs[dir]:
+                        if song not in kept:
+                            continue
+                        self.logger.debug(f"Adding {song} back to .dta at {dir}")
+                        if song.span:
+                            dta_f.write(song.span) #read from a .dta, written back byte for byte
+                        else:
+                            parts = []
+                            DTAProcessor.write_dta(song.content, parts.append)
+                            parts.append("\n")
+                            text = "".join(parts)
+                            #encoded the way it is decoded, latin-1 unless the song says (encoding utf8)
+                            dta_f.write(text.encode(DTAProcessor.song_encoding(text.encode("utf-8")), errors="replace"))
+                    dta_f.write(self.trailers.get(dir, b""))
                 self.logger.debug(f"Done writing to {destination_path}")
                 return True
             except Exception as e:
                 self.logger.debug(f"Error writing modified .dta originally from {dir}: {e}")
                 raise RetryError(e)
 
+        def write_modified_dtb(dir, destination_path):
+            '''
+            Helper function to compile the kept songs of a .dtb back into one, anything that isn't a song stays where it was
+            '''
+            root = self.dtb_roots[dir]
+            kept_contents = {id(song.content) for song in self.songs[dir] if song in kept}
+            modified = DTBArray((item for item in root if not isinstance(item, list) or id(item) in kept_contents), root.kind, root.line, root.id)
+            copy(os.path.join(dir, "songs.dtb"), os.path.join(destination_path, "songs.dtbb")) #create backup .dtb
+            with open(os.path.join(destination_path, "songs.dtb"), "wb") as dtb_f:
+                dtb_f.write(DTAProcessor.nested_list_to_dtb(modified))
+            self.logger.debug(f"Done writing {len(modified)} items to {destination_path}")
+            return True
+
         self.logger.info("finalizing .dta files to send back")
         try:
             with ThreadPoolExecutor() as executor:
                 dirs = self.songs.keys()
-                self.logger.info("Creating new .dta strings to write to files")
-                create_futures = [executor.submit(create_modified_dta, dir) for dir in dirs]
-                for future in as_completed(create_futures):
-                    if not future.result():
-                        raise Exception("a .dta file string failed to be created")
-
-                self.logger.info("Writing new .dta strings to files")
+                self.logger.info("Writing kept songs to new .dta files")
                 write_futures = [executor.submit(write_modified_dta, dir) for dir in dirs]
                 for future in as_completed(write_futures):
                     if not future.result():
-                        raise Exception("a .dta file string failed to be writted")
+                        raise Exception("a .dta file failed to be written")
 
             self.logger.info("Modified .dta files finalized")
             return True
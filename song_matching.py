@@ -0,0 +1,48 @@
+'''
+Normalized keys songs are matched on, check the normalization with:
+python -m song_matching
+'''
+import re
+import unicodedata
+
+_FEATURING = re.compile(r"\s+(?:[\(\[](?:feat\.?|ft\.?|featuring)|feat\.|ft\.|featuring)\s.*$") #featured artists suffix, never the first word, a bare "ft" only in brackets as in "Six ft Under" it is a word
+_PUNCTUATION = re.compile(r"[^\w\s]")
+
+def normalize(text: str) -> str:
+    '''
+    Reduces an artist or title to the form it is matched on: no accents, casing, punctuation, featured artists or leading "The", "&" is "and"
+    '''
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(char for char in text if not unicodedata.combining(char)).casefold()
+    text = _FEATURING.sub("", text)
+    text = _PUNCTUATION.sub("", text.replace("&", " and "))
+    words = text.split()
+    if len(words) > 1 and words[0] == "the":
+        words = words[1:]
+    return " ".join(words)
+
+def make_match_key(artist: str, title: str) -> str:
+    '''
+    Key that the same song gets no matter how its artist and title are written
+    '''
+    return f"{normalize(artist)}|{normalize(title)}"
+
+_EXAMPLES = [ #(written as, normalized)
+    ("The Beatles", "beatles"),
+    ("The The", "the"),
+    ("Beyoncé", "beyonce"),
+    ("Simon & Garfunkel", "simon and garfunkel"),
+    ("AC/DC", "acdc"),
+    ("Run This Town (feat. Rihanna)", "run this town"),
+    ("Empire State of Mind [ft Alicia Keys]", "empire state of mind"),
+    ("Stay ft. Justin Bieber", "stay"),
+    ("Airplanes featuring Hayley Williams", "airplanes"),
+    ("Feat. First", "feat first"),
+    ("Six ft Under", "six ft under"),
+    ("Five ft High", "five ft high"),
+]
+
+if __name__ == "__main__":
+    for text, expected in _EXAMPLES:
+        assert normalize(text) == expected, f"{text!r} normalized to {normalize(text)!r} instead of {expected!r}"
+    print(f"{len(_EXAMPLES)} normalization examples pass")